@@ -1,19 +1,43 @@
-import json
+import logging
+from dataclasses import dataclass
+from typing import Any
 
 import chainlit as cl
-import plotly.graph_objects as go
+from chainlit.element import Element
+from langchain_core.messages import AIMessage, BaseMessage
 
 import atlas_assistant.settings
-from atlas_assistant.agent import create_graph
+from atlas_assistant.agent import get_graph, reset_graph, warm_up
+from atlas_assistant.blobs import resolve_json
+from atlas_assistant.checkpointer import close_checkpointer
+from atlas_assistant.llm import close_llm_gateway, llm_report
+from atlas_assistant.render import chart_key, describe_update
+from atlas_assistant.rollups import get_rollup_router
+from atlas_assistant.semantic_cache import chart_cache_report
+
+logger = logging.getLogger(__name__)
+
+
+@cl.on_app_startup
+async def startup():
+    # Before the first session, rather than during it
+    try:
+        await warm_up(atlas_assistant.settings.get_settings())
+    except Exception:
+        # Not fatal, what failed is loaded again on first use
+        logger.exception("Warm-up failed, loading on first use instead")
 
 
 @cl.on_chat_start
 async def start():
     """Initialize the agent when chat starts"""
     settings = atlas_assistant.settings.get_settings()
-    graph = await create_graph(settings)
+    # Compiled once for the process, sessions only differ by their thread id
+    graph = await get_graph(settings)
     cl.user_session.set("graph", graph)
-    cl.user_session.set("thread_id", "default_thread")
+    # One conversation per chat session; the browser sends the same thread id
+    # back when it reconnects, e.g. after a restart of the worker
+    cl.user_session.set("thread_id", cl.context.session.thread_id)
     await cl.Message(
         content="""Hello! Ask me about climate adaptation data from the Adaptation Atlas.
         Examples:
@@ -24,6 +48,22 @@ async def start():
     ).send()
 
 
+@cl.on_app_shutdown
+async def shutdown():
+    await close_checkpointer()
+    reset_graph()
+    report = get_rollup_router().report()
+    if report:
+        logger.info(f"Chart queries answered by rollups:\n{report}")
+    report = chart_cache_report()
+    if report:
+        logger.info(f"Semantic chart cache: {report}")
+    report = llm_report()
+    if report:
+        logger.info(f"Mistral API calls:\n{report}")
+    await close_llm_gateway()
+
+
 @cl.on_message
 async def main(message: cl.Message):
     """Handle incoming messages"""
@@ -31,79 +71,196 @@ async def main(message: cl.Message):
     thread_id = cl.user_session.get("thread_id")
 
     config = {"configurable": {"thread_id": thread_id}}
+    renderer = TurnRenderer()
 
-    # Create a message to update with streaming content
-    msg = cl.Message(content="")
-
-    # Stream agent updates
-    async for update in graph.astream(
-        {"messages": [("user", message.content)]}, config=config, stream_mode="updates"
+    # Stream agent updates, the stages of the charts as they're done, and the
+    # tokens of the answer
+    async for mode, update in graph.astream(
+        {"messages": [("user", message.content)]},
+        config=config,
+        stream_mode=["updates", "custom", "messages"],
     ):
+        if mode == "custom":
+            await renderer.stage(update)
+        elif mode == "messages":
+            await renderer.token(*update)
+        else:
+            await renderer.update(update)
+    await renderer.finish()
+
+
+@dataclass
+class PlotlyJSON(cl.Plotly):
+    """A plotly element from the JSON create_chart stored, sent as is.
+
+    cl.Plotly would rebuild and validate a go.Figure only to serialize it again.
+    """
+
+    def __post_init__(self) -> None:
+        self.mime = "application/json"
+        Element.__post_init__(self)
+
+
+# Shown when the figure behind a chart handle was evicted or lost on restart
+CHART_UNAVAILABLE = "This chart is no longer available, ask for it again."
+
+
+def plotly_element(chart) -> cl.Plotly | None:
+    # The state only holds a handle, the figure is fetched here
+    content = resolve_json(chart)
+    if content is None:
+        return None
+    return PlotlyJSON(name="chart", content=content, display="inline")
+
+
+class TurnRenderer:
+    """Shows what the agent does during one turn.
+
+    Notes on the state updates are batched into one message until something
+    else is shown, each chart is sent once in a message of its own, a preview
+    being replaced in place, and the answer is streamed token by token.
+    """
+
+    def __init__(self):
+        self.answer = cl.Message(content="")
+        self.notes: list[str] = []
+        # Chart stages already shown as create_chart streamed them
+        self.streamed: set[str] = set()
+        self.charts: set[str] = set()
+        # The message of a preview chart, updated with the exact one
+        self.preview: cl.Message | None = None
+
+    async def flush(self) -> None:
+        """Send the pending notes, as one message."""
+        if self.notes:
+            notes, self.notes = self.notes, []
+            await cl.Message(content="\n\n".join(notes), author="System").send()
+
+    async def say(self, content: str, **kwargs: Any) -> cl.Message:
+        await self.flush()
+        return await cl.Message(content=content, author="System", **kwargs).send()
+
+    async def token(self, chunk: BaseMessage, metadata: dict) -> None:
+        """Stream the text the chat model writes."""
+        if metadata.get("langgraph_node") != "agent":
+            return
+        if isinstance(chunk, AIMessage) and isinstance(chunk.content, str):
+            if chunk.content and not self.answer.streaming:
+                await self.flush()
+            await self.answer.stream_token(chunk.content)
+
+    async def update(self, update: dict) -> None:
         for node, values in update.items():
-            # Show raw state updates for each tool
-            if values:  # Only show if there are actual updates
-                msg_content = "\n".join(
-                    [msg.content for msg in values["messages"] if msg.content]
-                )
-                values.pop("messages")
-                update_json = json.dumps(values, indent=2, default=str)
-
-                # Truncate for preview if too long
-                if len(update_json) > 500:
-                    msg_data = (
-                        update_json[:500]
-                        + "\n... (truncated, "
-                        + str(len(update_json))
-                        + " chars total)"
-                    )
-                else:
-                    msg_data = update_json
-
-                final = f"Update from **{node}**"
-                send = False
-                if msg_content:
-                    send = True
-                    final += f"\n**msg:** {msg_content}"
-                if msg_data != "{}":
-                    send = True
-                    final += f"\n```json\n{msg_data}\n```"
-
-                if send:
-                    await cl.Message(
-                        content=final,
-                        author="System",
-                    ).send()
-
-            # Handle SQL query
-            if "chart_query" in values and values["chart_query"]:
-                await cl.Message(
-                    content=f"**SQL Query:**\n```sql\n{values['chart_query']}\n```",
-                    author="System",
-                ).send()
+            if not values:
+                continue
+            values = dict(values)
+            messages = values.pop("messages", [])
+            # What the history hook sent the model, not worth showing
+            values.pop("llm_input_messages", None)
+            text = "\n".join(
+                message.content
+                for message in messages
+                if message.content and isinstance(message.content, str)
+            )
+            if text or values:
+                note = f"Update from **{node}**"
+                if text:
+                    note += f"\n**msg:** {text}"
+                if values:
+                    # Described from their sizes, charts can be megabytes
+                    note += f"\n```\n{describe_update(values)}\n```"
+                self.notes.append(note)
+
+            # Handle SQL query, unless it was streamed
+            if values.get("chart_query") and "sql" not in self.streamed:
+                await self.say(f"**SQL Query:**\n```sql\n{values['chart_query']}\n```")
 
             # Handle Python code
-            if "python_code" in values and values["python_code"]:
-                await cl.Message(
-                    content=f"**Python Code:**\n```python\n{values['python_code']}\n```",
-                    author="System",
-                ).send()
-
-            # Handle charts
-            if "chart" in values and values["chart"]:
-                chart_data = values["chart"]
-                fig = go.Figure(chart_data)
-
-                # Send chart as a separate element
-                elements = [cl.Plotly(name="chart", figure=fig, display="inline")]
-                msg.elements = elements
-                await msg.update()
-
-            # Handle text messages
-            if "messages" in values:
-                last_msg = values["messages"][-1]
-                if hasattr(last_msg, "content") and last_msg.content:
-                    msg.content = last_msg.content
-                    await msg.update()
-
-    # Final send
-    await msg.send()
+            if values.get("python_code") and "plot" not in self.streamed:
+                await self.say(
+                    f"**Python Code:**\n```python\n{values['python_code']}\n```"
+                )
+
+            # Handle charts, unless create_chart streamed them
+            if values.get("chart") and "figure" not in self.streamed:
+                await self.show_chart(values["chart"])
+
+            # The answer, unless its tokens were streamed
+            if node == "agent" and text and not self.answer.streaming:
+                self.answer.content = messages[-1].content
+
+    async def show_chart(self, chart) -> None:
+        key = chart_key(chart)
+        if key in self.charts:
+            return
+        self.charts.add(key)
+        element = plotly_element(chart)
+        if element is None:
+            await self.say(CHART_UNAVAILABLE)
+            return
+        if self.preview is not None:
+            await self.replace_preview(element)
+        else:
+            await self.say("", elements=[element])
+
+    async def show_preview(self, event: dict) -> None:
+        """Show the chart of a sample until the exact one replaces it."""
+        self.charts.add(chart_key(event["chart"]))
+        element = plotly_element(event["chart"])
+        if element is None:
+            return
+        if self.preview is not None:
+            await self.replace_preview(element)
+            return
+        self.preview = await self.say(
+            f"**Preview** from {event['fraction']:.1%} of the rows,"
+            " the exact chart follows",
+            elements=[element],
+        )
+
+    async def replace_preview(self, element: cl.Plotly) -> None:
+        """Replace the chart of the preview message in place."""
+        for old in self.preview.elements:
+            await old.remove()
+        await element.send(for_id=self.preview.id)
+        self.preview.elements = [element]
+        self.preview.content = "**Chart**"
+        await self.preview.update()
+
+    async def stage(self, event: dict) -> None:
+        """Show a stage of a chart as soon as create_chart streams it."""
+        stage = event.get("stage")
+        self.streamed.add(stage)
+        if stage == "sql":
+            cached = " (reused)" if event.get("cached") else ""
+            await self.say(f"**SQL Query{cached}:**\n```sql\n{event['sql']}\n```")
+        elif stage == "data":
+            columns = event["columns"]
+            rows = [
+                "| " + " | ".join(str(row.get(column)) for column in columns) + " |"
+                for row in event["preview"]
+            ]
+            await self.say(
+                "\n".join(
+                    [
+                        f"**Data:** {event['num_rows']} rows",
+                        "",
+                        "| " + " | ".join(columns) + " |",
+                        "|" + "---|" * len(columns),
+                        *rows,
+                    ]
+                )
+            )
+        elif stage == "plot":
+            await self.say(f"**Python Code:**\n```python\n{event['python_code']}\n```")
+        elif stage == "preview":
+            await self.show_preview(event)
+        elif stage == "figure":
+            await self.show_chart(event["chart"])
+            # The next chart of the turn gets a message of its own
+            self.preview = None
+
+    async def finish(self) -> None:
+        await self.flush()
+        # Ends the stream of the answer, or sends it whole
+        await self.answer.send()
@@ -0,0 +1,83 @@
+"""Memory and latency of turning a large query result into chart data.
+
+Compares the previous path (fetchall -> DataFrame -> dropna -> to_dict) with
+the Arrow path (fetch_arrow_table -> compact_table -> encode_columns). Each
+path runs in its own process so that peak RSS can be compared:
+
+    uv run python scripts/benchmark_arrow_results.py --rows 1000000
+"""
+
+import argparse
+import multiprocessing
+import resource
+import tempfile
+import time
+from pathlib import Path
+
+import duckdb
+
+
+def fetchall_path(sql: str) -> int:
+    import pandas as pd
+
+    conn = duckdb.connect()
+    result = conn.execute(sql)
+    column_names = [desc[0] for desc in result.description]
+    chart_data = pd.DataFrame(result.fetchall(), columns=column_names)
+    chart_data = chart_data.dropna()
+    return len(chart_data.to_dict()["value"])
+
+
+def arrow_path(sql: str) -> int:
+    from atlas_assistant.columnar import compact_table, encode_columns
+
+    conn = duckdb.connect()
+    chart_data = compact_table(conn.execute(sql).fetch_arrow_table())
+    return encode_columns(chart_data)["num_rows"]
+
+
+def run(name: str, sql: str, queue: multiprocessing.Queue) -> None:
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    rows = {"fetchall": fetchall_path, "arrow": arrow_path}[name](sql)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((rows, elapsed, (peak - baseline) / 1024))
+
+
+def main(rows: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "result.parquet"
+        duckdb.execute(
+            f"""
+            COPY (
+              SELECT
+                'country ' || (i % 50) AS admin0_name,
+                'region ' || (i % 900) AS admin1_name,
+                [126, 585][i % 2 + 1] AS scenario,
+                [2045, 2085][i // 2 % 2 + 1] AS timeframe,
+                CASE WHEN i % 1000 = 0 THEN NULL ELSE random() END AS value
+              FROM range({rows}) t(i)
+            ) TO '{path}' (FORMAT parquet)
+            """
+        )
+        sql = f"SELECT * FROM '{path}'"
+        context = multiprocessing.get_context("spawn")
+        print(f"{rows:,} rows")
+        for name in ("fetchall", "arrow"):
+            queue = context.Queue()
+            process = context.Process(target=run, args=(name, sql, queue))
+            process.start()
+            kept, elapsed, peak_mb = queue.get()
+            process.join()
+            print(
+                f"{name:<10} {elapsed * 1000:9.1f} ms   peak RSS +{peak_mb:8.1f} MB"
+                f"   {kept:,} rows kept"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+    main(args.rows)
@@ -0,0 +1,142 @@
+"""End-to-end create_chart latency: "code" (two LLM calls) vs. "fast" (one call).
+
+Codestral is replaced by a scripted model that takes `--ttft-ms` before the
+first token and `--token-ms` per output token (about 4 characters), on local
+synthetic parquet:
+
+    uv run python scripts/benchmark_chart_modes.py --ttft-ms 400 --token-ms 15
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import duckdb
+
+import atlas_assistant.tools.create_chart as create_chart_module
+from atlas_assistant import engine
+from atlas_assistant.settings import get_settings
+from atlas_assistant.state import AgentState
+
+EXPLANATION = "Bar chart of the mean heat stress per country for each scenario"
+
+
+class ScriptedCodestral:
+    """Answers like codestral would, taking as long as the answer is long."""
+
+    def __init__(self, sql: str, ttft: float, per_token: float):
+        self.chat = self
+        self.sql = sql
+        self.ttft = ttft
+        self.per_token = per_token
+        self.output_tokens = 0
+
+    def answer(self, response_format):
+        if response_format is create_chart_module.SQLQuery:
+            return create_chart_module.SQLQuery(
+                sql_query=self.sql,
+                explanation="Mean value per country and scenario",
+            )
+        if response_format is create_chart_module.PlotlyPlot:
+            return create_chart_module.PlotlyPlot(
+                python_code=(
+                    "import plotly.express as px\n"
+                    'fig = px.bar(chart_data, x="admin0_name", y="value", '
+                    'color="scenario", barmode="group", '
+                    'title="Mean heat stress per country")\n'
+                    "fig.show()"
+                ),
+                explanation=EXPLANATION,
+            )
+        return create_chart_module.ChartSpec(
+            sql_query=self.sql,
+            plot=create_chart_module.PlotlyPlotArgs(
+                plotly_express_args={
+                    "x": "admin0_name",
+                    "y": "value",
+                    "color": "scenario",
+                    "barmode": "group",
+                    "title": "Mean heat stress per country",
+                },
+                plot_type="bar",
+                explanation=EXPLANATION,
+            ),
+        )
+
+    async def parse_async(self, response_format, **kwargs):
+        parsed = self.answer(response_format)
+        tokens = len(parsed.model_dump_json()) / 4
+        self.output_tokens += tokens
+        await asyncio.sleep(self.ttft + tokens * self.per_token)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(parsed=parsed))]
+        )
+
+
+async def run(mode: str, dataset: dict, iterations: int, llm: ScriptedCodestral):
+    os.environ["CHART_MODE"] = mode
+    get_settings.cache_clear()
+    llm.output_tokens = 0
+    timings = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        await create_chart_module.create_chart.coroutine(
+            plot_query="mean heat stress per country and scenario",
+            tool_call_id=f"call-{i}",
+            state=AgentState(messages=[], dataset=dataset),
+        )
+        timings.append(time.perf_counter() - start)
+    mean = sum(timings) / len(timings)
+    print(
+        f"{mode:<5} first {timings[0] * 1000:8.1f} ms   mean {mean * 1000:8.1f} ms"
+        f"   output tokens/chart {llm.output_tokens / iterations:6.0f}"
+    )
+
+
+async def main(rows: int, iterations: int, ttft: float, per_token: float) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "heat_stress.parquet"
+        duckdb.execute(
+            f"""
+            COPY (
+              SELECT
+                'country ' || (i % 50) AS admin0_name,
+                'region ' || (i % 900) AS admin1_name,
+                [126, 585][i % 2 + 1] AS scenario,
+                random() AS value
+              FROM range({rows}) t(i)
+            ) TO '{path}' (FORMAT parquet)
+            """
+        )
+        os.environ["RESULT_CACHE_DIR"] = str(Path(tmp) / "result-cache")
+        dataset = {"key": "heat_stress", "info": "Cattle heat stress", "s3": str(path)}
+        llm = ScriptedCodestral(
+            sql=(
+                "SELECT admin0_name, scenario, avg(value) AS value "
+                f"FROM '{path}' GROUP BY ALL"
+            ),
+            ttft=ttft,
+            per_token=per_token,
+        )
+        create_chart_module.get_codestral_client = lambda: llm
+
+        print(f"{rows:,} rows, {iterations} charts per mode")
+        for mode in ["code", "fast"]:
+            engine.close_database()
+            await run(mode, dataset, iterations, llm)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--ttft-ms", type=float, default=400)
+    parser.add_argument("--token-ms", type=float, default=15)
+    args = parser.parse_args()
+    asyncio.run(
+        main(args.rows, args.iterations, args.ttft_ms / 1000, args.token_ms / 1000)
+    )
@@ -0,0 +1,114 @@
+"""Bytes read and latency of country-filtered queries per parquet layout.
+
+Compares a file in its original, unsorted, order with the layouts the dataset
+mirror writes, see `atlas_assistant.layout`, on local synthetic parquet. Bytes
+are counted by the filesystem DuckDB reads through:
+
+    uv run python scripts/benchmark_layout.py --rows 5000000
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import duckdb
+from fsspec.implementations.local import LocalFileSystem
+
+from atlas_assistant.layout import Layout, query_path, relayout
+
+PROTOCOL = "counting"
+SORT_BY = ["admin0_name", "admin1_name", "scenario", "timeframe"]
+
+
+class CountingFileSystem(LocalFileSystem):
+    """The local filesystem, counting the bytes read through it."""
+
+    protocol = PROTOCOL
+    cachable = False
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.bytes_read = 0
+
+    @classmethod
+    def _strip_protocol(cls, path):
+        return super()._strip_protocol(path.removeprefix(f"{PROTOCOL}://"))
+
+    def _open(self, path, mode="rb", **kwargs):
+        file = super()._open(path, mode, **kwargs)
+        read = file.read
+
+        def counting_read(*args):
+            data = read(*args)
+            self.bytes_read += len(data)
+            return data
+
+        file.read = counting_read
+        return file
+
+
+def run(name: str, path: str, iterations: int) -> None:
+    conn = duckdb.connect()
+    filesystem = CountingFileSystem()
+    conn.register_filesystem(filesystem)
+    timings = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        conn.execute(
+            f"""
+            SELECT admin1_name, scenario, avg(value) AS value
+            FROM '{PROTOCOL}://{path}'
+            WHERE admin0_name = 'country {i % 50}' AND timeframe = 2045
+            GROUP BY ALL
+            """
+        ).fetch_arrow_table()
+        timings.append(time.perf_counter() - start)
+    conn.close()
+    print(
+        f"{name:<12} {filesystem.bytes_read / iterations / 1024**2:10.2f} MiB"
+        f" {sum(timings) / iterations * 1000:10.1f} ms"
+    )
+
+
+def main(rows: int, iterations: int, row_group_size: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp) / "hazard.parquet"
+        duckdb.execute(
+            f"""
+            COPY (
+              SELECT
+                'country ' || (hash(i) % 50) AS admin0_name,
+                'region ' || (hash(i + 1) % 900) AS admin1_name,
+                [126, 585][i % 2 + 1] AS scenario,
+                [2045, 2085][i // 2 % 2 + 1] AS timeframe,
+                random() AS value
+              FROM range({rows}) t(i)
+            ) TO '{source}' (FORMAT parquet)
+            """
+        )
+        layouts = {
+            "sorted": Layout(sort_by=SORT_BY, row_group_size=row_group_size),
+            "partitioned": Layout(
+                sort_by=SORT_BY,
+                partition_by=["admin0_name"],
+                row_group_size=row_group_size,
+            ),
+        }
+
+        print(f"{rows:,} rows, {iterations} country-filtered queries per layout")
+        print(f"{'layout':<12} {'read/query':>14} {'latency':>13}")
+        run("original", str(source), iterations)
+        for name, layout in layouts.items():
+            target = Path(tmp) / f"{name}.parquet"
+            layout = relayout(source, target, layout)
+            run(name, query_path(target, layout), iterations)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=5_000_000)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--row-group-size", type=int, default=65_536)
+    args = parser.parse_args()
+    main(args.rows, args.iterations, args.row_group_size)
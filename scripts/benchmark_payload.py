@@ -0,0 +1,99 @@
+"""Chart payload bytes and render latency, as plotly serialized them vs. payload.py.
+
+For query results of increasing size, builds a line, scatter, histogram and
+box chart with plotly express, then times getting the JSON the browser is sent:
+
+- before: `fig.write_json`, parsed back for the state, serialized again into
+  the blob store, parsed back by the UI to a `go.Figure` that cl.Plotly
+  validates and serializes once more,
+- after: `figure_to_json`, downsampled and aggregated, serialized once into
+  the blob store and sent as is by the UI.
+
+Reports the bytes sent and the seconds from the figure to them
+
+    uv run python scripts/benchmark_payload.py --points 10000 100000 1000000 5000000
+"""
+
+import argparse
+import io
+import json
+import time
+
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+import plotly.io as pio
+import pyarrow as pa
+
+from atlas_assistant.blobs import resolve_json, store_json
+from atlas_assistant.settings import Settings
+from atlas_assistant.tools.create_chart import figure_to_json
+
+CHARTS = {
+    "line": lambda table: px.line(table, x="day", y="value", color="scenario"),
+    "scatter": lambda table: px.scatter(table, x="rainfall", y="value"),
+    "histogram": lambda table: px.histogram(table, x="value", color="scenario"),
+    "box": lambda table: px.box(table, x="country", y="value"),
+}
+
+
+def result_table(points: int) -> pa.Table:
+    rng = np.random.default_rng(0)
+    return pa.table(
+        {
+            "day": np.arange(points) // 2,
+            "rainfall": rng.gamma(2, 30, points).astype(np.float32),
+            "value": rng.normal(size=points).cumsum().astype(np.float32),
+            "scenario": np.array(["ssp126", "ssp585"])[np.arange(points) % 2],
+            "country": np.array(["Kenya", "Ghana", "Mali", "Chad"])[
+                np.arange(points) % 4
+            ],
+        }
+    )
+
+
+def before(fig: go.Figure, settings: Settings) -> str:
+    with io.StringIO() as buffer:
+        fig.write_json(buffer)
+        chart = json.loads(buffer.getvalue())
+    ref = store_json(chart, settings)
+    figure = go.Figure(json.loads(resolve_json(ref, settings)))
+    return pio.to_json(figure, validate=True)
+
+
+def after(fig: go.Figure, settings: Settings) -> str:
+    return resolve_json(store_json(figure_to_json(fig), settings), settings)
+
+
+def main(points: list[int]) -> None:
+    settings = Settings()
+    print(
+        f"{'points':>10} {'chart':<10} {'bytes before':>13} {'after':>10}"
+        f" {'s before':>9} {'after':>7}"
+    )
+    for count in points:
+        table = result_table(count)
+        for name, chart in CHARTS.items():
+            fig = chart(table)
+            results = []
+            for render in (before, after):
+                start = time.perf_counter()
+                content = render(fig, settings)
+                results.append((len(content), time.perf_counter() - start))
+            (bytes_before, s_before), (bytes_after, s_after) = results
+            print(
+                f"{count:>10,} {name:<10} {bytes_before:>13,} {bytes_after:>10,}"
+                f" {s_before:>9.3f} {s_after:>7.3f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--points",
+        type=int,
+        nargs="+",
+        default=[10_000, 100_000, 1_000_000, 5_000_000],
+    )
+    args = parser.parse_args()
+    main(args.points)
@@ -0,0 +1,123 @@
+"""Time to the first chart with and without previews from a sample.
+
+Runs a chart query per country and scenario on local synthetic parquet files
+of increasing size, as create_chart does: through `ProgressiveQuery`, then
+compacting the result and building the figure. The first chart is the preview
+when the sample is done before the exact query, see `atlas_assistant.preview`.
+The result cache, the mirror and the rollups are off
+
+    uv run python scripts/benchmark_preview.py --rows 1000000 5000000 20000000
+"""
+
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import duckdb
+
+from atlas_assistant import engine
+from atlas_assistant.catalog import get_dataset_profile, reset_catalog
+from atlas_assistant.columnar import compact_table
+from atlas_assistant.preview import ProgressiveQuery
+from atlas_assistant.settings import Settings
+from atlas_assistant.tools.create_chart import PlotlyPlotArgs, build_figure_from_args
+
+PLOT = PlotlyPlotArgs(
+    plotly_express_args={"x": "admin0_name", "y": "value", "color": "scenario"},
+    plot_type="bar",
+    explanation="",
+)
+
+
+def write_dataset(path: Path, rows: int, row_group_size: int) -> None:
+    duckdb.execute(
+        f"""
+        COPY (
+          SELECT
+            'country ' || (hash(i) % 50) AS admin0_name,
+            'region ' || (hash(i + 1) % 900) AS admin1_name,
+            [126, 585][i % 2 + 1] AS scenario,
+            [2045, 2085][i // 2 % 2 + 1] AS timeframe,
+            random() AS value,
+            md5(i::VARCHAR) AS pixel_id
+          FROM range({rows}) t(i)
+        ) TO '{path}' (FORMAT parquet, ROW_GROUP_SIZE {row_group_size})
+        """
+    )
+
+
+def figure(table) -> dict:
+    return build_figure_from_args(compact_table(table), PLOT)
+
+
+async def first_chart(dataset: dict, settings: Settings) -> tuple[float, float, bool]:
+    """Seconds to the first chart and to the exact one, and if there was a preview."""
+    profile = await get_dataset_profile(dataset, settings)
+    sql = f"""
+        SELECT admin0_name, scenario, avg(value) AS value, count(DISTINCT pixel_id)
+        FROM '{dataset["s3"]}'
+        GROUP BY ALL
+    """
+    start = time.perf_counter()
+    first = None
+    async with ProgressiveQuery(sql, dataset, profile, settings) as query:
+        sample = await query.preview()
+        if sample is not None:
+            await asyncio.to_thread(figure, sample)
+            first = time.perf_counter() - start
+        result = await query.result()
+    await asyncio.to_thread(figure, result)
+    exact = time.perf_counter() - start
+    return first or exact, exact, first is not None
+
+
+async def main(
+    rows: list[int], row_group_size: int, sample_rows: int, iterations: int
+) -> None:
+    print(f"{'rows':>12} {'first chart':>12} {'exact chart':>12} {'no preview':>11}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in rows:
+            path = Path(tmp) / f"hazard-{count}.parquet"
+            write_dataset(path, count, row_group_size)
+            dataset = {"key": path.stem, "s3": str(path)}
+            results = {}
+            for enabled in (True, False):
+                settings = Settings(
+                    preview_enabled=enabled,
+                    preview_min_rows=0,
+                    preview_sample_rows=sample_rows,
+                    result_cache_enabled=False,
+                    rollups_enabled=False,
+                    dataset_mirror_dir=None,
+                    duckdb_cache_dir=None,
+                    dataset_catalog_path=Path(tmp) / "catalog.json",
+                )
+                engine.close_database()
+                reset_catalog()
+                results[enabled] = [
+                    await first_chart(dataset, settings) for _ in range(iterations)
+                ]
+            first = statistics.median(first for first, _, _ in results[True])
+            exact = statistics.median(exact for _, exact, _ in results[True])
+            without = statistics.median(exact for _, exact, _ in results[False])
+            previews = sum(preview for _, _, preview in results[True])
+            print(
+                f"{count:>12,} {first:>11.3f}s {exact:>11.3f}s {without:>10.3f}s"
+                f"  ({previews}/{iterations} previews)"
+            )
+    engine.close_database()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[1_000_000, 5_000_000, 20_000_000]
+    )
+    parser.add_argument("--row-group-size", type=int, default=122_880)
+    parser.add_argument("--sample-rows", type=int, default=500_000)
+    parser.add_argument("--iterations", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.row_group_size, args.sample_rows, args.iterations))
@@ -0,0 +1,123 @@
+"""Chart prompt sizes within the token budgets vs. the whole dataset description.
+
+For every active dataset of data/datasets.json in the catalog, and a few
+requests, compares the prompt of the SQL (or fast chart) call as it was, with
+the dataset as JSON and every column, to the one of prompts.py. Datasets missing
+from the catalog are profiled from S3 with `--profile`, else skipped
+
+With `--llm`, also times codestral on both prompts, which needs MISTRAL_API_KEY:
+
+    uv run python scripts/benchmark_prompts.py --llm --iterations 3
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from atlas_assistant.catalog import (
+    active_datasets,
+    describe_dataset,
+    get_catalog,
+    get_dataset_profile,
+)
+from atlas_assistant.prompts import count_tokens, dataset_context
+from atlas_assistant.settings import get_settings
+from atlas_assistant.tools.create_chart import (
+    FAST_CHART_PROMPT,
+    GET_DATA_PROMPT,
+    ChartSpec,
+    SQLQuery,
+    get_codestral_client,
+)
+from atlas_assistant.vectorstore import load_datasets
+
+REQUESTS = [
+    "{info} per country",
+    "{info} in Kenya by scenario and time period",
+    "compare the regions of Mozambique",
+]
+
+
+async def latency(prompt: str, request: str, response_format, iterations: int):
+    client = get_codestral_client()
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await client.chat.parse_async(
+            model="codestral-latest",
+            messages=[
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": request},
+            ],
+            response_format=response_format,
+        )
+        timings.append(time.perf_counter() - start)
+    return statistics.mean(timings)
+
+
+async def main(mode: str, profile: bool, llm: bool, iterations: int) -> None:
+    settings = get_settings()
+    catalog = get_catalog(settings)
+    template, response_format = (
+        (FAST_CHART_PROMPT, ChartSpec)
+        if mode == "fast"
+        else (GET_DATA_PROMPT, SQLQuery)
+    )
+    totals = {"before": [], "after": [], "before_s": [], "after_s": []}
+    print(f"{'dataset':<28} {'columns':>7} {'tokens before':>13} {'after':>6}", end="")
+    print(f" {'s before':>9} {'after':>6}" if llm else "")
+    for dataset in active_datasets(load_datasets()):
+        key = dataset.get("key", dataset["s3"])
+        if key not in catalog.datasets and not profile:
+            print(f"{key:<28} not in the catalog, skipped")
+            continue
+        dataset_profile = await get_dataset_profile(dataset, settings)
+        for request in REQUESTS:
+            request = request.format(info=dataset["info"])
+            before = template.format(
+                dataset_info=json.dumps(dataset),
+                num_rows=dataset_profile.num_rows,
+                dataset_profile=describe_dataset(dataset_profile),
+            )
+            after = template.format(
+                **dataset_context(dataset, dataset_profile, request, settings)
+            )
+            totals["before"].append(count_tokens(before))
+            totals["after"].append(count_tokens(after))
+            print(
+                f"{key[:28]:<28} {len(dataset_profile.columns):>7}"
+                f" {totals['before'][-1]:>13} {totals['after'][-1]:>6}",
+                end="",
+            )
+            if llm:
+                for name, prompt in [("before_s", before), ("after_s", after)]:
+                    totals[name].append(
+                        await latency(prompt, request, response_format, iterations)
+                    )
+                print(f" {totals['before_s'][-1]:>9.2f} {totals['after_s'][-1]:>6.2f}")
+            else:
+                print()
+    if not totals["before"]:
+        return
+    print(
+        f"mean prompt tokens {statistics.mean(totals['before']):.0f} ->"
+        f" {statistics.mean(totals['after']):.0f},"
+        f" max {max(totals['before'])} -> {max(totals['after'])}"
+    )
+    if llm:
+        print(
+            f"mean codestral latency {statistics.mean(totals['before_s']):.2f}s ->"
+            f" {statistics.mean(totals['after_s']):.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mode", choices=["fast", "code"], default="fast")
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--llm", action="store_true")
+    parser.add_argument("--iterations", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(main(args.mode, args.profile, args.llm, args.iterations))
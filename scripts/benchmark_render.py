@@ -0,0 +1,83 @@
+"""Time it takes the UI to preview a state update, as it was vs. render.py.
+
+Builds the update create_chart returns for charts of increasing size, with the
+figure and chart data kept in the state or in the blob store, then times:
+
+- before: the update serialized with `json.dumps(indent=2, default=str)`, then
+  cut to its first 500 characters,
+- after: `describe_update`, from the type and size of the fields.
+
+Reports the milliseconds per update and the characters shown
+
+    uv run python scripts/benchmark_render.py --points 10000 100000 1000000
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import pyarrow as pa
+
+from atlas_assistant.blobs import store_json
+from atlas_assistant.columnar import encode_columns
+from atlas_assistant.render import describe_update
+from atlas_assistant.settings import Settings
+
+
+def chart_update(points: int, settings: Settings) -> dict:
+    rng = np.random.default_rng(0)
+    x = np.arange(points)
+    y = rng.normal(size=points).cumsum()
+    table = pa.table({"day": x, "value": y})
+    # An uncompacted figure, as a chart of chart_max_points or more would be
+    figure = {
+        "data": [{"type": "scattergl", "mode": "lines", "x": x, "y": y}],
+        "layout": {"title": {"text": "Value per day"}},
+    }
+    return {
+        "chart_query": "SELECT day, avg(value) AS value FROM t GROUP BY day",
+        "chart_data": store_json(encode_columns(table), settings),
+        "chart": store_json(figure, settings),
+    }
+
+
+def before(values: dict) -> str:
+    update_json = json.dumps(values, indent=2, default=str)
+    if len(update_json) > 500:
+        return update_json[:500] + f"\n... (truncated, {len(update_json)} chars total)"
+    return update_json
+
+
+def timed(render, values: dict, repeat: int) -> tuple[float, str]:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        content = render(values)
+    return (time.perf_counter() - start) / repeat, content
+
+
+def main(points: list[int], repeat: int) -> None:
+    print(f"{'points':>10} {'store':<7} {'ms before':>10} {'after':>8} {'speedup':>8}")
+    for count in points:
+        for store in ("none", "memory"):
+            settings = Settings(blob_store=store)
+            values = chart_update(count, settings)
+            s_before, _ = timed(before, values, repeat)
+            s_after, _ = timed(describe_update, values, repeat)
+            print(
+                f"{count:>10,} {store:<7} {s_before * 1000:>10.3f}"
+                f" {s_after * 1000:>8.3f} {s_before / s_after:>7.0f}x"
+            )
+    print()
+    print("Shown after:")
+    print(describe_update(chart_update(points[-1], Settings(blob_store="none"))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--points", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    main(args.points, args.repeat)
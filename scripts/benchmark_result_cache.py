@@ -0,0 +1,67 @@
+"""Query latency with a cold and a warm result cache, on local synthetic parquet.
+
+uv run python scripts/benchmark_result_cache.py --rows 5000000
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import duckdb
+
+from atlas_assistant import engine
+from atlas_assistant.settings import Settings
+
+
+def main(rows: int, iterations: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "hazard.parquet"
+        duckdb.execute(
+            f"""
+            COPY (
+              SELECT
+                'country ' || (i % 50) AS admin0_name,
+                'region ' || (i % 900) AS admin1_name,
+                [126, 585][i % 2 + 1] AS scenario,
+                random() AS value
+              FROM range({rows}) t(i)
+            ) TO '{path}' (FORMAT parquet)
+            """
+        )
+        settings = Settings(result_cache_dir=Path(tmp) / "result-cache")
+        sql = f"""
+          SELECT admin0_name, scenario, avg(value) AS value
+          FROM '{path}'
+          WHERE admin1_name <> 'region 3'
+          GROUP BY ALL
+        """
+
+        start = time.perf_counter()
+        engine.fetch_table(sql, settings)
+        miss = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            engine.fetch_table(sql, settings)
+        hit = (time.perf_counter() - start) / iterations
+
+        # A fresh process only has the disk tier
+        engine.close_database()
+        start = time.perf_counter()
+        engine.fetch_table(sql, settings)
+        disk_hit = time.perf_counter() - start
+
+    print(f"{rows:,} rows")
+    print(f"miss (full scan)   {miss * 1000:9.2f} ms")
+    print(f"memory hit         {hit * 1000:9.2f} ms")
+    print(f"disk hit           {disk_hit * 1000:9.2f} ms")
+    print(engine.get_result_cache().stats())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=5_000_000)
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+    main(args.rows, args.iterations)
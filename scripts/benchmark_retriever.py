@@ -0,0 +1,97 @@
+"""Dataset lookup latency: Chroma vs. the in-process retriever modes.
+
+The stand-in embedder sleeps for `--embed-latency-ms` to mimic the round-trip
+to mistral-embed:
+
+    uv run python scripts/benchmark_retriever.py --embed-latency-ms 150
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from langchain_chroma import Chroma
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from atlas_assistant import vectorstore
+from atlas_assistant.retriever import DatasetRetriever
+
+QUERIES = [
+    "cattle heat stress",
+    "crop suitability in Kenya",
+    "deforestation",
+    "drought hazard exposure for maize",
+    "livestock vulnerability",
+    "precipitation trends",
+]
+
+
+class SlowEmbedding(DeterministicFakeEmbedding):
+    latency: float = 0.0
+
+    def embed_query(self, text: str) -> list[float]:
+        time.sleep(self.latency)
+        return super().embed_query(text)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        await asyncio.sleep(self.latency)
+        return super().embed_query(text)
+
+
+def report(label: str, timings: list[float]) -> None:
+    mean = sum(timings) / len(timings)
+    print(f"{label:<34} mean {mean * 1e6:10.1f} µs")
+
+
+async def main(embed_latency: float, iterations: int) -> None:
+    embedder = SlowEmbedding(size=1024, latency=0.0)
+    with tempfile.TemporaryDirectory() as tmp:
+        datasets = vectorstore.load_datasets()
+        store = Chroma.from_texts(
+            texts=[vectorstore.dataset_document(ds) for ds in datasets],
+            embedding=embedder,
+            metadatas=datasets,
+            persist_directory=str(Path(tmp) / "index"),
+        )
+        embedder.latency = embed_latency
+
+        timings = []
+        for query in QUERIES * iterations:
+            start = time.perf_counter()
+            store.similarity_search_with_score(query, k=3)
+            timings.append(time.perf_counter() - start)
+        report("chroma similarity_search_with_score", timings)
+
+        for mode in ("vector", "lexical", "hybrid"):
+            retriever = DatasetRetriever.from_vectorstore(store, mode, 0.3)
+            timings = []
+            for query in QUERIES * iterations:
+                start = time.perf_counter()
+                await retriever.asearch(query, k=3)
+                timings.append(time.perf_counter() - start)
+            report(f"retriever {mode}", timings)
+            if mode == "hybrid":
+                print(
+                    f"{'':<34} embedded {retriever.embedding_calls}"
+                    f" of {len(timings)} queries"
+                )
+
+        vectors = np.array([embedder.embed_documents(QUERIES)] * 16).reshape(
+            -1, embedder.size
+        )
+        start = time.perf_counter()
+        for _ in range(iterations):
+            retriever.search_by_vectors(vectors, k=3)
+        elapsed = (time.perf_counter() - start) / iterations / len(vectors)
+        report(f"batched top-k (per query, n={len(vectors)})", [elapsed])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--embed-latency-ms", type=float, default=0.0)
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.embed_latency_ms / 1000, args.iterations))
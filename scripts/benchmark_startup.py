@@ -0,0 +1,158 @@
+"""Import time and cold start of the agent, offline.
+
+Each run starts a fresh interpreter:
+
+- import: `python -X importtime -c "import atlas_assistant.agent"`, the time
+  to import the agent and its slowest dependencies,
+- cold start: importing the agent then `warm_up`, on a local datasets index
+  built with a stand-in embedder so that nothing calls the Mistral API,
+- sessions: the time a new session waits for its graph, compiled for every
+  session as `on_chat_start` used to, vs. the shared graph.
+
+Exits with an error when the import takes longer than `--max-import-seconds`,
+so that CI catches a heavy module imported up front again
+
+    uv run python scripts/benchmark_startup.py --runs 5 --max-import-seconds 1.5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+MODULE = "atlas_assistant.agent"
+EMBEDDING_SIZE = 64
+SESSIONS = 20
+
+
+def import_times() -> dict[str, float]:
+    """Seconds to import each module, children included, in a fresh interpreter."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {MODULE}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def build_index(path: Path) -> None:
+    from langchain_chroma import Chroma
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    from atlas_assistant import vectorstore
+
+    datasets = vectorstore.load_datasets()
+    Chroma.from_texts(
+        texts=[vectorstore.dataset_document(ds) for ds in datasets],
+        embedding=DeterministicFakeEmbedding(size=EMBEDDING_SIZE),
+        metadatas=datasets,
+        persist_directory=str(path),
+    )
+
+
+def cold_start() -> None:
+    """Run in the child interpreter, prints its timings as JSON."""
+    start = time.perf_counter()
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    from atlas_assistant import agent
+    from atlas_assistant.settings import Settings
+
+    imported = time.perf_counter()
+    embedder = DeterministicFakeEmbedding(size=EMBEDDING_SIZE)
+    Settings.get_embeddings = lambda self: embedder  # type: ignore
+    settings = Settings()
+
+    async def run() -> dict[str, float]:
+        await agent.warm_up(settings)
+        warm = time.perf_counter()
+        per_session = time.perf_counter()
+        for _ in range(SESSIONS):
+            await agent.create_graph(settings)
+        compiled = time.perf_counter()
+        for _ in range(SESSIONS):
+            await agent.get_graph(settings)
+        shared = time.perf_counter()
+        return {
+            "import": imported - start,
+            "warm_up": warm - imported,
+            "per_session": (compiled - per_session) / SESSIONS,
+            "shared": (shared - compiled) / SESSIONS,
+        }
+
+    print(json.dumps(asyncio.run(run())))
+
+
+def main(runs: int, max_import_seconds: float | None) -> None:
+    imports = [import_times() for _ in range(runs)]
+    total = statistics.median(times[MODULE] for times in imports)
+    packages = {
+        name: statistics.median(times.get(name, 0.0) for times in imports)
+        for name in imports[0]
+        if "." not in name and name != MODULE.split(".")[0]
+    }
+    print(f"import {MODULE}: {total:.3f}s, median of {runs} runs")
+    for name, seconds in sorted(packages.items(), key=lambda item: -item[1])[:8]:
+        print(f"  {name:<24} {seconds:.3f}s")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        build_index(Path(tmp) / "index")
+        env = {
+            **os.environ,
+            "DATASETS_INDEX_PATH": str(Path(tmp) / "index"),
+            "EMBEDDING_CACHE_PATH": str(Path(tmp) / "embeddings.sqlite3"),
+            "DUCKDB_CACHE_DIR": str(Path(tmp) / "s3-cache"),
+            "RESULT_CACHE_DIR": str(Path(tmp) / "result-cache"),
+            "DATASET_MIRROR_DIR": str(Path(tmp) / "mirror"),
+            "BLOB_STORE_PATH": str(Path(tmp) / "blobs"),
+            "CHECKPOINTER": "memory",
+            "CHART_CACHE_PATH": str(Path(tmp) / "chart-cache.sqlite3"),
+        }
+        starts = []
+        for _ in range(runs):
+            result = subprocess.run(
+                [sys.executable, __file__, "--cold-start"],
+                capture_output=True,
+                text=True,
+                check=True,
+                env=env,
+            )
+            starts.append(json.loads(result.stdout.splitlines()[-1]))
+
+    def median(key: str) -> float:
+        return statistics.median(start[key] for start in starts)
+
+    print(
+        f"cold start: import {median('import'):.3f}s + warm-up {median('warm_up'):.3f}s"
+    )
+    print(
+        f"graph of a new session: compiled {median('per_session') * 1000:.1f} ms,"
+        f" shared {median('shared') * 1000:.3f} ms"
+    )
+    if max_import_seconds is not None and total > max_import_seconds:
+        sys.exit(f"Importing {MODULE} took {total:.3f}s > {max_import_seconds}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-seconds", type=float, default=None)
+    parser.add_argument("--cold-start", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.cold_start:
+        cold_start()
+    else:
+        main(args.runs, args.max_import_seconds)
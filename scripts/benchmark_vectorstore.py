@@ -0,0 +1,65 @@
+"""Per-call latency of a dataset lookup with and without the shared vector store.
+
+Uses a local stand-in embedder so it runs without an API key:
+
+    uv run python scripts/benchmark_vectorstore.py
+"""
+
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from langchain_chroma import Chroma
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from atlas_assistant import vectorstore
+from atlas_assistant.settings import Settings
+
+ITERATIONS = 50
+QUERY = "cattle heat stress"
+
+
+def report(label: str, timings: list[float]) -> None:
+    timings = sorted(timings)
+    mean = sum(timings) / len(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{label:<12} mean {mean * 1000:8.2f} ms   p95 {p95 * 1000:8.2f} ms")
+
+
+async def main() -> None:
+    embedder = DeterministicFakeEmbedding(size=1024)
+    with tempfile.TemporaryDirectory() as tmp:
+        index = Path(tmp) / "index"
+        datasets = vectorstore.load_datasets()
+        Chroma.from_texts(
+            texts=[vectorstore.dataset_document(ds) for ds in datasets],
+            embedding=embedder,
+            metadatas=datasets,
+            persist_directory=str(index),
+        )
+        settings = Settings(datasets_index_path=index, embedding_cache_path=None)
+        Settings.get_embeddings = lambda self: embedder  # type: ignore
+
+        before = []
+        for _ in range(ITERATIONS):
+            start = time.perf_counter()
+            store = vectorstore.load_datasets_vector_embeddings(settings)
+            store.similarity_search_with_score(QUERY, k=3)
+            before.append(time.perf_counter() - start)
+
+        vectorstore.reload_datasets_vectorstore()
+        after = []
+        for _ in range(ITERATIONS):
+            start = time.perf_counter()
+            store = await vectorstore.get_datasets_vectorstore(settings)
+            store.similarity_search_with_score(QUERY, k=3)
+            after.append(time.perf_counter() - start)
+
+    print(f"{ITERATIONS} lookups over {len(datasets)} datasets")
+    report("per-call", before)
+    report("shared", after)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
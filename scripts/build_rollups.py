@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Script to build the rollups chart queries are routed to
+Aggregates every active dataset of datasets.json per admin level, scenario and
+time period; only the datasets whose file changed since the last run are
+aggregated again
+"""
+
+import argparse
+import asyncio
+import time
+
+from atlas_assistant.catalog import active_datasets
+from atlas_assistant.rollups import load_manifest, refresh_rollups, save_manifest
+from atlas_assistant.settings import Settings
+from atlas_assistant.vectorstore import load_datasets
+
+
+async def main(rebuild: bool) -> None:
+    settings = Settings()
+    manifest_path = settings.rollup_dir / "manifest.json"
+    datasets = active_datasets(load_datasets())
+    print(f"Found {len(datasets)} active parquet files to aggregate")
+
+    previous = None if rebuild else load_manifest(manifest_path)
+    start = time.perf_counter()
+    manifest = await refresh_rollups(datasets, settings, manifest=previous)
+    elapsed = time.perf_counter() - start
+    save_manifest(manifest, manifest_path)
+
+    for key, dataset_rollups in manifest.datasets.items():
+        for rollup in dataset_rollups.rollups:
+            print(
+                f"{key:<30} {rollup.num_rows:>10,} rows  {', '.join(rollup.dimensions)}"
+            )
+    reused = sum(
+        previous is not None and previous.datasets.get(key) == rollups
+        for key, rollups in manifest.datasets.items()
+    )
+    print(
+        f"Rollups of {len(manifest.datasets)}/{len(datasets)} datasets "
+        f"({reused} unchanged) in {elapsed:.1f}s, written to {settings.rollup_dir}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="aggregate every dataset again, even if its file didn't change",
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.rebuild))
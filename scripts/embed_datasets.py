@@ -2,34 +2,20 @@
 https://onewri.sharepoint.com/:x:/s/LandandCarbonWatch/ESllWse7dmFAnobmcA4IMXABbyDYhta0p81qnPH3-XUsBw
 """
 
-import json
-from pathlib import Path
-
 import dotenv
 from langchain_chroma import Chroma
-from langchain_mistralai import MistralAIEmbeddings
-
-root = Path(__file__).parents[1]
 
-with open(root / "data" / "datasets.json") as f:
-    datasets = json.load(f)
+from atlas_assistant.settings import Settings
+from atlas_assistant.vectorstore import dataset_document, load_datasets
 
 dotenv.load_dotenv()
 
-embedder = MistralAIEmbeddings(model="mistral-embed")
-
-data_dir = Path(root / "data").absolute()
-
-docs = []
-metadatas = []
-for ds in datasets:
-    docs.append(f"Name: {ds['name']}, Info: {ds['info']}, Note: {ds['note']}")
-    metadatas.append(ds)
-
+settings = Settings()
+datasets = load_datasets()
 
 Chroma.from_texts(
-    texts=docs,
-    embedding=embedder,
-    metadatas=metadatas,
-    persist_directory=str(data_dir / "atlas-assistant-docs-mistral-index"),
+    texts=[dataset_document(ds) for ds in datasets],
+    embedding=settings.get_embeddings(),
+    metadatas=datasets,
+    persist_directory=str(settings.datasets_index_path),
 )
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Script to mirror the active parquet files of datasets.json to local disk
+Only files whose ETag or size changed since the last sync are downloaded, and
+rewritten in the layout of the DATASET_LAYOUT_* settings
+"""
+
+import argparse
+import asyncio
+import time
+
+from atlas_assistant import engine
+from atlas_assistant.catalog import active_datasets
+from atlas_assistant.settings import Settings
+from atlas_assistant.vectorstore import load_datasets
+
+
+async def main(prune: bool) -> None:
+    settings = Settings()
+    engine.get_database(settings)
+    mirror = engine.get_dataset_mirror()
+    if mirror is None:
+        print("DATASET_MIRROR_DIR is not set, nothing to sync")
+        return
+    s3_paths = [dataset["s3"] for dataset in active_datasets(load_datasets())]
+    print(f"Syncing {len(s3_paths)} datasets to {mirror.path}")
+
+    start = time.perf_counter()
+    stats = await mirror.sync(s3_paths)
+    if prune:
+        mirror.prune(s3_paths)
+    elapsed = time.perf_counter() - start
+    size = sum(entry.size for entry in mirror.manifest().files.values())
+    print(
+        f"{stats['downloaded']} downloaded, {stats['unchanged']} unchanged, "
+        f"{stats['failed']} failed in {elapsed:.1f}s, "
+        f"{size / 1024**2:.1f} MiB mirrored"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="delete the local copies of datasets that are no longer active",
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.prune))
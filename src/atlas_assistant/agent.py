@@ -1,13 +1,25 @@
+import asyncio
 import datetime
+import logging
+import time
 
-from langgraph.checkpoint.memory import InMemorySaver
+from langchain_core.messages import BaseMessage, SystemMessage
 from langgraph.graph.state import CompiledStateGraph
 from langgraph.prebuilt import create_react_agent
 
-from .settings import Settings
+from . import engine
+from .catalog import get_catalog
+from .checkpointer import get_checkpointer
+from .history import history_hook
+from .llm import get_llm_gateway
+from .retriever import get_dataset_retriever
+from .settings import Settings, get_settings
 from .state import AgentState
-from .tools.create_chart import create_chart
+from .tools.create_chart import create_chart, plotly_express
 from .tools.select_dataset import select_dataset
+from .vectorstore import get_datasets_vectorstore
+
+logger = logging.getLogger(__name__)
 
 SYSTEM_PROMPT = """
 You help users leverage the Adaptation Atlas data to answer their questions.
@@ -18,20 +30,69 @@ You have access to the following tools:
 """
 
 
+def system_prompt(state: AgentState) -> list[BaseMessage]:
+    # Dated on every call, the graph lives as long as the process
+    today = datetime.datetime.now(datetime.UTC)
+    prompt = SYSTEM_PROMPT + f"\nToday is {today:%Y-%m-%d}."
+    return [SystemMessage(content=prompt), *state.messages]
+
+
 async def create_graph(settings: Settings) -> CompiledStateGraph:
     tools = [
         select_dataset,
         create_chart,
     ]
 
-    checkpointer = InMemorySaver()
+    checkpointer = await get_checkpointer(settings)
     return create_react_agent(
         settings.get_chat_model(),
         tools,
-        prompt=(
-            SYSTEM_PROMPT
-            + f"\nToday is {datetime.datetime.now(datetime.UTC):%Y-%m-%d}."
-        ),
+        prompt=system_prompt,
         state_schema=AgentState,
+        # Bounds what the model is sent of long conversations
+        pre_model_hook=history_hook(settings),
         checkpointer=checkpointer,
     )
+
+
+_graph: CompiledStateGraph | None = None
+
+
+async def get_graph(settings: Settings | None = None) -> CompiledStateGraph:
+    """The graph shared by all sessions, compiled on first use.
+
+    Sessions only share the compiled graph: their conversations are kept apart
+    by the thread_id of their config.
+    """
+    global _graph
+    if _graph is None:
+        graph = await create_graph(settings or get_settings())
+        # Another session may have compiled one in the meantime
+        if _graph is None:
+            _graph = graph
+    return _graph
+
+
+def reset_graph() -> None:
+    global _graph
+    _graph = None
+
+
+async def warm_up(settings: Settings | None = None) -> None:
+    """Load what the first session would otherwise wait for.
+
+    Opens the datasets index and the DuckDB database, loads the catalog,
+    imports plotly and the Mistral SDK, and compiles the graph.
+    """
+    settings = settings or get_settings()
+    start = time.perf_counter()
+    if settings.dataset_retriever == "chroma":
+        await get_datasets_vectorstore(settings)
+    else:
+        await get_dataset_retriever(settings)
+    await asyncio.to_thread(engine.get_database, settings)
+    await asyncio.to_thread(get_catalog, settings)
+    await asyncio.to_thread(plotly_express)
+    await asyncio.to_thread(get_llm_gateway(settings).codestral)
+    await get_graph(settings)
+    logger.info(f"Warmed up in {time.perf_counter() - start:.2f}s")
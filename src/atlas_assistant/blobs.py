@@ -0,0 +1,235 @@
+"""Content-addressed storage for large state values.
+
+The checkpointer snapshots the whole agent state at every step, so chart data
+and plotly figures kept in the state are copied again and again. They are
+stored here instead and the state only holds a `BlobRef` to them.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Protocol
+
+from pydantic import BaseModel
+
+from .payload import dumps, loads
+from .settings import Settings, get_settings
+
+logger = logging.getLogger(__name__)
+
+
+class BlobRef(BaseModel):
+    """A handle to a value in the blob store."""
+
+    blob: str
+    size: int
+    media_type: str = "application/json"
+
+
+class BlobStore(Protocol):
+    def put(self, data: bytes) -> str: ...
+
+    def get(self, digest: str) -> bytes | None: ...
+
+
+class MemoryBlobStore:
+    """Blobs in memory, least recently used ones evicted over `max_bytes`."""
+
+    def __init__(self, max_bytes: int = 512 * 1024**2):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._blobs: OrderedDict[str, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if digest in self._blobs:
+                self._blobs.move_to_end(digest)
+                return digest
+            self._blobs[digest] = data
+            self.size += len(data)
+            while self.size > self.max_bytes and len(self._blobs) > 1:
+                evicted, blob = self._blobs.popitem(last=False)
+                self.size -= len(blob)
+                logger.info(f"Evicted blob {evicted} from memory")
+        return digest
+
+    def get(self, digest: str) -> bytes | None:
+        with self._lock:
+            data = self._blobs.get(digest)
+            if data is not None:
+                self._blobs.move_to_end(digest)
+            return data
+
+
+class DiskBlobStore:
+    """Blobs in files under `path`, shared by workers and kept across restarts.
+
+    Least recently used blobs, by access time, are evicted over `max_bytes`.
+    The size of the store is counted as blobs are written, and from the files
+    every `RECOUNT_PUTS` writes for those of the other workers.
+    """
+
+    RECOUNT_PUTS = 100
+
+    def __init__(self, path: Path, max_bytes: int = 512 * 1024**2):
+        self.path = path
+        self.max_bytes = max_bytes
+        # None until the files are counted
+        self.size: int | None = None
+        self._puts = 0
+        self._lock = threading.Lock()
+
+    def _file(self, digest: str) -> Path:
+        return self.path / digest[:2] / digest[2:]
+
+    def put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        file = self._file(digest)
+        try:
+            # Used again, evicted last
+            os.utime(file)
+            return digest
+        except FileNotFoundError:
+            pass
+        file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = file.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, file)
+        with self._lock:
+            self._puts += 1
+            recount = self.size is None or self._puts >= self.RECOUNT_PUTS
+            if not recount:
+                self.size += len(data)
+            if not recount and self.size <= self.max_bytes:
+                return digest
+        self.evict(keep=file)
+        return digest
+
+    def get(self, digest: str) -> bytes | None:
+        file = self._file(digest)
+        try:
+            data = file.read_bytes()
+            os.utime(file)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def _files(self) -> list[tuple[float, int, Path]]:
+        files = []
+        for file in self.path.glob("*/*"):
+            if file.suffix == ".tmp":
+                continue
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                # Evicted by another worker
+                continue
+            files.append((stat.st_atime, stat.st_size, file))
+        return files
+
+    def evict(self, keep: Path | None = None) -> None:
+        """Delete the least recently used blobs, but `keep`, over `max_bytes`."""
+        files = self._files()
+        total = sum(size for _, size, _ in files)
+        for _, size, file in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if file == keep:
+                continue
+            file.unlink(missing_ok=True)
+            total -= size
+            logger.info(f"Evicted blob {file.parent.name}{file.name} from disk")
+        with self._lock:
+            self.size = total
+            self._puts = 0
+
+
+MEMORY_WITH_SQLITE = (
+    "Charts are kept in memory but conversations in SQLite: after a restart the"
+    " charts of earlier turns are gone, set BLOB_STORE=disk to keep them"
+)
+
+_store: BlobStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_blob_store(settings: Settings | None = None) -> BlobStore | None:
+    """The blob store of the process, None if large values stay in the state."""
+    global _store
+    settings = settings or get_settings()
+    if settings.blob_store == "none":
+        return None
+    with _store_lock:
+        if _store is None:
+            if settings.blob_store == "disk":
+                _store = DiskBlobStore(
+                    settings.blob_store_path, settings.blob_store_max_bytes
+                )
+            else:
+                if settings.checkpointer == "sqlite":
+                    logger.warning(MEMORY_WITH_SQLITE)
+                _store = MemoryBlobStore(settings.blob_store_max_bytes)
+        return _store
+
+
+def reset_blob_store() -> None:
+    global _store
+    with _store_lock:
+        _store = None
+
+
+def store_json(value: Any, settings: Settings | None = None) -> BlobRef | Any:
+    """Put a JSON value in the blob store and return its handle.
+
+    Numpy arrays are stored as plotly typed arrays, see `payload.dumps`. The
+    value itself, as plain JSON, is returned if there is no blob store.
+    """
+    data = dumps(value)
+    store = get_blob_store(settings)
+    if store is None:
+        return loads(data)
+    return BlobRef(blob=store.put(data), size=len(data))
+
+
+def _blob(value: BlobRef | dict, settings: Settings | None) -> bytes | None:
+    settings = settings or get_settings()
+    store = get_blob_store(settings)
+    data = store.get(value.blob) if store is not None else None
+    if data is None:
+        reason = f"evicted from the {settings.blob_store} blob store"
+        if settings.blob_store == "memory" and settings.checkpointer == "sqlite":
+            reason += f", or lost on restart. {MEMORY_WITH_SQLITE}"
+        logger.warning(f"Blob {value.blob} is no longer available: {reason}")
+    return data
+
+
+def _as_ref(value: Any) -> BlobRef | Any:
+    if isinstance(value, dict) and set(value) == {"blob", "size", "media_type"}:
+        return BlobRef(**value)
+    return value
+
+
+def resolve(value: BlobRef | Any, settings: Settings | None = None) -> Any:
+    """The value behind a handle; anything else is returned as is.
+
+    Returns None, and logs why, if the blob is no longer in the store.
+    """
+    value = _as_ref(value)
+    if not isinstance(value, BlobRef):
+        return value
+    data = _blob(value, settings)
+    return loads(data) if data is not None else None
+
+
+def resolve_json(value: BlobRef | Any, settings: Settings | None = None) -> str | None:
+    """The JSON of the value behind a handle, as stored, without parsing it."""
+    value = _as_ref(value)
+    if not isinstance(value, BlobRef):
+        return dumps(value).decode()
+    data = _blob(value, settings)
+    return data.decode() if data is not None else None
@@ -0,0 +1,322 @@
+"""Catalog of the schema and statistics of the datasets.
+
+The profiler only reads parquet footers: the schema, the row counts and the
+statistics of every row group. Distinct values of low-cardinality columns come
+from the row group statistics when every row group holds a single value, or
+else from the column itself when it is dictionary encoded and small. The
+catalog is written by `scripts/parquet_analyzer.py` and lets `create_chart`
+describe a dataset without reading anything from S3.
+
+Datasets with a fresh copy in the local mirror are profiled from it, and their
+profile records the layout of the copy.
+"""
+
+import asyncio
+import csv
+import hashlib
+import io
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Any
+
+from pydantic import BaseModel, Field
+
+from . import engine
+from .layout import Layout
+from .result_cache import file_version
+from .settings import Settings, get_settings
+
+logger = logging.getLogger(__name__)
+
+# Bump when the profiles change, older catalogs are then rebuilt from scratch
+CATALOG_VERSION = 1
+
+INTEGER_TYPES = {
+    "TINYINT",
+    "SMALLINT",
+    "INTEGER",
+    "BIGINT",
+    "HUGEINT",
+    "UTINYINT",
+    "USMALLINT",
+    "UINTEGER",
+    "UBIGINT",
+}
+FLOAT_TYPES = {"FLOAT", "DOUBLE", "DECIMAL"}
+
+Value = str | int | float
+
+
+class ColumnProfile(BaseModel):
+    name: str
+    type: str
+    min: Value | None = None
+    max: Value | None = None
+    null_count: int | None = None
+    distinct_values: list[Value] | None = None
+
+
+class DatasetProfile(BaseModel):
+    key: str
+    s3: str
+    file_version: str
+    num_rows: int
+    num_row_groups: int
+    columns: list[ColumnProfile]
+    # The layout of the local copy queries read, None if they read the original
+    layout: Layout | None = None
+
+
+class Catalog(BaseModel):
+    version: int = CATALOG_VERSION
+    datasets: dict[str, DatasetProfile] = Field(default_factory=dict)
+
+
+def _parse(value: str | None, column_type: str) -> Value | None:
+    """A statistic of a parquet footer, as the type of its column."""
+    if value is None:
+        return None
+    base_type = column_type.split("(")[0]
+    try:
+        if base_type in INTEGER_TYPES:
+            return int(value)
+        if base_type in FLOAT_TYPES:
+            return float(value)
+    except ValueError:
+        return None
+    return value
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _distinct_values(
+    path: str,
+    column: ColumnProfile,
+    row_groups: list[dict[str, Any]],
+    settings: Settings,
+) -> list[Value] | None:
+    if column.type.split("(")[0] in FLOAT_TYPES:
+        return None
+    limit = settings.catalog_max_distinct_values
+    mins = [_parse(group["stats_min_value"], column.type) for group in row_groups]
+    maxs = [_parse(group["stats_max_value"], column.type) for group in row_groups]
+    if mins == maxs and None not in mins:
+        # One value per row group, e.g. data sorted by this column
+        values = set(mins)
+        return sorted(values) if len(values) <= limit else None
+
+    dictionary_encoded = all(
+        "DICTIONARY" in (group["encodings"] or "") for group in row_groups
+    )
+    size = sum(group["total_compressed_size"] or 0 for group in row_groups)
+    if not dictionary_encoded or size > settings.catalog_distinct_max_bytes:
+        return None
+    result = engine.fetch_table(
+        f"SELECT DISTINCT {_quote(column.name)} AS value FROM '{path}'"
+        f" WHERE value IS NOT NULL LIMIT {limit + 1}",
+        settings,
+    )
+    values = result.column("value").to_pylist()
+    return sorted(values) if len(values) <= limit else None
+
+
+def local_layout(path: str) -> Layout | None:
+    """The layout of the fresh mirrored copy of a dataset, if it has one."""
+    mirror = engine.get_dataset_mirror()
+    return mirror.local_layout(path) if mirror is not None else None
+
+
+def profile_dataset(
+    dataset: dict, settings: Settings | None = None, version: str | None = None
+) -> DatasetProfile:
+    """Profile a dataset from its parquet footer, blocking."""
+    settings = settings or get_settings()
+    path = dataset["s3"]
+    version = version or file_version(path, settings.duckdb_s3_endpoint)
+    schema = engine.fetch_table(f"DESCRIBE SELECT * FROM '{path}'", settings)
+    file_metadata = engine.fetch_table(
+        f"""
+        SELECT sum(num_rows) AS num_rows, sum(num_row_groups) AS num_row_groups
+        FROM parquet_file_metadata('{path}')
+        """,
+        settings,
+    ).to_pylist()[0]
+    statistics = engine.fetch_table(
+        f"""
+        SELECT
+          path_in_schema, stats_min_value, stats_max_value, stats_null_count,
+          total_compressed_size, encodings
+        FROM parquet_metadata('{path}')
+        ORDER BY row_group_id
+        """,
+        settings,
+    ).to_pylist()
+
+    columns = []
+    for field in schema.select(["column_name", "column_type"]).to_pylist():
+        column = ColumnProfile(name=field["column_name"], type=field["column_type"])
+        row_groups = [
+            group for group in statistics if group["path_in_schema"] == column.name
+        ]
+        if row_groups:
+            mins = [_parse(g["stats_min_value"], column.type) for g in row_groups]
+            maxs = [_parse(g["stats_max_value"], column.type) for g in row_groups]
+            if None not in mins:
+                column.min = min(mins)
+            if None not in maxs:
+                column.max = max(maxs)
+            null_counts = [group["stats_null_count"] for group in row_groups]
+            if None not in null_counts:
+                column.null_count = sum(null_counts)
+            column.distinct_values = _distinct_values(
+                path, column, row_groups, settings
+            )
+        columns.append(column)
+
+    return DatasetProfile(
+        key=dataset.get("key", path),
+        s3=path,
+        file_version=version,
+        num_rows=file_metadata["num_rows"],
+        num_row_groups=file_metadata["num_row_groups"],
+        columns=columns,
+        layout=local_layout(path),
+    )
+
+
+def active_datasets(datasets: list[dict]) -> list[dict]:
+    return [
+        dataset
+        for dataset in datasets
+        if dataset.get("active", False) and dataset.get("s3", "").endswith(".parquet")
+    ]
+
+
+async def build_catalog(
+    datasets: list[dict],
+    settings: Settings | None = None,
+    catalog: Catalog | None = None,
+) -> Catalog:
+    """Profile all datasets concurrently.
+
+    Profiles in `catalog` whose file and local copy didn't change are reused.
+    """
+    settings = settings or get_settings()
+    if catalog is None or catalog.version != CATALOG_VERSION:
+        catalog = Catalog()
+    loop = asyncio.get_running_loop()
+    executor = engine.get_executor(settings)
+    engine.get_database(settings)
+
+    async def profile(dataset: dict) -> DatasetProfile | None:
+        previous = catalog.datasets.get(dataset.get("key", dataset["s3"]))
+        try:
+            version = await loop.run_in_executor(
+                executor, file_version, dataset["s3"], settings.duckdb_s3_endpoint
+            )
+            if (
+                previous is not None
+                and previous.s3 == dataset["s3"]
+                and previous.file_version == version
+                and previous.layout == local_layout(dataset["s3"])
+            ):
+                return previous
+            return await loop.run_in_executor(
+                executor, profile_dataset, dataset, settings, version
+            )
+        except Exception as e:
+            logger.warning(f"Can't profile {dataset['s3']}: {e}")
+            return previous
+
+    profiles = await asyncio.gather(*(profile(dataset) for dataset in datasets))
+    return Catalog(
+        datasets={profile.key: profile for profile in profiles if profile is not None}
+    )
+
+
+def load_catalog(path: Path) -> Catalog:
+    try:
+        return Catalog.model_validate_json(path.read_bytes())
+    except FileNotFoundError:
+        return Catalog()
+
+
+def save_catalog(catalog: Catalog, path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(catalog.model_dump_json(indent=1))
+    os.replace(tmp, path)
+
+
+_catalog: Catalog | None = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog(settings: Settings | None = None) -> Catalog:
+    """The catalog of the process, loaded on first use."""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            settings = settings or get_settings()
+            _catalog = load_catalog(settings.dataset_catalog_path)
+            if _catalog.version != CATALOG_VERSION:
+                logger.warning("The dataset catalog is outdated, rebuild it")
+                _catalog = Catalog()
+        return _catalog
+
+
+def reset_catalog() -> None:
+    global _catalog
+    with _catalog_lock:
+        _catalog = None
+
+
+async def get_dataset_profile(
+    dataset: dict, settings: Settings | None = None
+) -> DatasetProfile:
+    """The profile of a dataset from the catalog, profiled now if it's missing."""
+    settings = settings or get_settings()
+    catalog = get_catalog(settings)
+    profile = catalog.datasets.get(dataset.get("key", dataset["s3"]))
+    if profile is None or profile.s3 != dataset["s3"]:
+        logger.info(f"{dataset['s3']} is not in the catalog, profiling it")
+        loop = asyncio.get_running_loop()
+        profile = await loop.run_in_executor(
+            engine.get_executor(settings), profile_dataset, dataset, settings
+        )
+        catalog.datasets[profile.key] = profile
+    return profile
+
+
+def describe_dataset(
+    profile: DatasetProfile, columns: list[ColumnProfile] | None = None
+) -> str:
+    """The columns of a dataset, or only `columns`, with their statistics as csv."""
+    with io.StringIO() as buffer:
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(
+            ["column_name", "column_type", "min", "max", "null_count", "values"]
+        )
+        for column in profile.columns if columns is None else columns:
+            values = column.distinct_values
+            writer.writerow(
+                [
+                    column.name,
+                    column.type,
+                    column.min,
+                    column.max,
+                    column.null_count,
+                    "|".join(map(str, values)) if values is not None else "",
+                ]
+            )
+        return buffer.getvalue()
+
+
+def schema_version(profile: DatasetProfile) -> str:
+    """A digest of the columns of a dataset, which generated SQL depends on."""
+    columns = "\n".join(f"{column.name}\0{column.type}" for column in profile.columns)
+    return hashlib.sha256(columns.encode()).hexdigest()[:16]
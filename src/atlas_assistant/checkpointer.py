@@ -0,0 +1,276 @@
+"""Checkpointers that keep conversations bounded.
+
+Every step of the agent writes a checkpoint of its state. Without limits they
+pile up for as long as the process runs, so only the latest checkpoints of a
+conversation are kept and conversations nobody touched for `checkpointer_ttl`
+seconds are dropped. `checkpointer = "sqlite"` keeps them in a file so that
+conversations survive a restart of the worker.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any
+
+import aiosqlite
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+)
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+from .settings import Settings, get_settings
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedMemorySaver(InMemorySaver):
+    """In-memory checkpoints of at most `max_threads` conversations.
+
+    The least recently used conversations are dropped first, and any that were
+    idle for `ttl` seconds. Only the latest `keep_checkpoints` checkpoints of
+    each conversation are kept.
+    """
+
+    def __init__(
+        self,
+        max_threads: int = 1000,
+        ttl: float | None = None,
+        keep_checkpoints: int = 10,
+    ):
+        super().__init__()
+        self.max_threads = max_threads
+        self.ttl = ttl
+        self.keep_checkpoints = keep_checkpoints
+        self.last_used: OrderedDict[str, float] = OrderedDict()
+
+    def _touch(self, thread_id: str) -> None:
+        now = time.monotonic()
+        self.last_used[thread_id] = now
+        self.last_used.move_to_end(thread_id)
+        while self.last_used:
+            oldest, used = next(iter(self.last_used.items()))
+            expired = self.ttl is not None and now - used > self.ttl
+            if oldest == thread_id or (
+                len(self.last_used) <= self.max_threads and not expired
+            ):
+                break
+            del self.last_used[oldest]
+            self.delete_thread(oldest)
+            logger.info(f"Dropped the checkpoints of thread {oldest}")
+
+    def _prune(self, thread_id: str, checkpoint_ns: str) -> None:
+        checkpoints = self.storage[thread_id][checkpoint_ns]
+        if len(checkpoints) <= self.keep_checkpoints:
+            return
+        # Checkpoint IDs are time ordered
+        ids = sorted(checkpoints)
+        dropped, kept = ids[: -self.keep_checkpoints], ids[-self.keep_checkpoints :]
+        referenced = set()
+        for checkpoint_id in kept:
+            checkpoint = self.serde.loads_typed(checkpoints[checkpoint_id][0])
+            referenced.update(checkpoint["channel_versions"].items())
+        for checkpoint_id in dropped:
+            checkpoint = self.serde.loads_typed(checkpoints.pop(checkpoint_id)[0])
+            self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+            # Channel values are stored once per version, by the checkpoint
+            # that introduced them
+            for channel, version in checkpoint["channel_versions"].items():
+                if (channel, version) not in referenced:
+                    self.blobs.pop((thread_id, checkpoint_ns, channel, version), None)
+
+    def get_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        thread_id = config["configurable"]["thread_id"]
+        if thread_id in self.last_used:
+            self._touch(thread_id)
+        return super().get_tuple(config)
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        next_config = super().put(config, checkpoint, metadata, new_versions)
+        thread_id = config["configurable"]["thread_id"]
+        self._prune(thread_id, config["configurable"]["checkpoint_ns"])
+        self._touch(thread_id)
+        return next_config
+
+
+class CompactingSqliteSaver(AsyncSqliteSaver):
+    """SQLite checkpoints, compacted every `compact_interval` seconds.
+
+    Compaction drops conversations idle for `ttl` seconds and all but the
+    latest `keep_checkpoints` checkpoints of the others.
+    """
+
+    def __init__(
+        self,
+        conn: aiosqlite.Connection,
+        ttl: float | None = None,
+        keep_checkpoints: int = 10,
+        compact_interval: float = 600.0,
+    ):
+        super().__init__(conn)
+        self.ttl = ttl
+        self.keep_checkpoints = keep_checkpoints
+        self.compact_interval = compact_interval
+        self.last_compaction = time.monotonic()
+
+    async def setup(self) -> None:
+        if self.is_setup:
+            return
+        # Only applies to new databases: lets compaction give space back
+        await self._execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await super().setup()
+        async with self.lock:
+            await self._execute(
+                "CREATE TABLE IF NOT EXISTS thread_activity"
+                " (thread_id TEXT PRIMARY KEY, updated_at REAL NOT NULL)"
+            )
+            await self.conn.commit()
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        next_config = await super().aput(config, checkpoint, metadata, new_versions)
+        async with self.lock:
+            await self._execute(
+                "INSERT INTO thread_activity (thread_id, updated_at) VALUES (?, ?)"
+                " ON CONFLICT (thread_id) DO UPDATE SET updated_at = excluded.updated_at",
+                (str(config["configurable"]["thread_id"]), time.time()),
+            )
+            await self.conn.commit()
+        if time.monotonic() - self.last_compaction > self.compact_interval:
+            await self.compact()
+        return next_config
+
+    async def _execute(self, sql: str, parameters: tuple = ()) -> int:
+        """Run a statement to completion and return the number of rows changed."""
+        async with self.conn.execute(sql, parameters) as cursor:
+            await cursor.fetchall()
+            return cursor.rowcount
+
+    async def compact(self) -> dict[str, int]:
+        """Delete expired conversations and old checkpoints."""
+        await self.setup()
+        self.last_compaction = time.monotonic()
+        async with self.lock:
+            expired = 0
+            if self.ttl is not None:
+                cutoff = (time.time() - self.ttl,)
+                for table in ["checkpoints", "writes"]:
+                    await self._execute(
+                        f"DELETE FROM {table} WHERE thread_id IN (SELECT thread_id"
+                        " FROM thread_activity WHERE updated_at < ?)",
+                        cutoff,
+                    )
+                expired = await self._execute(
+                    "DELETE FROM thread_activity WHERE updated_at < ?", cutoff
+                )
+            # Checkpoint IDs are time ordered
+            pruned = await self._execute(
+                """
+                DELETE FROM checkpoints WHERE rowid IN (
+                    SELECT rowid FROM (
+                        SELECT rowid, row_number() OVER (
+                            PARTITION BY thread_id, checkpoint_ns
+                            ORDER BY checkpoint_id DESC
+                        ) AS n
+                        FROM checkpoints
+                    ) WHERE n > ?
+                )
+                """,
+                (self.keep_checkpoints,),
+            )
+            await self._execute(
+                """
+                DELETE FROM writes WHERE NOT EXISTS (
+                    SELECT 1 FROM checkpoints c
+                    WHERE c.thread_id = writes.thread_id
+                    AND c.checkpoint_ns = writes.checkpoint_ns
+                    AND c.checkpoint_id = writes.checkpoint_id
+                )
+                """
+            )
+            await self.conn.commit()
+            await self._execute("PRAGMA incremental_vacuum")
+            await self._execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        logger.info(
+            f"Compacted checkpoints: {expired} threads expired,"
+            f" {pruned} old checkpoints deleted"
+        )
+        return {"expired_threads": expired, "deleted_checkpoints": pruned}
+
+
+async def open_sqlite_saver(
+    path: Path,
+    ttl: float | None = None,
+    keep_checkpoints: int = 10,
+    compact_interval: float = 600.0,
+) -> CompactingSqliteSaver:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = await aiosqlite.connect(path)
+    saver = CompactingSqliteSaver(
+        conn,
+        ttl=ttl,
+        keep_checkpoints=keep_checkpoints,
+        compact_interval=compact_interval,
+    )
+    await saver.setup()
+    await saver.compact()
+    return saver
+
+
+_checkpointer: BaseCheckpointSaver | None = None
+
+
+async def get_checkpointer(settings: Settings | None = None) -> BaseCheckpointSaver:
+    """The checkpointer shared by all conversations of the process."""
+    global _checkpointer
+    if _checkpointer is None:
+        settings = settings or get_settings()
+        if settings.checkpointer == "sqlite":
+            checkpointer: Any = await open_sqlite_saver(
+                settings.checkpointer_path,
+                ttl=settings.checkpointer_ttl,
+                keep_checkpoints=settings.checkpointer_keep_checkpoints,
+                compact_interval=settings.checkpointer_compact_interval,
+            )
+        else:
+            checkpointer = BoundedMemorySaver(
+                max_threads=settings.checkpointer_max_threads,
+                ttl=settings.checkpointer_ttl,
+                keep_checkpoints=settings.checkpointer_keep_checkpoints,
+            )
+        # Another session may have opened one in the meantime
+        if _checkpointer is None:
+            _checkpointer = checkpointer
+        elif isinstance(checkpointer, AsyncSqliteSaver):
+            await checkpointer.conn.close()
+    return _checkpointer
+
+
+async def close_checkpointer() -> None:
+    global _checkpointer
+    checkpointer, _checkpointer = _checkpointer, None
+    if isinstance(checkpointer, AsyncSqliteSaver):
+        await checkpointer.conn.close()
+
+
+def reset_checkpointer() -> None:
+    """Forget the shared checkpointer, without closing it."""
+    global _checkpointer
+    _checkpointer = None
@@ -0,0 +1,110 @@
+"""Compact Arrow tables for chart data.
+
+Query results stay in Arrow from DuckDB to plotly: rows with missing values
+are dropped, repetitive strings (country and admin names) are dictionary
+encoded and numbers are downcast to the smallest type that holds them.
+"""
+
+from typing import Any
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Strings are dictionary encoded when there are at most this many distinct
+# values per row
+MAX_DICTIONARY_RATIO = 0.5
+
+INTEGER_TYPES = [pa.int8(), pa.int16(), pa.int32()]
+
+
+def drop_missing(table: pa.Table) -> pa.Table:
+    """Drop rows with a null or NaN in any column, like `DataFrame.dropna`."""
+    mask = None
+    for column in table.columns:
+        valid = pc.is_valid(column)
+        if pa.types.is_floating(column.type):
+            valid = pc.and_kleene(valid, pc.invert(pc.is_nan(column)))
+        mask = valid if mask is None else pc.and_kleene(mask, valid)
+    if mask is None or pc.all(mask).as_py():
+        return table
+    return table.filter(mask)
+
+
+def _compact_column(column: pa.ChunkedArray) -> pa.ChunkedArray:
+    if len(column) == 0:
+        return column
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        if pc.count_distinct(column).as_py() <= len(column) * MAX_DICTIONARY_RATIO:
+            return column.dictionary_encode()
+        return column
+    if pa.types.is_float64(column.type) or pa.types.is_decimal(column.type):
+        return column.cast(pa.float32(), safe=False)
+    if pa.types.is_signed_integer(column.type):
+        min_max = pc.min_max(column)
+        low, high = min_max["min"].as_py(), min_max["max"].as_py()
+        for integer_type in INTEGER_TYPES:
+            if integer_type.bit_width >= column.type.bit_width:
+                break
+            info = np.iinfo(integer_type.to_pandas_dtype())
+            if info.min <= low and high <= info.max:
+                return column.cast(integer_type)
+    return column
+
+
+def compact_table(table: pa.Table) -> pa.Table:
+    """Drop incomplete rows and shrink the column types."""
+    table = drop_missing(table)
+    return pa.table(
+        [_compact_column(column) for column in table.columns],
+        names=table.column_names,
+    )
+
+
+def _to_list(column: pa.Array | pa.ChunkedArray) -> list:
+    numeric = pa.types.is_integer(column.type) or pa.types.is_floating(column.type)
+    if numeric and column.null_count == 0:
+        # Much faster than to_pylist for numbers
+        return column.to_numpy().tolist()
+    return column.to_pylist()
+
+
+def encode_columns(table: pa.Table) -> dict[str, Any]:
+    """A JSON-serializable columnar form of a table, see `decode_columns`.
+
+    Dictionary encoded columns are stored as their distinct values and the
+    index of each row's value in them.
+    """
+    columns = {}
+    for name, column in zip(table.column_names, table.columns, strict=True):
+        if pa.types.is_dictionary(column.type):
+            column = column.unify_dictionaries().combine_chunks()
+            columns[name] = {
+                "type": str(column.type.value_type),
+                "dictionary": column.dictionary.to_pylist(),
+                "indices": _to_list(column.indices),
+            }
+        else:
+            columns[name] = {"type": str(column.type), "values": _to_list(column)}
+    return {"num_rows": table.num_rows, "columns": columns}
+
+
+def _type(alias: str) -> pa.DataType | None:
+    try:
+        return pa.type_for_alias(alias)
+    except ValueError:
+        # Let Arrow infer types that have no alias, e.g. decimals
+        return None
+
+
+def decode_columns(data: dict[str, Any]) -> pa.Table:
+    arrays = {}
+    for name, column in data["columns"].items():
+        if "dictionary" in column:
+            arrays[name] = pa.DictionaryArray.from_arrays(
+                pa.array(column["indices"], pa.int32()),
+                pa.array(column["dictionary"], type=_type(column["type"])),
+            )
+        else:
+            arrays[name] = pa.array(column["values"], type=_type(column["type"]))
+    return pa.table(arrays)
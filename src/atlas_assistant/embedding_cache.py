@@ -0,0 +1,223 @@
+"""Two-tier cache for query embeddings.
+
+Users ask the same questions over and over, so query embeddings are kept in
+an in-memory LRU backed by a SQLite file. Entries are keyed by the embedding
+model and the normalized query text; switching models drops the disk tier.
+
+The asynchronous path keeps SQLite off the event loop. The recency of disk
+hits is written in batches of `USED_BATCH`, and the disk tier is trimmed to
+`TRIM_RATIO` of `max_disk_entries` once it's over it, not on every write.
+"""
+
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+USED_BATCH = 64
+TRIM_RATIO = 0.9
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an embedder so that repeated queries skip the API.
+
+    Document embeddings are passed through untouched, they're only computed
+    when the index is (re)built.
+    """
+
+    def __init__(
+        self,
+        embedder: Embeddings,
+        model: str,
+        path: Path | None = None,
+        max_memory_entries: int = 1024,
+        max_disk_entries: int = 100_000,
+    ):
+        self.embedder = embedder
+        self.model = model
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.memory: OrderedDict[str, list[float]] = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        # Last use of the disk hits not written yet
+        self._used: dict[str, float] = {}
+        self._rows = 0
+        if path is not None:
+            self._db = self._open(path)
+            self._rows = self._db.execute("SELECT count(*) FROM embeddings").fetchone()[
+                0
+            ]
+
+    def _open(self, path: Path) -> sqlite3.Connection:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(path, check_same_thread=False)
+        db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY, vector BLOB NOT NULL, used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used);
+            """
+        )
+        row = db.execute("SELECT value FROM meta WHERE key = 'model'").fetchone()
+        if row is None or row[0] != self.model:
+            if row is not None:
+                logger.info(
+                    f"Embedding model changed from {row[0]} to {self.model}, "
+                    "clearing the embedding cache"
+                )
+            db.execute("DELETE FROM embeddings")
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('model', ?)", (self.model,))
+            db.commit()
+        return db
+
+    def _key(self, text: str) -> str:
+        normalized = normalize_query(text)
+        return hashlib.sha256(f"{self.model}\0{normalized}".encode()).hexdigest()
+
+    def _get_memory(self, key: str) -> list[float] | None:
+        with self._lock:
+            vector = self.memory.get(key)
+            if vector is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+            return vector
+
+    def _get_disk(self, key: str) -> list[float] | None:
+        with self._lock:
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT vector FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    self._used[key] = time.time()
+                    if len(self._used) >= USED_BATCH:
+                        self._write_used()
+                        self._db.commit()
+                    vector = np.frombuffer(row[0], dtype=np.float64).tolist()
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                    return vector
+            self.misses += 1
+            return None
+
+    def _get(self, key: str) -> list[float] | None:
+        vector = self._get_memory(key)
+        if vector is None:
+            vector = self._get_disk(key)
+        return vector
+
+    def _write_used(self) -> None:
+        """Write the pending recency updates, with the lock held."""
+        assert self._db is not None
+        self._db.executemany(
+            "UPDATE embeddings SET used = ? WHERE key = ?",
+            [(used, key) for key, used in self._used.items()],
+        )
+        self._used.clear()
+
+    def _remember(self, key: str, vector: list[float]) -> None:
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def _put(self, key: str, vector: list[float]) -> None:
+        with self._lock:
+            self._remember(key, vector)
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                (key, np.asarray(vector, dtype=np.float64).tobytes(), time.time()),
+            )
+            self._rows += 1
+            if self._rows > self.max_disk_entries:
+                self._write_used()
+                self._db.execute(
+                    """
+                    DELETE FROM embeddings WHERE key IN (
+                        SELECT key FROM embeddings ORDER BY used DESC LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    (max(1, int(self.max_disk_entries * TRIM_RATIO)),),
+                )
+                # Counted again, other processes write to the file too
+                self._rows = self._db.execute(
+                    "SELECT count(*) FROM embeddings"
+                ).fetchone()[0]
+            self._db.commit()
+
+    async def _off_loop[T](self, function: Callable[..., T], *args: Any) -> T:
+        """Run `function` in a thread if it may touch SQLite."""
+        if self._db is None:
+            return function(*args)
+        return await asyncio.to_thread(function, *args)
+
+    def embed_query(self, text: str) -> list[float]:
+        key = self._key(text)
+        vector = self._get(key)
+        if vector is None:
+            vector = self.embedder.embed_query(text)
+            self._put(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        key = self._key(text)
+        vector = self._get_memory(key)
+        if vector is None:
+            vector = await self._off_loop(self._get_disk, key)
+        if vector is None:
+            vector = await self.embedder.aembed_query(text)
+            await self._off_loop(self._put, key, vector)
+        return vector
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embedder.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self.embedder.aembed_documents(texts)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.memory.clear()
+            self._used.clear()
+            self._rows = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM embeddings")
+                self._db.commit()
+
+    def stats(self) -> dict[str, int]:
+        disk_entries = 0
+        with self._lock:
+            if self._db is not None:
+                disk_entries = self._db.execute(
+                    "SELECT count(*) FROM embeddings"
+                ).fetchone()[0]
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self.memory),
+                "disk_entries": disk_entries,
+            }
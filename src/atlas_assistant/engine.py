@@ -0,0 +1,290 @@
+"""DuckDB query execution.
+
+All queries of the process run against one shared in-memory database, each
+on its own cursor, so that parquet metadata and remote file contents cached
+by one query are reused by the next. Datasets with a fresh copy in the local
+mirror are read from it, sorted for predicate pushdown. With `duckdb_cache_dir`
+set, other S3 reads go through `RangeCacheFileSystem` and the byte ranges read
+are kept on disk.
+
+DuckDB calls block until the scan is done, which for parquet on S3 can take
+seconds. Queries run on a bounded thread pool so that the event loop, and the
+other sessions it serves, keep going while a chart is being computed.
+Cancelling the task that awaits a query interrupts its cursor, and the task
+only ends once the pool thread is done with it.
+"""
+
+import asyncio
+import logging
+import re
+import threading
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from typing import Any
+
+import duckdb
+import pyarrow as pa
+
+from .governor import QueryGovernor, database_limits, is_truncated
+from .layout import Layout
+from .mirror import DatasetMirror
+from .range_cache import RangeCacheFileSystem, to_cached_path
+from .result_cache import ResultCache
+from .settings import Settings, get_settings
+
+logger = logging.getLogger(__name__)
+
+S3_LITERAL_PATTERN = re.compile(r"(['\"])(s3://[^'\"]+)\1")
+
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+_database: duckdb.DuckDBPyConnection | None = None
+_range_cache: RangeCacheFileSystem | None = None
+_result_cache: ResultCache | None = None
+_mirror: DatasetMirror | None = None
+_governor: QueryGovernor | None = None
+_database_lock = threading.Lock()
+
+
+def get_executor(settings: Settings | None = None) -> ThreadPoolExecutor:
+    """The thread pool shared by all DuckDB queries of this process."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            settings = settings or get_settings()
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.duckdb_max_workers,
+                thread_name_prefix="duckdb",
+            )
+        return _executor
+
+
+def shutdown_executor() -> None:
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def _connect(settings: Settings) -> duckdb.DuckDBPyConnection:
+    database = duckdb.connect(config=database_limits(settings))
+    # Keep parquet footers, HTTP HEAD responses and remote file contents around
+    # between queries instead of refetching them every time
+    database.execute("SET parquet_metadata_cache = true")
+    database.execute("SET enable_http_metadata_cache = true")
+    database.execute("SET enable_external_file_cache = true")
+    return database
+
+
+def get_database(settings: Settings | None = None) -> duckdb.DuckDBPyConnection:
+    """The DuckDB database shared by all queries, created on first use."""
+    global _database, _range_cache, _result_cache, _mirror, _governor
+    with _database_lock:
+        if _database is None:
+            settings = settings or get_settings()
+            database = _connect(settings)
+            if settings.duckdb_cache_dir is not None:
+                _range_cache = RangeCacheFileSystem(
+                    settings.duckdb_cache_dir,
+                    endpoint=settings.duckdb_s3_endpoint,
+                    max_bytes=settings.duckdb_cache_max_bytes,
+                )
+                database.register_filesystem(_range_cache)
+            if settings.result_cache_enabled:
+                _result_cache = ResultCache(
+                    settings.result_cache_dir,
+                    memory_bytes=settings.result_cache_memory_bytes,
+                    disk_bytes=settings.result_cache_disk_bytes,
+                    s3_endpoint=settings.duckdb_s3_endpoint,
+                    version_ttl=settings.result_cache_version_ttl,
+                )
+            if settings.dataset_mirror_dir is not None:
+                layout = None
+                if (
+                    settings.dataset_layout_sort_by
+                    or settings.dataset_layout_partition_by
+                ):
+                    layout = Layout(
+                        sort_by=settings.dataset_layout_sort_by,
+                        partition_by=settings.dataset_layout_partition_by,
+                        row_group_size=settings.dataset_layout_row_group_size,
+                    )
+                _mirror = DatasetMirror(
+                    settings.dataset_mirror_dir,
+                    s3_endpoint=settings.duckdb_s3_endpoint,
+                    max_age=settings.dataset_mirror_max_age,
+                    concurrency=settings.dataset_mirror_concurrency,
+                    layout=layout,
+                )
+            _governor = QueryGovernor(
+                max_rows=settings.query_max_rows,
+                timeout=settings.query_timeout,
+                max_estimated_rows=settings.query_max_estimated_rows,
+                max_concurrent=settings.query_max_concurrent,
+                queue_timeout=settings.query_queue_timeout,
+            )
+            _database = database
+        return _database
+
+
+def get_range_cache() -> RangeCacheFileSystem | None:
+    return _range_cache
+
+
+def get_result_cache() -> ResultCache | None:
+    return _result_cache
+
+
+def get_dataset_mirror() -> DatasetMirror | None:
+    return _mirror
+
+
+def get_governor(settings: Settings | None = None) -> QueryGovernor:
+    """The governor of the chart queries, see `fetch_table`."""
+    get_database(settings)
+    assert _governor is not None
+    return _governor
+
+
+def close_database() -> None:
+    """Close the shared database, e.g. to apply new settings."""
+    global _database, _range_cache, _result_cache, _mirror, _governor
+    with _database_lock:
+        if _database is not None:
+            _database.close()
+        _database = None
+        _range_cache = None
+        _result_cache = None
+        _mirror = None
+        _governor = None
+
+
+class RunningQuery:
+    """The cursor a query runs on, to interrupt it from another thread."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._conn: duckdb.DuckDBPyConnection | None = None
+        self._lock = threading.Lock()
+
+    def attach(self, conn: duckdb.DuckDBPyConnection | None) -> None:
+        with self._lock:
+            if conn is not None and self.cancelled:
+                raise duckdb.InterruptException("The query was cancelled")
+            self._conn = conn
+
+    def interrupt(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            if self._conn is not None:
+                self._conn.interrupt()
+
+
+@contextmanager
+def cursor(
+    settings: Settings | None = None, query: RunningQuery | None = None
+) -> Iterator[duckdb.DuckDBPyConnection]:
+    """A cursor on the shared database for the duration of one request.
+
+    `query.interrupt()` interrupts what runs on it.
+    """
+    conn = get_database(settings).cursor()
+    try:
+        if query is not None:
+            query.attach(conn)
+        yield conn
+    finally:
+        if query is not None:
+            query.attach(None)
+        conn.close()
+
+
+def localize_sql(sql: str) -> str:
+    """Read S3 objects from the local mirror, where it has fresh copies."""
+    if _mirror is None:
+        return sql
+    return _mirror.rewrite_sql(sql)
+
+
+def prepare_sql(sql: str) -> str:
+    """Route S3 reads through the range cache, if there is one."""
+    if _range_cache is None:
+        return sql
+    return S3_LITERAL_PATTERN.sub(
+        lambda match: match[1] + to_cached_path(match[2]) + match[1], sql
+    )
+
+
+def fetch_table(
+    sql: str,
+    settings: Settings | None = None,
+    governed: bool = False,
+    query: RunningQuery | None = None,
+) -> pa.Table:
+    """Run a query and return its result as an Arrow table, blocking.
+
+    Results of queries over parquet files are served from the result cache
+    while the files don't change. `governed` queries, the generated ones, run
+    within the limits of the `QueryGovernor`, admission aside.
+    """
+    get_database(settings)
+    sql = localize_sql(sql)
+    key = _result_cache.key(sql) if _result_cache is not None else None
+    if key is not None:
+        table = _result_cache.get(key)
+        if table is not None:
+            return _governor.cap(table) if governed else table
+
+    start = time.perf_counter()
+    with cursor(settings, query) as conn:
+        if governed:
+            table = _governor.execute(conn, prepare_sql(sql))
+        else:
+            table = conn.execute(prepare_sql(sql)).fetch_arrow_table()
+    # Truncated results aren't the result of the query
+    if key is not None and not is_truncated(table):
+        _result_cache.put(key, table, elapsed=time.perf_counter() - start)
+    return table
+
+
+async def run_on_pool[T](
+    function: Callable[..., T], *args: Any, settings: Settings | None = None
+) -> T:
+    """`function(*args, query=...)` on the DuckDB thread pool.
+
+    Cancelling the call interrupts the query, then waits for the thread to be
+    done with it: until then the query still holds its governor slot.
+    """
+    query = RunningQuery()
+    future = asyncio.get_running_loop().run_in_executor(
+        get_executor(settings), partial(function, *args, query=query)
+    )
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        query.interrupt()
+        await asyncio.wait([future])
+        raise
+
+
+async def run_query(
+    sql: str,
+    settings: Settings | None = None,
+    governed: bool = False,
+    admit: bool = True,
+) -> pa.Table:
+    """Run a query on the DuckDB thread pool.
+
+    `governed` queries first wait for a slot of the `QueryGovernor`, unless
+    not `admit`, for callers that bound their queries with slots of their own.
+    """
+    if not governed or not admit:
+        return await run_on_pool(
+            fetch_table, sql, settings, governed, settings=settings
+        )
+    async with get_governor(settings).admit():
+        return await run_on_pool(fetch_table, sql, settings, True, settings=settings)
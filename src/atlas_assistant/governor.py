@@ -0,0 +1,227 @@
+"""Limits on the queries generated for charts.
+
+The SQL codestral writes runs on the database every session shares, so one
+query over a whole hazard dataset could take the CPU and memory of all of
+them. `QueryGovernor`:
+
+- admits at most `query_max_concurrent` chart queries at once, the others wait
+  for up to `query_queue_timeout` seconds,
+- rejects queries whose plan, from `EXPLAIN`, estimates more rows than
+  `query_max_estimated_rows` in any operator, e.g. an accidental cross join,
+- interrupts queries still running after `query_timeout` seconds,
+- passes at most `query_max_rows` rows on to the plotting stage.
+
+DuckDB's `memory_limit` and `threads` apply to a whole database, not to one
+query, so the shared database is sized for `query_max_concurrent` queries of
+`query_memory_limit` and `query_threads` each, see `database_limits`.
+
+Rejected queries raise `QueryRejected`, whose message tells the agent how to
+fix the query.
+"""
+
+import asyncio
+import json
+import logging
+import re
+import threading
+from collections import Counter
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+
+import duckdb
+import pyarrow as pa
+
+from .settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# Operators whose output is the product of their inputs, DuckDB doesn't
+# estimate their cardinality
+PRODUCT_OPERATORS = {
+    "CROSS_PRODUCT",
+    "NESTED_LOOP_JOIN",
+    "BLOCKWISE_NL_JOIN",
+    "PIECEWISE_MERGE_JOIN",
+}
+SIZE_PATTERN = re.compile(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(i?)B?\s*", re.IGNORECASE)
+TRUNCATED_KEY = b"atlas_assistant.truncated"
+
+
+class QueryRejected(Exception):
+    """A query the governor won't run or finish, the message says why."""
+
+
+def estimate_rows(node: dict) -> int:
+    """The largest number of rows an operator of a plan is estimated to output."""
+    children = [estimate_rows(child) for child in node.get("children", [])]
+    estimate = node.get("extra_info", {}).get("Estimated Cardinality")
+    if estimate is not None:
+        own = int(estimate)
+    elif node.get("name", "").strip() in PRODUCT_OPERATORS:
+        own = 1
+        for child in children:
+            own *= child
+    else:
+        own = max(children, default=0)
+    return max([own, *children])
+
+
+def parse_size(size: str) -> int:
+    """Bytes in a DuckDB size like "2GB" or "512MiB"."""
+    match = SIZE_PATTERN.fullmatch(size)
+    if match is None:
+        raise ValueError(f"Not a size: {size}")
+    number, unit, binary = match.groups()
+    base = 1024 if binary or not unit else 1000
+    return int(float(number) * base ** " KMGT".index(unit.upper() or " "))
+
+
+def database_limits(settings: Settings) -> dict[str, int | str]:
+    """The `threads` and `memory_limit` of the shared database."""
+    limits: dict[str, int | str] = {}
+    if settings.duckdb_threads:
+        limits["threads"] = settings.duckdb_threads
+    elif settings.query_threads:
+        limits["threads"] = settings.query_threads * settings.query_max_concurrent
+    if settings.duckdb_memory_limit:
+        limits["memory_limit"] = settings.duckdb_memory_limit
+    elif settings.query_memory_limit:
+        total = parse_size(settings.query_memory_limit) * settings.query_max_concurrent
+        limits["memory_limit"] = f"{total // 1024}KiB"
+    return limits
+
+
+def is_truncated(table: pa.Table) -> bool:
+    """Whether the governor dropped rows of a query result."""
+    return TRUNCATED_KEY in (table.schema.metadata or {})
+
+
+class QueryGovernor:
+    def __init__(
+        self,
+        max_rows: int | None = 100_000,
+        timeout: float | None = 30.0,
+        max_estimated_rows: int | None = 1_000_000_000,
+        max_concurrent: int = 2,
+        queue_timeout: float | None = 60.0,
+    ):
+        self.max_rows = max_rows
+        self.timeout = timeout
+        self.max_estimated_rows = max_estimated_rows
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.stats: Counter[str] = Counter()
+        self.waiting = 0
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+
+    def _count(self, outcome: str) -> None:
+        with self._lock:
+            self.stats[outcome] += 1
+
+    def _release_unused(self, acquire: asyncio.Future) -> None:
+        if not acquire.cancelled() and acquire.exception() is None and acquire.result():
+            self._slots.release()
+
+    @asynccontextmanager
+    async def admit(self) -> AsyncIterator[None]:
+        """Wait for one of the `max_concurrent` query slots."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.waiting += 1
+            # Not on the DuckDB pool, whose threads the running queries need
+            acquire = asyncio.ensure_future(
+                asyncio.to_thread(self._slots.acquire, timeout=self.queue_timeout)
+            )
+            try:
+                acquired = await asyncio.shield(acquire)
+            except asyncio.CancelledError:
+                # The thread still waits for a slot, give it back once taken
+                acquire.add_done_callback(self._release_unused)
+                raise
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+            if not acquired:
+                self._count("busy")
+                raise QueryRejected(
+                    "The server is busy running other queries, try again later."
+                )
+            self._count("queued")
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def check(self, conn: duckdb.DuckDBPyConnection, sql: str) -> None:
+        """Reject a query whose plan estimates too many rows."""
+        if self.max_estimated_rows is None:
+            return
+        plans = conn.execute(f"EXPLAIN (FORMAT json) {sql}").fetchall()
+        estimate = max(
+            (estimate_rows(node) for _, plan in plans for node in json.loads(plan)),
+            default=0,
+        )
+        if estimate > self.max_estimated_rows:
+            self._count("too_large")
+            raise QueryRejected(
+                f"The query would process about {estimate:,} rows, more than the"
+                f" limit of {self.max_estimated_rows:,}. Join on keys, filter or"
+                " aggregate the data instead."
+            )
+
+    def cap(self, table: pa.Table) -> pa.Table:
+        """The first `max_rows` rows of a result."""
+        if self.max_rows is None or table.num_rows <= self.max_rows:
+            return table
+        self._count("truncated")
+        logger.warning(f"Keeping {self.max_rows} of the rows of a query result")
+        table = table.slice(0, self.max_rows)
+        metadata = {**(table.schema.metadata or {}), TRUNCATED_KEY: b"true"}
+        return table.replace_schema_metadata(metadata)
+
+    def execute(self, conn: duckdb.DuckDBPyConnection, sql: str) -> pa.Table:
+        """Run a query within the limits, blocking."""
+        self.check(conn, sql)
+        timer = None
+        timed_out = threading.Event()
+
+        def stop() -> None:
+            timed_out.set()
+            conn.interrupt()
+
+        if self.timeout is not None:
+            timer = threading.Timer(self.timeout, stop)
+            timer.daemon = True
+            timer.start()
+        try:
+            reader = conn.execute(sql).fetch_record_batch()
+            batches = []
+            num_rows = 0
+            # Stop reading once past the cap, the rest of the query never runs
+            for batch in reader:
+                batches.append(batch)
+                num_rows += batch.num_rows
+                if self.max_rows is not None and num_rows > self.max_rows:
+                    break
+            table = pa.Table.from_batches(batches, schema=reader.schema)
+        except duckdb.InterruptException as e:
+            if not timed_out.is_set():
+                # Cancelled by the caller, see `engine.RunningQuery`
+                raise
+            self._count("timeout")
+            raise QueryRejected(
+                f"The query took longer than {self.timeout:g} seconds and was"
+                " stopped. Filter or aggregate the data more."
+            ) from e
+        except duckdb.OutOfMemoryException as e:
+            self._count("out_of_memory")
+            raise QueryRejected(
+                f"The query ran out of memory ({e}). Filter or aggregate the data"
+                " more, or select fewer columns."
+            ) from e
+        finally:
+            if timer is not None:
+                timer.cancel()
+        self._count("executed")
+        return self.cap(table)
@@ -0,0 +1,160 @@
+"""What the chat model sees of a conversation.
+
+Without it the agent sends the whole conversation, every tool result
+included, to the chat model on every turn, so long sessions get slower and
+more expensive with each turn. `history_hook` runs before each model call and
+sends instead:
+
+- the last `history_keep_turns` turns verbatim, a turn being a user message
+  and what followed it,
+- older turns as a rolling summary, one line per turn of what the user asked,
+  which tools answered and the final answer, at most `history_summary_tokens`
+  of it, oldest lines first to go,
+- tool results of past turns cut to `history_tool_tokens`, the model already
+  answered from them,
+- at most `history_max_tokens` in all: turns are moved to the summary, then
+  the messages of the current turn cut, until the input fits.
+
+The conversation in the state, which the checkpointer keeps and the UI shows,
+is left whole. The summary is kept in the state and only extended with the
+turns that leave the window.
+"""
+
+import json
+import logging
+from collections.abc import Callable, Sequence
+from typing import Any
+
+from langchain_core.messages import AIMessage, BaseMessage, SystemMessage, ToolMessage
+
+from .prompts import count_tokens, truncate_tokens
+from .settings import Settings
+from .state import AgentState
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_HEADER = "Summary of the earlier turns of the conversation:"
+# Tokens of each part of the summary line of a turn
+SUMMARY_PART_TOKENS = 40
+# Role and framing of each message, on top of its content
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def split_turns(messages: Sequence[BaseMessage]) -> list[list[BaseMessage]]:
+    """The messages grouped in turns, each starting with a user message."""
+    turns: list[list[BaseMessage]] = []
+    for message in messages:
+        if message.type == "human" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def message_tokens(message: BaseMessage) -> int:
+    tokens = MESSAGE_OVERHEAD_TOKENS + count_tokens(str(message.content))
+    if isinstance(message, AIMessage) and message.tool_calls:
+        tokens += count_tokens(
+            json.dumps([call["args"] for call in message.tool_calls])
+        )
+    return tokens
+
+
+def _cut(message: BaseMessage, budget: int) -> BaseMessage:
+    if not isinstance(message.content, str):
+        return message
+    content = truncate_tokens(message.content, budget)
+    if content == message.content:
+        return message
+    return message.model_copy(update={"content": content})
+
+
+def summarize_turn(turn: list[BaseMessage]) -> str:
+    """One line of what the user asked, the tools that answered and the answer."""
+    parts = []
+    for message in turn:
+        text = truncate_tokens(
+            " ".join(str(message.content).split()), SUMMARY_PART_TOKENS
+        )
+        if message.type == "human":
+            parts.append(f"User: {text}")
+        elif isinstance(message, ToolMessage):
+            parts.append(f"{message.name or 'tool'}: {text}")
+    answers = [
+        message
+        for message in turn
+        if isinstance(message, AIMessage) and message.content and not message.tool_calls
+    ]
+    if answers:
+        text = " ".join(str(answers[-1].content).split())
+        parts.append(f"Assistant: {truncate_tokens(text, SUMMARY_PART_TOKENS)}")
+    return "- " + " | ".join(parts)
+
+
+def _cap_summary(lines: list[str], budget: int) -> list[str]:
+    while len(lines) > 1 and count_tokens("\n".join(lines)) > budget:
+        lines = lines[1:]
+    return lines
+
+
+def trim_history(
+    messages: Sequence[BaseMessage],
+    summary: list[str],
+    summarized_turns: int,
+    settings: Settings,
+) -> tuple[list[BaseMessage], list[str], int]:
+    """The input of the model, and the summary and number of turns it covers."""
+    turns = split_turns(messages)
+    start = max(summarized_turns, len(turns) - settings.history_keep_turns)
+    kept = [
+        [
+            _cut(message, settings.history_tool_tokens)
+            if isinstance(message, ToolMessage)
+            else message
+            for message in turn
+        ]
+        for turn in turns[start:-1]
+    ] + turns[-1:]
+    summary = summary + [summarize_turn(turn) for turn in turns[summarized_turns:start]]
+
+    def size() -> int:
+        summary_tokens = count_tokens("\n".join(summary)) if summary else 0
+        return summary_tokens + sum(message_tokens(m) for turn in kept for m in turn)
+
+    summary = _cap_summary(summary, settings.history_summary_tokens)
+    while len(kept) > 1 and size() > settings.history_max_tokens:
+        summary = _cap_summary(
+            summary + [summarize_turn(turns[start])], settings.history_summary_tokens
+        )
+        kept.pop(0)
+        start += 1
+    if kept and size() > settings.history_max_tokens:
+        # A single turn too large for the ceiling, e.g. a huge pasted table
+        budget = max(1, settings.history_max_tokens // (2 * len(kept[0])))
+        kept[0] = [_cut(message, budget) for message in kept[0]]
+
+    llm_input = [message for turn in kept for message in turn]
+    if summary:
+        llm_input.insert(
+            0, SystemMessage(content="\n".join([SUMMARY_HEADER, *summary]))
+        )
+    return llm_input, summary, start
+
+
+def history_hook(settings: Settings) -> Callable[[AgentState], dict[str, Any]]:
+    """The pre-model hook of the agent."""
+
+    def hook(state: AgentState) -> dict[str, Any]:
+        llm_input, summary, summarized_turns = trim_history(
+            state.messages, state.history_summary, state.summarized_turns, settings
+        )
+        logger.debug(
+            f"Sending {len(llm_input)} of {len(state.messages)} messages,"
+            f" {sum(map(message_tokens, llm_input))} tokens, to the chat model"
+        )
+        return {
+            "llm_input_messages": llm_input,
+            "history_summary": summary,
+            "summarized_turns": summarized_turns,
+        }
+
+    return hook
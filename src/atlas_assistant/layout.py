@@ -0,0 +1,80 @@
+"""Layout of the parquet files for predicate pushdown.
+
+Questions are nearly always about a country or a region, and a scenario or a
+time period. Parquet keeps the min and max of every column per row group, so
+with the rows sorted by those columns DuckDB skips the row groups of other
+countries without reading them, which it can't do on files in their original
+order. With `partition_by`, rows are also split in one directory per value,
+`column=value/`, and whole files are skipped.
+"""
+
+from pathlib import Path
+
+import duckdb
+from pydantic import BaseModel, Field
+
+
+class Layout(BaseModel):
+    sort_by: list[str] = Field(default_factory=list)
+    partition_by: list[str] = Field(default_factory=list)
+    row_group_size: int = 65_536
+
+    def for_columns(self, columns: list[str]) -> "Layout":
+        """This layout without the columns a file doesn't have.
+
+        Partition columns have a single value per file, they aren't sorted by.
+        """
+        partition_by = [column for column in self.partition_by if column in columns]
+        sort_by = [
+            column
+            for column in self.sort_by
+            if column in columns and column not in partition_by
+        ]
+        return self.model_copy(
+            update={"sort_by": sort_by, "partition_by": partition_by}
+        )
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _literal(path: Path) -> str:
+    return "'" + str(path).replace("'", "''") + "'"
+
+
+def query_path(target: Path, layout: Layout | None) -> str:
+    """What queries read to get the rows of a file written by `relayout`."""
+    if layout is not None and layout.partition_by:
+        return f"{target}/**/*.parquet"
+    return str(target)
+
+
+def relayout(source: Path, target: Path, layout: Layout) -> Layout:
+    """Rewrite a parquet file in `layout`, blocking.
+
+    Returns the layout applied, without the columns the file doesn't have.
+    `target` must not exist, it is written as a file, or as a directory of hive
+    partitions with `partition_by`.
+    """
+    with duckdb.connect() as conn:
+        columns = [
+            row[0]
+            for row in conn.execute(
+                f"DESCRIBE SELECT * FROM read_parquet({_literal(source)})"
+            ).fetchall()
+        ]
+        layout = layout.for_columns(columns)
+        order = ", ".join(map(_quote, layout.partition_by + layout.sort_by))
+        options = f"FORMAT parquet, ROW_GROUP_SIZE {layout.row_group_size}"
+        if layout.partition_by:
+            options += f", PARTITION_BY ({', '.join(map(_quote, layout.partition_by))})"
+        conn.execute(
+            f"""
+            COPY (
+              SELECT * FROM read_parquet({_literal(source)})
+              {f"ORDER BY {order}" if order else ""}
+            ) TO {_literal(target)} ({options})
+            """
+        )
+    return layout
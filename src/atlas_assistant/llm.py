@@ -0,0 +1,357 @@
+"""One gateway for the calls to the Mistral API.
+
+The agent model, codestral and the embeddings send their requests through a
+single `GatewayTransport`, so that every session shares:
+
+- one pool of HTTP connections, TLS handshakes are paid once per connection
+  rather than once per client,
+- the account's rate limits, token buckets of requests and tokens per minute
+  that calls wait on before they are sent,
+- retries of rate limited (429) and failed (5xx) calls, after the
+  `Retry-After` the API asks for or a jittered exponential backoff,
+- per-model metrics of latencies and token usage, see `LLMGateway.report`.
+
+Only asynchronous calls go through the gateway, the app makes no others.
+"""
+
+import asyncio
+import json
+import logging
+import random
+import statistics
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+import httpx
+
+if TYPE_CHECKING:
+    from mistralai import Mistral
+
+    from .settings import Settings
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Rough size of a token in the bytes of a request, for the estimate a call
+# reserves before the API tells how many it used
+BYTES_PER_TOKEN = 4
+# Headers that don't hold anymore once the body of a response was decoded
+DECODED_HEADERS = {b"content-encoding", b"content-length", b"transfer-encoding"}
+
+
+class TokenBucket:
+    """A budget of `per_minute` units, refilled continuously, up to `capacity`.
+
+    `reserve` never refuses: it takes the units, possibly overdrawing the
+    bucket, and returns how long to wait for the overdraft to be refilled.
+    Callers are served in the order they reserve.
+    """
+
+    def __init__(self, per_minute: float, capacity: float | None = None):
+        self.rate = per_minute / 60
+        self.capacity = capacity if capacity is not None else per_minute
+        self.level = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Take `amount` units, the seconds to wait before using them."""
+        with self._lock:
+            self._refill()
+            self.level -= amount
+            return max(0.0, -self.level / self.rate)
+
+    def adjust(self, amount: float) -> None:
+        """Take `amount` more units, or give them back if negative."""
+        with self._lock:
+            self._refill()
+            self.level = min(self.capacity, self.level - amount)
+
+
+@dataclass
+class CallStats:
+    calls: int = 0
+    failures: int = 0
+    retries: int = 0
+    # Seconds spent waiting on the rate limits
+    throttled: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    latencies: deque[float] = field(default_factory=lambda: deque(maxlen=1000))
+
+
+def _describe(content: bytes) -> tuple[str, int]:
+    """The model of a request and an estimate of the tokens it will use."""
+    try:
+        model = json.loads(content).get("model", "unknown")
+    except (ValueError, AttributeError):
+        model = "unknown"
+    return str(model), len(content) // BYTES_PER_TOKEN
+
+
+class GatewayTransport(httpx.AsyncBaseTransport):
+    def __init__(
+        self,
+        transport: httpx.AsyncBaseTransport,
+        requests_per_minute: int | None = None,
+        tokens_per_minute: int | None = None,
+        max_retries: int = 5,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+    ):
+        self.transport = transport
+        self.requests = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stats: dict[str, CallStats] = {}
+        self._lock = threading.Lock()
+
+    def _stats(self, model: str) -> CallStats:
+        with self._lock:
+            return self.stats.setdefault(model, CallStats())
+
+    async def _throttle(self, tokens: int) -> float:
+        delay = 0.0
+        if self.requests is not None:
+            delay = max(delay, self.requests.reserve(1))
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.reserve(tokens))
+        if delay:
+            await asyncio.sleep(delay)
+        return delay
+
+    def _backoff(self, attempt: int, response: httpx.Response | None) -> float:
+        retry_after = response.headers.get("Retry-After") if response else None
+        if retry_after is not None:
+            try:
+                return min(self.backoff_max, float(retry_after))
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    async def _with_usage(
+        self, response: httpx.Response, stats: CallStats
+    ) -> int | None:
+        """Read the usage of a JSON response, the tokens it used if it tells."""
+        await response.aread()
+        try:
+            usage = json.loads(response.content).get("usage") or {}
+        except (ValueError, AttributeError):
+            return None
+        stats.prompt_tokens += usage.get("prompt_tokens", 0)
+        stats.completion_tokens += usage.get("completion_tokens", 0) or 0
+        return usage.get("total_tokens")
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        model, estimate = _describe(request.content)
+        stats = self._stats(model)
+        stats.calls += 1
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            stats.throttled += await self._throttle(estimate)
+            response = error = None
+            try:
+                response = await self.transport.handle_async_request(request)
+            except httpx.TransportError as e:
+                error = e
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                break
+            # The API didn't count the tokens of a call it refused
+            if self.tokens is not None:
+                self.tokens.adjust(-estimate)
+            if attempt == self.max_retries:
+                stats.failures += 1
+                stats.latencies.append(time.perf_counter() - start)
+                if error is not None:
+                    raise error
+                return response
+            delay = self._backoff(attempt, response)
+            logger.warning(
+                f"Retrying {model} call in {delay:.1f}s after "
+                + (f"{response.status_code}" if response is not None else f"{error!r}")
+            )
+            if response is not None:
+                await response.aclose()
+            stats.retries += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+        if response.headers.get("content-type", "").startswith("application/json"):
+            used = await self._with_usage(response, stats)
+            if used is not None and self.tokens is not None:
+                self.tokens.adjust(used - estimate)
+            response = httpx.Response(
+                response.status_code,
+                headers=[
+                    (name, value)
+                    for name, value in response.headers.raw
+                    if name.lower() not in DECODED_HEADERS
+                ],
+                content=response.content,
+                extensions=response.extensions,
+            )
+        if response.is_error:
+            stats.failures += 1
+        stats.latencies.append(time.perf_counter() - start)
+        return response
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class LLMGateway:
+    def __init__(
+        self,
+        api_key: str | None = None,
+        endpoint: str = "https://api.mistral.ai",
+        max_connections: int = 20,
+        timeout: float = 120.0,
+        requests_per_minute: int | None = None,
+        tokens_per_minute: int | None = None,
+        max_retries: int = 5,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+    ):
+        self.api_key = api_key
+        self.endpoint = endpoint.rstrip("/")
+        self.timeout = timeout
+        self.transport = GatewayTransport(
+            httpx.AsyncHTTPTransport(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections,
+                ),
+            ),
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            max_retries=max_retries,
+            backoff_base=backoff_base,
+            backoff_max=backoff_max,
+        )
+        self._clients: dict[str, httpx.AsyncClient] = {}
+        self._codestral: Mistral | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def api_url(self) -> str:
+        """The base URL of the langchain clients, which leave out the version."""
+        return f"{self.endpoint}/v1"
+
+    def client(self, base_url: str = "") -> httpx.AsyncClient:
+        """An HTTP client for `base_url` on the shared connections."""
+        with self._lock:
+            client = self._clients.get(base_url)
+            if client is None:
+                headers = {
+                    "Content-Type": "application/json",
+                    "Accept": "application/json",
+                }
+                if self.api_key:
+                    headers["Authorization"] = f"Bearer {self.api_key}"
+                client = httpx.AsyncClient(
+                    base_url=base_url,
+                    headers=headers,
+                    timeout=self.timeout,
+                    transport=self.transport,
+                )
+                self._clients[base_url] = client
+            return client
+
+    def codestral(self) -> "Mistral":
+        """The Mistral client of the chart requests."""
+        # The SDK is slow to import, only the chart tool needs it
+        from mistralai import Mistral
+
+        client = self.client()
+        with self._lock:
+            if self._codestral is None:
+                self._codestral = Mistral(
+                    api_key=self.api_key,
+                    server_url=self.endpoint,
+                    async_client=client,
+                    # The gateway retries, the SDK shouldn't on top of it
+                    retry_config=None,
+                    timeout_ms=int(self.timeout * 1000),
+                )
+            return self._codestral
+
+    def report(self) -> str:
+        """Calls, latencies and token usage of each model."""
+        lines = []
+        with self.transport._lock:
+            stats = dict(self.transport.stats)
+        for model, model_stats in sorted(stats.items()):
+            latencies = sorted(model_stats.latencies)
+            if not latencies:
+                continue
+            p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+            lines.append(
+                f"{model}: {model_stats.calls} calls, {model_stats.failures} failed,"
+                f" {model_stats.retries} retries, latency p50"
+                f" {statistics.median(latencies):.2f}s p95 {p95:.2f}s,"
+                f" {model_stats.prompt_tokens} prompt and"
+                f" {model_stats.completion_tokens} completion tokens,"
+                f" {model_stats.throttled:.1f}s throttled"
+            )
+        return "\n".join(lines)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+_gateway: LLMGateway | None = None
+_gateway_lock = threading.Lock()
+
+
+def get_llm_gateway(settings: "Settings") -> LLMGateway:
+    """The gateway of the process, built on first use."""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            api_key = settings.mistral_api_key
+            _gateway = LLMGateway(
+                api_key=api_key.get_secret_value() if api_key else None,
+                endpoint=settings.mistral_endpoint,
+                max_connections=settings.llm_max_connections,
+                timeout=settings.llm_timeout,
+                requests_per_minute=settings.llm_requests_per_minute,
+                tokens_per_minute=settings.llm_tokens_per_minute,
+                max_retries=settings.llm_max_retries,
+                backoff_base=settings.llm_backoff_base,
+                backoff_max=settings.llm_backoff_max,
+            )
+        return _gateway
+
+
+def llm_report() -> str:
+    """The report of the gateway, empty if it wasn't used."""
+    gateway = _gateway
+    return gateway.report() if gateway is not None else ""
+
+
+async def close_llm_gateway() -> None:
+    global _gateway
+    with _gateway_lock:
+        gateway, _gateway = _gateway, None
+    if gateway is not None:
+        await gateway.aclose()
+
+
+def reset_llm_gateway() -> None:
+    """Drop the gateway without closing it, e.g. when the event loop is gone."""
+    global _gateway
+    with _gateway_lock:
+        _gateway = None
@@ -0,0 +1,247 @@
+"""Local mirror of the datasets.
+
+`DatasetMirror.sync` downloads the active parquet files of datasets.json to
+`dataset_mirror_dir`, concurrently, and only those whose ETag or size changed
+since the last sync. Downloads are checked against their size and, for
+single-part uploads whose ETag is the MD5 of the content, their MD5.
+
+With a `Layout`, local copies are rewritten sorted by the columns questions
+filter on, see `layout.py`, the layout of each copy is kept in the manifest.
+
+Queries read the local copy of a file instead of S3 while it is fresh, that is
+synced less than `dataset_mirror_max_age` seconds ago, and go to S3 otherwise.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import urllib.request
+from pathlib import Path
+
+from pydantic import BaseModel, Field
+
+from .layout import Layout, query_path, relayout
+from .range_cache import head, object_url
+
+logger = logging.getLogger(__name__)
+
+S3_LITERAL_PATTERN = re.compile(r"(['\"])(s3://[^'\"]+)\1")
+MD5_ETAG_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+
+class MirroredFile(BaseModel):
+    etag: str
+    size: int
+    synced_at: float
+    # The layout asked for, and the one applied to the columns of the file
+    requested_layout: Layout | None = None
+    layout: Layout | None = None
+
+
+class Manifest(BaseModel):
+    files: dict[str, MirroredFile] = Field(default_factory=dict)
+
+
+class IntegrityError(Exception):
+    pass
+
+
+def _remove(path: Path) -> None:
+    if path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def _replace(source: Path, target: Path) -> None:
+    """Move a file or a directory to `target`, replacing what's there."""
+    if target.is_dir() or (source.is_dir() and target.exists()):
+        old = target.with_name(f"{target.name}.{threading.get_ident()}.old")
+        os.replace(target, old)
+        os.replace(source, target)
+        _remove(old)
+    else:
+        os.replace(source, target)
+
+
+class DatasetMirror:
+    """Local copies of S3 objects under `path`, at `path/bucket/key`."""
+
+    def __init__(
+        self,
+        path: Path,
+        s3_endpoint: str = "https://{bucket}.s3.amazonaws.com",
+        max_age: float | None = None,
+        concurrency: int = 4,
+        layout: Layout | None = None,
+    ):
+        self.path = Path(path)
+        self.manifest_path = self.path / "manifest.json"
+        self.s3_endpoint = s3_endpoint
+        self.max_age = max_age
+        self.concurrency = concurrency
+        self.layout = layout
+        self._manifest = Manifest()
+        self._manifest_mtime: int | None = None
+        self._lock = threading.Lock()
+
+    def local_file(self, s3_path: str) -> Path:
+        bucket, _, key = s3_path.removeprefix("s3://").partition("/")
+        return self.path / bucket / key
+
+    def manifest(self) -> Manifest:
+        """The manifest, reloaded when another process synced."""
+        try:
+            mtime = self.manifest_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return self._manifest
+        with self._lock:
+            if mtime != self._manifest_mtime:
+                self._manifest = Manifest.model_validate_json(
+                    self.manifest_path.read_bytes()
+                )
+                self._manifest_mtime = mtime
+            return self._manifest
+
+    def _save_manifest(self) -> None:
+        tmp = self.manifest_path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp.write_text(self._manifest.model_dump_json(indent=1))
+        os.replace(tmp, self.manifest_path)
+        self._manifest_mtime = self.manifest_path.stat().st_mtime_ns
+
+    def _is_on_disk(self, s3_path: str, entry: MirroredFile) -> bool:
+        file = self.local_file(s3_path)
+        if entry.layout is not None:
+            return file.exists()
+        try:
+            return file.stat().st_size == entry.size
+        except FileNotFoundError:
+            return False
+
+    def _fresh_entry(self, s3_path: str) -> MirroredFile | None:
+        entry = self.manifest().files.get(s3_path)
+        if entry is None:
+            return None
+        if self.max_age is not None and time.time() - entry.synced_at > self.max_age:
+            return None
+        return entry if self._is_on_disk(s3_path, entry) else None
+
+    def local_path(self, s3_path: str) -> Path | None:
+        """The local copy of an object, None if there is no fresh one.
+
+        It is a directory for copies partitioned by their layout.
+        """
+        if self._fresh_entry(s3_path) is None:
+            return None
+        return self.local_file(s3_path)
+
+    def local_layout(self, s3_path: str) -> Layout | None:
+        """The layout of the fresh local copy of an object, if it has one."""
+        entry = self._fresh_entry(s3_path)
+        return entry.layout if entry is not None else None
+
+    def rewrite_sql(self, sql: str) -> str:
+        """Read the S3 objects of a query from their local copies, when fresh."""
+
+        def replace(match: re.Match) -> str:
+            entry = self._fresh_entry(match[2])
+            if entry is None:
+                return match[0]
+            local = query_path(self.local_file(match[2]), entry.layout)
+            return f"{match[1]}{local}{match[1]}"
+
+        return S3_LITERAL_PATTERN.sub(replace, sql)
+
+    def _download(self, s3_path: str, info: dict) -> MirroredFile:
+        file = self.local_file(s3_path)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = file.with_suffix(f".{threading.get_ident()}.tmp")
+        md5 = hashlib.md5()
+        size = 0
+        try:
+            url = object_url(s3_path, self.s3_endpoint)
+            with urllib.request.urlopen(url) as response, tmp.open("wb") as f:
+                while chunk := response.read(1 << 20):
+                    md5.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            if size != info["size"]:
+                raise IntegrityError(f"got {size} bytes, expected {info['size']}")
+            if MD5_ETAG_PATTERN.fullmatch(info["ETag"]) and (
+                md5.hexdigest() != info["ETag"]
+            ):
+                raise IntegrityError(f"MD5 {md5.hexdigest()} doesn't match the ETag")
+            layout = None
+            if self.layout is None:
+                _replace(tmp, file)
+            else:
+                laid_out = file.with_suffix(f".{threading.get_ident()}.layout")
+                try:
+                    layout = relayout(tmp, laid_out, self.layout)
+                    _replace(laid_out, file)
+                finally:
+                    _remove(laid_out)
+        finally:
+            tmp.unlink(missing_ok=True)
+        return MirroredFile(
+            etag=info["ETag"],
+            size=size,
+            synced_at=time.time(),
+            requested_layout=self.layout,
+            layout=layout,
+        )
+
+    def _sync_file(self, s3_path: str) -> str:
+        info = head(object_url(s3_path, self.s3_endpoint))
+        entry = self.manifest().files.get(s3_path)
+        unchanged = (
+            entry is not None
+            and entry.etag == info["ETag"]
+            and entry.size == info["size"]
+            and entry.requested_layout == self.layout
+            and self._is_on_disk(s3_path, entry)
+        )
+        if unchanged:
+            entry = entry.model_copy(update={"synced_at": time.time()})
+        else:
+            entry = self._download(s3_path, info)
+        with self._lock:
+            self._manifest.files[s3_path] = entry
+            self._save_manifest()
+        return "unchanged" if unchanged else "downloaded"
+
+    async def sync(self, s3_paths: list[str]) -> dict[str, int]:
+        """Download the objects that changed since the last sync, concurrently."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.manifest()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def sync_file(s3_path: str) -> str:
+            async with semaphore:
+                try:
+                    return await asyncio.to_thread(self._sync_file, s3_path)
+                except Exception as e:
+                    logger.warning(f"Can't mirror {s3_path}: {e}")
+                    return "failed"
+
+        results = await asyncio.gather(*(sync_file(path) for path in set(s3_paths)))
+        return {
+            status: results.count(status)
+            for status in ["downloaded", "unchanged", "failed"]
+        }
+
+    def prune(self, s3_paths: list[str]) -> None:
+        """Delete the local copies of objects that are not in `s3_paths`."""
+        keep = set(s3_paths)
+        manifest = self.manifest()
+        with self._lock:
+            for s3_path in list(manifest.files):
+                if s3_path not in keep:
+                    _remove(self.local_file(s3_path))
+                    del self._manifest.files[s3_path]
+            self._save_manifest()
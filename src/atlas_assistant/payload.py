@@ -0,0 +1,349 @@
+"""Compact chart payloads.
+
+Plotly express embeds every row of the query result in the figure, so a chart
+of a few million points is tens of megabytes of JSON that the browser then
+has to parse and draw. `compact_figure` shrinks the figure before it's stored:
+
+- line, scatter and area traces of more than `chart_max_points` points are
+  downsampled with Largest-Triangle-Three-Buckets, which keeps the peaks and
+  the overall shape of a series. Stacked areas keep evenly spaced points, the
+  same ones for every trace of the stack, and clouds of markers, whose x
+  isn't sorted, one marker per cell of a grid,
+- histograms are binned here and sent as bars of the counts,
+- box plots are sent as the statistics of each box rather than the points,
+  outliers aren't drawn,
+- numeric arrays are sent as plotly's typed arrays, base64 of their bytes.
+
+The figure goes from plotly to the blob store without a JSON round trip, and
+is serialized once with orjson, see `dumps`.
+"""
+
+import base64
+import logging
+import math
+from typing import Any
+
+import numpy as np
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# Bins of a histogram when it doesn't set `nbinsx`, at most
+MAX_BINS = 100
+# Typed array dtypes plotly.js reads, int64 isn't one of them
+TYPED_ARRAY_DTYPES = {"f8", "f4", "i4", "i2", "i1", "u4", "u2", "u1"}
+SCATTER_TYPES = {"scatter", "scattergl"}
+# Attributes of a trace holding one value per point, under it or its marker
+POINT_ATTRIBUTES = ["x", "y", "text", "hovertext", "customdata", "ids"]
+MARKER_ATTRIBUTES = ["color", "size", "symbol", "opacity"]
+HISTOGRAM_ATTRIBUTES = [
+    "bingroup",
+    "nbinsx",
+    "nbinsy",
+    "xbins",
+    "ybins",
+    "autobinx",
+    "autobiny",
+    "histfunc",
+    "histnorm",
+    "cumulative",
+]
+
+
+def to_array(value: Any) -> np.ndarray | None:
+    """The values of a data array of a figure, typed arrays decoded."""
+    if isinstance(value, dict) and "bdata" in value:
+        array = np.frombuffer(base64.b64decode(value["bdata"]), value["dtype"])
+        if "shape" in value:
+            shape = value["shape"]
+            if isinstance(shape, str):
+                shape = [int(size) for size in shape.split(",")]
+            array = array.reshape(shape)
+        return array
+    if isinstance(value, np.ndarray):
+        return value
+    if isinstance(value, list | tuple):
+        return np.asarray(value)
+    return None
+
+
+def _is_numeric(array: np.ndarray) -> bool:
+    return array.dtype.kind in "iuf"
+
+
+def encode_array(array: np.ndarray) -> dict | list:
+    """A numeric array as a plotly typed array, anything else as a list."""
+    if array.dtype.kind in "iu" and array.dtype.itemsize == 8 and len(array):
+        # Not a type plotly.js reads
+        if (
+            np.iinfo(np.int32).min <= array.min()
+            and array.max() <= np.iinfo(np.int32).max
+        ):
+            array = array.astype(np.int32)
+        else:
+            array = array.astype(np.float64)
+    if array.dtype.kind == "M":
+        return np.datetime_as_string(array).tolist()
+    dtype = array.dtype.newbyteorder("<")
+    code = f"{dtype.kind}{dtype.itemsize}"
+    if array.ndim != 1 or code not in TYPED_ARRAY_DTYPES:
+        return array.tolist()
+    return {
+        "dtype": code,
+        "bdata": base64.b64encode(array.astype(dtype, copy=False).tobytes()).decode(),
+    }
+
+
+def _padded(values: np.ndarray, size: int, fill: float) -> np.ndarray:
+    """`values` in rows of `size`, the last one padded with `fill`."""
+    rows = -(-len(values) // size)
+    padded = np.full(rows * size, fill)
+    padded[: len(values)] = values
+    return padded.reshape(rows, size)
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """The indices of about `threshold` points of a series, MinMaxLTTB.
+
+    `x` must be sorted. The first and last points are always kept, and from
+    each bucket of points in between, Largest-Triangle-Three-Buckets keeps the
+    one making the largest triangle with the point kept before it and the mean
+    of the next bucket. Only the minimum and maximum of each bucket are
+    candidates, which is what LTTB keeps nearly always, so that the buckets
+    are reduced all at once and only the choice between two points is made
+    one bucket at a time.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
+    # The points between the first and the last, in buckets of `size`
+    inner_x, inner_y = x[1:-1], y[1:-1]
+    size = -(-len(inner_x) // (threshold - 2))
+    missing = np.isnan(inner_y)
+    lowest = _padded(np.where(missing, np.inf, inner_y), size, np.inf).argmin(axis=1)
+    highest = _padded(np.where(missing, -np.inf, inner_y), size, -np.inf).argmax(axis=1)
+    starts = np.arange(0, len(inner_x), size)
+    candidates = np.stack([lowest, highest], axis=1) + starts[:, None] + 1
+    sizes = np.full(len(starts), size)
+    sizes[-1] = len(inner_x) - starts[-1]
+    mean_x = _padded(inner_x, size, 0).sum(axis=1) / sizes
+    mean_y = _padded(np.where(missing, 0, inner_y), size, 0).sum(axis=1) / np.maximum(
+        _padded(~missing, size, 0).sum(axis=1), 1
+    )
+    # The bucket after the last one is the last point
+    next_x = [*mean_x[1:].tolist(), x[-1]]
+    next_y = [*mean_y[1:].tolist(), y[-1]]
+    candidate_x, candidate_y = x[candidates].tolist(), y[candidates].tolist()
+    kept_x, kept_y = x[0], y[0]
+    chosen = []
+    for bucket in range(len(candidates)):
+        (low_x, high_x), (low_y, high_y) = candidate_x[bucket], candidate_y[bucket]
+        dx, dy = kept_x - next_x[bucket], next_y[bucket] - kept_y
+        low_area = abs(dx * (low_y - kept_y) - (kept_x - low_x) * dy)
+        high_area = abs(dx * (high_y - kept_y) - (kept_x - high_x) * dy)
+        high = high_area > low_area
+        chosen.append(high)
+        kept_x, kept_y = (high_x, high_y) if high else (low_x, low_y)
+    return np.concatenate(
+        [[0], candidates[np.arange(len(candidates)), np.array(chosen, int)], [n - 1]]
+    )
+
+
+def _cells(values: np.ndarray, side: int) -> np.ndarray:
+    values = values.astype(np.float64)
+    low, high = np.nanmin(values), np.nanmax(values)
+    scaled = (values - low) / ((high - low) or 1) * side
+    return np.clip(np.nan_to_num(scaled), 0, side - 1).astype(np.int64)
+
+
+def thin_markers(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+    """The indices of at most `max_points` markers, one per occupied cell.
+
+    The plot area is cut in a grid of `max_points` cells and the first marker
+    of each cell is kept, so that the extent of the cloud and its outliers
+    are still drawn. Markers stay in their order.
+    """
+    side = max(1, math.isqrt(max_points))
+    cells = _cells(x, side) * side + _cells(y, side)
+    first = np.full(side * side, -1)
+    # Later assignments win, in reverse the first marker of each cell does
+    first[cells[::-1]] = np.arange(len(cells) - 1, -1, -1)
+    return np.sort(first[first >= 0])
+
+
+def _take(
+    trace: dict, indices: np.ndarray, n: int, decoded: dict[str, np.ndarray]
+) -> None:
+    """Keep the `indices` points of every per point attribute of a trace.
+
+    `decoded` are the arrays of the trace already decoded, by attribute.
+    """
+    for attributes, parent in [
+        (POINT_ATTRIBUTES, trace),
+        (MARKER_ATTRIBUTES, trace.get("marker") or {}),
+    ]:
+        for attribute in attributes:
+            if parent is trace and attribute in decoded:
+                array = decoded[attribute]
+            else:
+                array = to_array(parent.get(attribute))
+            if array is not None and array.ndim >= 1 and len(array) == n:
+                parent[attribute] = array[indices]
+
+
+def downsample_scatter(trace: dict, max_points: int) -> bool:
+    x, y = to_array(trace.get("x")), to_array(trace.get("y"))
+    if y is None or len(y) <= max_points or not _is_numeric(y):
+        return False
+    decoded = {"y": y} if x is None else {"x": x, "y": y}
+    if x is not None and len(x) != len(y):
+        return False
+    if trace.get("stackgroup"):
+        # Stacked traces must keep the same x
+        indices = np.linspace(0, len(y) - 1, max_points).round().astype(np.int64)
+        _take(trace, indices, len(y), decoded)
+        return True
+    if x is None or not (_is_numeric(x) or x.dtype.kind == "M"):
+        positions = np.arange(len(y))
+    else:
+        positions = x.astype(np.int64) if x.dtype.kind == "M" else x
+    if np.all(positions[1:] >= positions[:-1]):
+        indices = lttb(positions, y, max_points)
+    else:
+        # A cloud of markers rather than a series
+        indices = thin_markers(positions, y, max_points)
+    _take(trace, indices, len(y), decoded)
+    return True
+
+
+def _histogram_values(trace: dict) -> np.ndarray | None:
+    if trace.get("type") != "histogram" or trace.get("y") is not None:
+        return None
+    if trace.get("histfunc", "count") != "count" or trace.get("histnorm"):
+        return None
+    if trace.get("orientation", "v") != "v" or trace.get("cumulative"):
+        return None
+    x = to_array(trace.get("x"))
+    if x is None or not _is_numeric(x):
+        return None
+    return x[np.isfinite(x)] if x.dtype.kind == "f" else x
+
+
+def aggregate_histograms(figure: dict, max_points: int) -> bool:
+    """Bin the large histograms of a figure, into bars of the counts.
+
+    Histograms of the same bin group, e.g. one per color, share their bins.
+    """
+    groups: dict[Any, list[tuple[dict, np.ndarray]]] = {}
+    for trace in figure.get("data", []):
+        values = _histogram_values(trace)
+        if values is not None:
+            groups.setdefault(trace.get("bingroup"), []).append((trace, values))
+    aggregated = False
+    for traces in groups.values():
+        if sum(len(values) for _, values in traces) <= max_points:
+            continue
+        values = np.concatenate([values for _, values in traces])
+        if not len(values):
+            continue
+        nbins = traces[0][0].get("nbinsx")
+        edges = np.histogram_bin_edges(values, bins=nbins or "auto")
+        if len(edges) - 1 > (nbins or MAX_BINS):
+            edges = np.linspace(edges[0], edges[-1], (nbins or MAX_BINS) + 1)
+        for trace, values in traces:
+            counts, _ = np.histogram(values, bins=edges)
+            for attribute in HISTOGRAM_ATTRIBUTES:
+                trace.pop(attribute, None)
+            trace.update(
+                type="bar",
+                x=(edges[:-1] + edges[1:]) / 2,
+                y=counts,
+                width=np.diff(edges),
+            )
+        aggregated = True
+    if aggregated:
+        # Histograms have no gap between bars by default, bars do
+        figure.setdefault("layout", {}).setdefault("bargap", 0)
+    return aggregated
+
+
+def _box_statistics(values: np.ndarray) -> dict[str, float]:
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    iqr = q3 - q1
+    return {
+        "q1": q1,
+        "median": median,
+        "q3": q3,
+        "mean": values.mean(),
+        "lowerfence": values[values >= q1 - 1.5 * iqr].min(),
+        "upperfence": values[values <= q3 + 1.5 * iqr].max(),
+    }
+
+
+def aggregate_box(trace: dict, max_points: int) -> bool:
+    """Replace the points of a large box trace by the statistics of its boxes."""
+    if trace.get("type") != "box" or "q1" in trace:
+        return False
+    value_axis, position_axis = (
+        ("x", "y") if trace.get("orientation") == "h" else ("y", "x")
+    )
+    values = to_array(trace.get(value_axis))
+    if values is None or len(values) <= max_points or not _is_numeric(values):
+        return False
+    positions = to_array(trace.get(position_axis))
+    if positions is None or len(positions) != len(values):
+        positions = np.full(len(values), trace.get(f"{position_axis}0", 0))
+    valid = np.isfinite(values) if values.dtype.kind == "f" else slice(None)
+    values, positions = values[valid], positions[valid]
+    import pandas as pd
+
+    # Boxes in the order of their first point, as plotly draws them
+    codes, labels = pd.factorize(positions)
+    order = np.argsort(codes, kind="stable")
+    groups = np.split(values[order], np.cumsum(np.bincount(codes))[:-1])
+    boxes = [
+        (label, _box_statistics(box)) for label, box in zip(labels, groups, strict=True)
+    ]
+    trace[position_axis] = np.array([label for label, _ in boxes])
+    for name in ["q1", "median", "q3", "mean", "lowerfence", "upperfence"]:
+        trace[name] = np.array([statistics[name] for _, statistics in boxes])
+    trace.pop(value_axis, None)
+    trace.pop(f"{position_axis}0", None)
+    trace["boxpoints"] = False
+    return True
+
+
+def compact_figure(figure: dict, max_points: int) -> dict:
+    """Downsample and aggregate the large traces of a figure, in place."""
+    compacted = aggregate_histograms(figure, max_points)
+    for trace in figure.get("data", []):
+        if trace.get("type") in SCATTER_TYPES:
+            compacted |= downsample_scatter(trace, max_points)
+        elif trace.get("type") == "box":
+            compacted |= aggregate_box(trace, max_points)
+    if compacted:
+        logger.info("Downsampled or aggregated the large traces of a chart")
+    return figure
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, np.ndarray):
+        return encode_array(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    raise TypeError(f"Can't serialize {type(value).__name__}")
+
+
+def dumps(value: Any) -> bytes:
+    """`value` as JSON, numpy arrays as typed arrays, in a single pass."""
+    return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def loads(data: bytes | str) -> Any:
+    return orjson.loads(data)
@@ -0,0 +1,159 @@
+"""Preview charts from a sample of the dataset, while the exact query runs.
+
+The full scan behind a chart of a large dataset can take seconds. For datasets
+of more than `preview_min_rows` rows, the chart query also runs on a sample of
+about `preview_sample_rows` rows, and if that's done first its chart is shown,
+marked as approximate, until the exact one replaces it.
+
+DuckDB's `TABLESAMPLE` picks rows after the scan has read them, which saves
+little of a parquet scan. The sample is instead whole row groups spread evenly
+over the file, selected by ranges of `file_row_number` that DuckDB skips the
+other row groups with. Their number follows the size of the dataset read from
+the parquet metadata in the catalog. Sums and counts of a preview are those of
+the sample. Mirrored copies sorted or partitioned by country, see
+`DATASET_LAYOUT_*`, aren't previewed: each of their row groups holds a few
+countries only, a sample of them would leave the others out of the chart.
+
+Samples run within the limits of the query governor but not in its slots, so
+that a previewed chart doesn't take two of them. They have their own budget of
+`preview_max_concurrent`, charts past it are only drawn once exact.
+"""
+
+import asyncio
+import logging
+import math
+import re
+
+import pyarrow as pa
+
+from . import engine
+from .catalog import DatasetProfile
+from .rollups import run_chart_query
+from .settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# Samples running in this process, see `preview_max_concurrent`
+_running_samples = 0
+
+
+def sample_row_groups(profile: DatasetProfile, settings: Settings) -> list[int]:
+    """The row groups of a dataset its previews read, none for small datasets."""
+    groups = profile.num_row_groups
+    if profile.num_rows < settings.preview_min_rows or groups < 2:
+        return []
+    layout = profile.layout
+    if layout is not None and (layout.sort_by or layout.partition_by):
+        # Row groups of sorted copies aren't a sample of the whole dataset
+        return []
+    rows_per_group = math.ceil(profile.num_rows / groups)
+    count = math.ceil(settings.preview_sample_rows / rows_per_group)
+    if 2 * count > groups:
+        # Not much faster than the whole dataset
+        return []
+    # The middle row group of each of `count` equal slices of the file
+    return [(2 * i + 1) * groups // (2 * count) for i in range(count)]
+
+
+def sample_sql(sql: str, profile: DatasetProfile, row_groups: list[int]) -> str | None:
+    """The query over the row groups of a sample, None if it doesn't read the file."""
+    rows_per_group = math.ceil(profile.num_rows / profile.num_row_groups)
+    path = profile.s3.replace("'", "''")
+    sample = " UNION ALL ".join(
+        f"SELECT * EXCLUDE (file_row_number)"
+        f" FROM read_parquet('{path}', file_row_number = true)"
+        f" WHERE file_row_number BETWEEN {group * rows_per_group}"
+        f" AND {(group + 1) * rows_per_group - 1}"
+        for group in row_groups
+    )
+    escaped = re.escape(profile.s3)
+    pattern = re.compile(
+        rf"(?:read_parquet|parquet_scan)\(\s*(['\"]){escaped}\1\s*\)"
+        rf"|(?<![(\w])(['\"]){escaped}\2"
+    )
+    sampled, count = pattern.subn(lambda _: f"({sample})", sql)
+    return sampled if count else None
+
+
+def _sample_done(_: asyncio.Future) -> None:
+    global _running_samples
+    _running_samples -= 1
+
+
+class ProgressiveQuery:
+    """A chart query, and the same query on a sample of its dataset.
+
+    Both start on entering the context, whatever is still running is
+    cancelled on leaving it.
+    """
+
+    def __init__(
+        self, sql: str, dataset: dict, profile: DatasetProfile, settings: Settings
+    ):
+        self.sql = sql
+        self.dataset = dataset
+        self.profile = profile
+        self.settings = settings
+        self.fraction = 0.0
+        self._exact: asyncio.Future | None = None
+        self._sample: asyncio.Future | None = None
+        self._previewed = False
+
+    async def __aenter__(self) -> "ProgressiveQuery":
+        self._exact = asyncio.ensure_future(
+            run_chart_query(self.sql, self.dataset, self.settings)
+        )
+        if not self.settings.preview_enabled or self.profile.s3 != self.dataset["s3"]:
+            return self
+        row_groups = sample_row_groups(self.profile, self.settings)
+        sampled = sample_sql(self.sql, self.profile, row_groups) if row_groups else None
+        if sampled is not None:
+            self._sample = self._start_sample(sampled)
+            if self._sample is not None:
+                self.fraction = len(row_groups) / self.profile.num_row_groups
+        return self
+
+    def _start_sample(self, sql: str) -> asyncio.Future | None:
+        global _running_samples
+        if _running_samples >= self.settings.preview_max_concurrent:
+            logger.info("Too many previews running, not previewing the chart")
+            return None
+        _running_samples += 1
+        sample = asyncio.ensure_future(
+            engine.run_query(sql, self.settings, governed=True, admit=False)
+        )
+        sample.add_done_callback(_sample_done)
+        return sample
+
+    async def __aexit__(self, *exc_info) -> None:
+        tasks = [task for task in (self._exact, self._sample) if task is not None]
+        for task in tasks:
+            task.cancel()
+        # Cancelled queries are interrupted, wait for their threads to be done
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def done(self) -> bool:
+        """Whether the exact query is done."""
+        return self._exact.done()
+
+    async def preview(self) -> pa.Table | None:
+        """The result on the sample if it's done first, None otherwise."""
+        if self._sample is None or self._previewed:
+            return None
+        self._previewed = True
+        sample = self._sample
+        await asyncio.wait([self._exact, sample], return_when="FIRST_COMPLETED")
+        if self.done() or not sample.done():
+            sample.cancel()
+            return None
+        if sample.exception() is not None:
+            logger.warning(f"Can't preview the chart: {sample.exception()}")
+            return None
+        logger.info(
+            f"Chart preview from {self.fraction:.1%} of the rows of {self.profile.key}"
+        )
+        return sample.result()
+
+    async def result(self) -> pa.Table:
+        """The result of the exact query."""
+        return await self._exact
@@ -0,0 +1,192 @@
+"""Token budgets of the chart prompts.
+
+Codestral's latency and cost grow with the prompt, and most of a chart prompt
+is the description of the dataset: a long note, and for wide datasets the
+statistics and distinct values of every column. `dataset_context` describes
+a dataset within budgets:
+
+- the note is cut to `prompt_note_tokens`,
+- columns are described most relevant first until the profile reaches
+  `prompt_profile_tokens`: those the request mentions, by name or by one of
+  their values, then those with distinct values, which queries filter and
+  group by, then the others. The columns left out are only named,
+- columns list at most `prompt_max_values` of their values, those the request
+  mentions first.
+
+`count_tokens` estimates tokens close to Mistral's tokenizers on English, SQL
+and csv, without their vocabulary.
+"""
+
+import logging
+import os
+import re
+import textwrap
+from typing import Any
+
+from .catalog import ColumnProfile, DatasetProfile, describe_dataset
+from .retriever import tokenize
+from .settings import Settings
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+# Words sharing a prefix this long are the same to the relevance of columns,
+# e.g. "country" and "countries"
+MIN_COMMON_PREFIX = 5
+ELLIPSIS = "…"
+NUMBER_PATTERN = re.compile(r"\d+(?:[.,]\d+)*")
+# Capitalized words past the first of a request, names of places mostly
+NAME_PATTERN = re.compile(r"(?<=\s)[A-Z][\w-]*")
+
+
+def count_tokens(text: str) -> int:
+    """About the number of tokens of a text."""
+    return len(TOKEN_PATTERN.findall(text))
+
+
+def truncate_tokens(text: str, budget: int) -> str:
+    """The first `budget` tokens of a text."""
+    for i, match in enumerate(TOKEN_PATTERN.finditer(text)):
+        if i == budget:
+            return text[: match.start()].rstrip() + ELLIPSIS
+    return text
+
+
+def _matches(word: str, words: set[str]) -> bool:
+    return any(
+        word == other or len(os.path.commonprefix([word, other])) >= MIN_COMMON_PREFIX
+        for other in words
+    )
+
+
+def _mentioned_values(column: ColumnProfile, words: set[str]) -> list:
+    return [
+        value
+        for value in column.distinct_values or []
+        if (tokens := tokenize(str(value))) and all(t in words for t in tokens)
+    ]
+
+
+def _name_words(words: set[str], columns: list[ColumnProfile]) -> set[str]:
+    """The words of a request that single out columns by their name.
+
+    Words in the names of most columns, like "suitability" in those of every
+    crop, don't tell which columns the request is about.
+    """
+    names = [tokenize(column.name) for column in columns]
+    return {
+        word
+        for word in words
+        if sum(_matches(word, set(name)) for name in names) <= len(columns) // 2
+    }
+
+
+def relevance(column: ColumnProfile, words: set[str], name_words: set[str]) -> int:
+    """2 for a column a request mentions, 1 for one with distinct values, else 0."""
+    if any(_matches(word, name_words) for word in tokenize(column.name)):
+        return 2
+    if _mentioned_values(column, words):
+        return 2
+    return 1 if column.distinct_values is not None else 0
+
+
+def _cap_values(
+    column: ColumnProfile, words: set[str], max_values: int
+) -> ColumnProfile:
+    values = column.distinct_values
+    if values is None or len(values) <= max_values:
+        return column
+    mentioned = _mentioned_values(column, words)
+    values = mentioned + [value for value in values if value not in mentioned]
+    return column.model_copy(
+        update={
+            "distinct_values": [
+                *values[:max_values],
+                f"{ELLIPSIS} {len(values) - max_values} more",
+            ]
+        }
+    )
+
+
+def dataset_context(
+    dataset: dict, profile: DatasetProfile, question: str, settings: Settings
+) -> dict[str, Any]:
+    """The `dataset_info`, `num_rows` and `dataset_profile` of a chart prompt."""
+    words = set(tokenize(question))
+    name_words = _name_words(words, profile.columns)
+    header = count_tokens(describe_dataset(profile, []))
+    budget = settings.prompt_profile_tokens - header
+    kept: dict[str, ColumnProfile] = {}
+    omitted = []
+    ranked = sorted(
+        profile.columns,
+        key=lambda column: relevance(column, words, name_words),
+        reverse=True,
+    )
+    for column in ranked:
+        column = _cap_values(column, words, settings.prompt_max_values)
+        cost = count_tokens(describe_dataset(profile, [column])) - header
+        # The columns a request mentions are described whatever they cost
+        if cost <= budget or relevance(column, words, name_words) == 2:
+            kept[column.name] = column
+            budget -= cost
+        else:
+            omitted.append(column.name)
+    columns = [kept[column.name] for column in profile.columns if column.name in kept]
+
+    info = [
+        f"Name: {dataset.get('name')}",
+        f"Description: {dataset.get('info')}",
+        f"S3 path: {dataset['s3']}",
+    ]
+    if dataset.get("note"):
+        info.append(
+            f"Note: {truncate_tokens(dataset['note'], settings.prompt_note_tokens)}"
+        )
+    if dataset.get("sql"):
+        # Datasets that are views over a shared file are only their filtered
+        # rows, the view is kept whole whatever it costs
+        view = textwrap.dedent(dataset["sql"]).strip()
+        view = view.replace("__s3__", dataset.get("s3", "")).replace(
+            "__name__", dataset.get("name", "dataset")
+        )
+        info.append(
+            "The dataset is this view of the file, queries must keep its"
+            f" filters:\n{view}"
+        )
+    if omitted:
+        names = truncate_tokens(", ".join(omitted), settings.prompt_note_tokens)
+        info.append(f"Other columns, not described here: {names}")
+        logger.info(
+            f"Described {len(columns)} of the {len(profile.columns)} columns of"
+            f" {profile.key}"
+        )
+    return {
+        "dataset_info": "\n".join(info),
+        "num_rows": profile.num_rows,
+        "dataset_profile": describe_dataset(profile, columns),
+    }
+
+
+def request_literals(question: str, profile: DatasetProfile) -> list[str]:
+    """The values of the dataset, names and numbers a request mentions.
+
+    Requests about different ones need different queries, however similar the
+    rest of them reads, e.g. "rainfall in Kenya" and "rainfall in Mozambique".
+    """
+    words = set(tokenize(question))
+    literals = {
+        str(value).lower()
+        for column in profile.columns
+        for value in _mentioned_values(column, words)
+    }
+    literals.update(name.lower() for name in NAME_PATTERN.findall(question))
+    literals.update(NUMBER_PATTERN.findall(question))
+    return sorted(literals)
+
+
+def build_prompt(name: str, template: str, **fields: Any) -> str:
+    """`template` formatted with `fields`, logging its size."""
+    prompt = template.format(**fields)
+    logger.info(f"{name} prompt of {count_tokens(prompt)} tokens")
+    return prompt
@@ -0,0 +1,259 @@
+"""An fsspec filesystem that keeps the byte ranges DuckDB reads on local disk.
+
+Paths look like `s3cache://bucket/key`. Reads are aligned to fixed-size blocks;
+blocks already on disk are served locally and missing ones are fetched from
+the object store with HTTP range requests. Blocks are keyed by the object's
+ETag, so a re-uploaded file is never served from stale blocks.
+
+The size of the cache is kept up to date as blocks are written, the cache
+directory is only walked to evict objects once it's over `max_bytes`, and
+every `RECOUNT_WRITES` writes to count what other processes wrote.
+"""
+
+import contextlib
+import datetime
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.request
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+
+from fsspec import AbstractFileSystem
+from fsspec.spec import AbstractBufferedFile
+
+logger = logging.getLogger(__name__)
+
+PROTOCOL = "s3cache"
+RECOUNT_WRITES = 1000
+
+
+def to_cached_path(s3_path: str) -> str:
+    return PROTOCOL + s3_path.removeprefix("s3")
+
+
+def object_url(s3_path: str, endpoint: str) -> str:
+    """The HTTP URL of an `s3://bucket/key` path, see `RangeCacheFileSystem`."""
+    bucket, _, key = s3_path.split("://", 1)[-1].partition("/")
+    return f"{endpoint.format(bucket=bucket)}/{key}"
+
+
+def head(url: str) -> dict:
+    """Size, ETag and modification time of an object."""
+    request = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(request) as response:
+        headers = response.headers
+    modified = headers.get("Last-Modified")
+    return {
+        "size": int(headers["Content-Length"]),
+        "ETag": (headers.get("ETag") or "").strip('"'),
+        "LastModified": parsedate_to_datetime(modified) if modified else None,
+    }
+
+
+class RangeCacheFile(AbstractBufferedFile):
+    def _fetch_range(self, start: int, end: int) -> bytes:
+        return self.fs.read_range(self.path, start, end)
+
+
+class RangeCacheFileSystem(AbstractFileSystem):
+    """Read-only filesystem with an on-disk block cache in front of S3.
+
+    `endpoint` is a URL template with a `{bucket}` placeholder, objects are
+    fetched from `endpoint/key`.
+    """
+
+    protocol = PROTOCOL
+    cachable = False
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        endpoint: str = "https://{bucket}.s3.amazonaws.com",
+        block_size: int = 1 << 20,
+        max_bytes: int = 10 << 30,
+        info_ttl: float = 300.0,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.cache_dir = Path(cache_dir)
+        self.endpoint = endpoint
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.info_ttl = info_ttl
+        self.bytes_fetched = 0
+        self.bytes_cached = 0
+        self.requests = 0
+        # Bytes of the blocks on disk, None until the directory is walked
+        self._size: int | None = None
+        self._writes = 0
+        self._info: dict[str, tuple[float, dict]] = {}
+        self._lock = threading.Lock()
+
+    def url(self, path: str) -> str:
+        return object_url(self._strip_protocol(path), self.endpoint)
+
+    def _request(self, path: str, **kwargs) -> urllib.request.Request:
+        with self._lock:
+            self.requests += 1
+        return urllib.request.Request(self.url(path), **kwargs)
+
+    def info(self, path: str, **kwargs) -> dict:
+        path = self._strip_protocol(path)
+        cached = self._info.get(path)
+        if cached is not None and time.monotonic() - cached[0] < self.info_ttl:
+            return cached[1]
+        with self._lock:
+            self.requests += 1
+        info = {"name": path, "type": "file", **head(self.url(path))}
+        self._info[path] = (time.monotonic(), info)
+        return info
+
+    def ls(self, path: str, detail: bool = True, **kwargs) -> list:
+        info = self.info(path)
+        return [info] if detail else [info["name"]]
+
+    def glob(self, path: str, **kwargs) -> list[str]:
+        return [self._strip_protocol(path)]
+
+    def modified(self, path: str) -> datetime.datetime:
+        return self.info(path)["LastModified"] or datetime.datetime.now(datetime.UTC)
+
+    def _open(self, path: str, mode: str = "rb", **kwargs) -> RangeCacheFile:
+        if mode != "rb":
+            raise NotImplementedError("s3cache:// is read-only")
+        return RangeCacheFile(
+            self,
+            path,
+            mode,
+            block_size=self.block_size,
+            cache_type="none",
+            size=self.info(path)["size"],
+        )
+
+    def _blocks_dir(self, path: str) -> Path:
+        info = self.info(path)
+        version = f"{path}\0{info['ETag']}\0{info['size']}"
+        return self.cache_dir / hashlib.sha256(version.encode()).hexdigest()[:32]
+
+    def _fetch(self, path: str, start: int, end: int) -> bytes:
+        request = self._request(path, headers={"Range": f"bytes={start}-{end - 1}"})
+        with urllib.request.urlopen(request) as response:
+            data = response.read()
+        with self._lock:
+            self.bytes_fetched += len(data)
+        return data
+
+    def read_range(self, path: str, start: int, end: int) -> bytes:
+        """Bytes `[start, end)` of the object, through the block cache."""
+        size = self.info(path)["size"]
+        end = min(end, size)
+        if start >= end:
+            return b""
+        blocks_dir = self._blocks_dir(path)
+        first, last = start // self.block_size, (end - 1) // self.block_size
+        blocks: dict[int, bytes] = {}
+        missing: list[int] = []
+        for index in range(first, last + 1):
+            try:
+                blocks[index] = (blocks_dir / str(index)).read_bytes()
+            except FileNotFoundError:
+                missing.append(index)
+        if blocks:
+            # The directory's mtime is the object's last use, see `prune`
+            with contextlib.suppress(FileNotFoundError):
+                os.utime(blocks_dir)
+        with self._lock:
+            self.bytes_cached += sum(len(block) for block in blocks.values())
+
+        # Fetch runs of consecutive missing blocks with one request each
+        runs: list[list[int]] = []
+        for index in missing:
+            if runs and runs[-1][-1] == index - 1:
+                runs[-1].append(index)
+            else:
+                runs.append([index])
+        if runs:
+            blocks_dir.mkdir(parents=True, exist_ok=True)
+        written = 0
+        for run in runs:
+            run_start = run[0] * self.block_size
+            run_end = min((run[-1] + 1) * self.block_size, size)
+            data = self._fetch(path, run_start, run_end)
+            for index in run:
+                offset = (index - run[0]) * self.block_size
+                blocks[index] = data[offset : offset + self.block_size]
+                self._write_block(blocks_dir / str(index), blocks[index])
+                written += len(blocks[index])
+        if runs:
+            self._account(len(missing), written)
+
+        data = b"".join(blocks[index] for index in range(first, last + 1))
+        offset = first * self.block_size
+        return data[start - offset : end - offset]
+
+    def _write_block(self, path: Path, data: bytes) -> None:
+        fd, tmp = tempfile.mkstemp(dir=path.parent)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _account(self, blocks: int, written: int) -> None:
+        """Count written blocks, pruning once over `max_bytes`."""
+        with self._lock:
+            self._writes += blocks
+            recount = self._size is None or self._writes >= RECOUNT_WRITES
+            if not recount:
+                self._size += written
+            if not recount and self._size <= self.max_bytes:
+                return
+        self.prune()
+
+    def _objects(self) -> list[tuple[float, int, Path]]:
+        """Time of the last use, size and directory of the cached objects."""
+        objects = []
+        try:
+            blocks_dirs = list(self.cache_dir.iterdir())
+        except FileNotFoundError:
+            return objects
+        for blocks_dir in blocks_dirs:
+            try:
+                # Touched by reads, and by the blocks written in it
+                mtime = blocks_dir.stat().st_mtime
+                files = list(blocks_dir.iterdir())
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            size = 0
+            for f in files:
+                try:
+                    size += f.stat().st_size
+                except FileNotFoundError:
+                    # Evicted, or a temporary file renamed, by another reader
+                    continue
+            objects.append((mtime, size, blocks_dir))
+        return objects
+
+    def prune(self) -> None:
+        """Drop the least recently used objects once over `max_bytes`."""
+        objects = self._objects()
+        total = sum(size for _, size, _ in objects)
+        for _, size, blocks_dir in sorted(objects):
+            if total <= self.max_bytes:
+                break
+            logger.info(f"Evicting {blocks_dir.name} from the range cache")
+            shutil.rmtree(blocks_dir, ignore_errors=True)
+            total -= size
+        with self._lock:
+            self._size = total
+            self._writes = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "requests": self.requests,
+            "bytes_fetched": self.bytes_fetched,
+            "bytes_cached": self.bytes_cached,
+        }
@@ -0,0 +1,87 @@
+"""Short previews of the state updates of the agent, for the UI.
+
+An update can hold a whole figure, chart data or dataset. Serializing it only
+to show its first 500 characters costs as much as the value is large, so
+values are described from their type and size instead, without walking them.
+"""
+
+from typing import Any
+
+from .blobs import BlobRef
+
+# Characters of a string shown in a preview
+MAX_TEXT = 80
+# Fields of a dict shown in a preview
+MAX_FIELDS = 6
+
+
+def _blob(value: Any) -> BlobRef | None:
+    if isinstance(value, BlobRef):
+        return value
+    if isinstance(value, dict) and set(value) == {"blob", "size", "media_type"}:
+        return BlobRef(**value)
+    return None
+
+
+def _bytes(size: int) -> str:
+    for unit in ["B", "kB", "MB"]:
+        if size < 1000:
+            return f"{size:.0f} {unit}"
+        size /= 1000
+    return f"{size:.0f} GB"
+
+
+def _text(text: str) -> str:
+    if len(text) <= MAX_TEXT:
+        return repr(text)
+    return repr(text[:MAX_TEXT]) + f"… ({len(text)} chars)"
+
+
+def summarize(value: Any, depth: int = 1) -> str:
+    """A one line description of a value, from its type and size."""
+    blob = _blob(value)
+    if blob is not None:
+        return f"<stored {blob.media_type}, {_bytes(blob.size)}>"
+    if isinstance(value, str):
+        return _text(value)
+    if value is None or isinstance(value, bool | int | float):
+        return repr(value)
+    if isinstance(value, dict):
+        if "data" in value and "layout" in value:
+            types = {trace.get("type", "?") for trace in value["data"]}
+            return f"<figure, {len(value['data'])} traces: {', '.join(sorted(types))}>"
+        if "columns" in value and "num_rows" in value:
+            return (
+                f"<table, {value['num_rows']} rows x {len(value['columns'])} columns>"
+            )
+        if depth <= 0 or len(value) > MAX_FIELDS:
+            return f"{{{len(value)} fields}}"
+        fields = ", ".join(
+            f"{key}: {summarize(field, depth - 1)}" for key, field in value.items()
+        )
+        return f"{{{fields}}}"
+    if isinstance(value, list | tuple):
+        if not value:
+            return "[]"
+        return f"[{len(value)} items, first {summarize(value[0], 0)}]"
+    return f"<{type(value).__name__}>"
+
+
+def describe_update(values: dict[str, Any], limit: int = 500) -> str:
+    """The fields of a state update, one per line, cut at `limit` characters."""
+    lines = []
+    size = 0
+    for key, value in values.items():
+        line = f"{key}: {summarize(value)}"
+        if size + len(line) > limit:
+            lines.append(f"… and {len(values) - len(lines)} more fields")
+            break
+        lines.append(line)
+        size += len(line) + 1
+    return "\n".join(lines)
+
+
+def chart_key(chart: Any) -> str:
+    """What tells charts apart, to show each one once."""
+    blob = _blob(chart)
+    return blob.blob if blob is not None else str(id(chart))
@@ -0,0 +1,235 @@
+"""Cache of query results, in front of DuckDB.
+
+Results are keyed by the canonical form of the SQL and the version of every
+parquet file it reads (ETag and size on S3, mtime and size locally), so a
+re-uploaded dataset never serves stale results. They are stored as Arrow IPC
+in a byte-budgeted in-memory LRU and, optionally, in a directory on disk so
+that they survive restarts.
+
+The size of both tiers is kept up to date as results are stored, the disk
+directory is only walked to evict results once it's over `disk_bytes`, and
+every `RECOUNT_PUTS` writes to count what other processes wrote.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import pyarrow as pa
+
+from .range_cache import head, object_url
+
+logger = logging.getLogger(__name__)
+
+LITERAL_PATTERN = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+PARQUET_PATH_PATTERN = re.compile(r"['\"]([^'\"]+\.parquet)['\"]", re.IGNORECASE)
+RECOUNT_PUTS = 100
+
+
+def canonicalize_sql(sql: str) -> str:
+    """Collapse whitespace and lowercase everything but quoted literals."""
+    parts = LITERAL_PATTERN.split(sql.strip().rstrip(";"))
+    return "".join(
+        part if i % 2 else re.sub(r"\s+", " ", part.lower())
+        for i, part in enumerate(parts)
+    ).strip()
+
+
+def referenced_files(sql: str) -> list[str]:
+    return sorted(set(PARQUET_PATH_PATTERN.findall(sql)))
+
+
+def file_version(path: str, s3_endpoint: str) -> str:
+    """A string that changes whenever the file at `path` changes."""
+    if "://" in path:
+        info = head(object_url(path, s3_endpoint))
+        return f"{info['ETag']}-{info['size']}"
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def to_ipc(table: pa.Table) -> bytes:
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def from_ipc(data: bytes) -> pa.Table:
+    return pa.ipc.open_stream(data).read_all()
+
+
+class ResultCache:
+    """Byte-budgeted LRU of query results, optionally persisted to `path`."""
+
+    def __init__(
+        self,
+        path: Path | None = None,
+        memory_bytes: int = 256 * 1024**2,
+        disk_bytes: int = 2 * 1024**3,
+        s3_endpoint: str = "https://{bucket}.s3.amazonaws.com",
+        version_ttl: float = 60.0,
+    ):
+        self.path = path
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.s3_endpoint = s3_endpoint
+        self.version_ttl = version_ttl
+        self.memory: OrderedDict[str, tuple[bytes, float]] = OrderedDict()
+        self.memory_size = 0
+        # Bytes of the results on disk, None until the directory is walked
+        self.disk_size: int | None = None
+        self._disk_puts = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.seconds_saved = 0.0
+        self._versions: dict[str, tuple[float, str]] = {}
+        self._lock = threading.Lock()
+
+    def file_version(self, path: str) -> str:
+        """The version of a file, rechecked every `version_ttl` seconds."""
+        cached = self._versions.get(path)
+        if cached is not None and time.monotonic() - cached[0] < self.version_ttl:
+            return cached[1]
+        version = file_version(path, self.s3_endpoint)
+        self._versions[path] = (time.monotonic(), version)
+        return version
+
+    def key(self, sql: str) -> str | None:
+        """The cache key of a query, None if what it reads can't be versioned."""
+        canonical = canonicalize_sql(sql)
+        if not canonical.startswith(("select", "with", "from", "(")):
+            return None
+        files = referenced_files(sql)
+        if not files:
+            return None
+        try:
+            versions = [f"{path}={self.file_version(path)}" for path in files]
+        except OSError as e:
+            logger.warning(f"Can't version the files read by the query: {e}")
+            return None
+        material = "\0".join([canonical, *versions])
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def _disk_path(self, key: str) -> Path:
+        assert self.path is not None
+        return self.path / f"{key}.arrow"
+
+    def get(self, key: str) -> pa.Table | None:
+        with self._lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+        if entry is None and self.path is not None:
+            disk_path = self._disk_path(key)
+            try:
+                data = disk_path.read_bytes()
+                os.utime(disk_path)
+            except FileNotFoundError:
+                pass
+            else:
+                entry = (data, _elapsed(data))
+                self._remember(key, entry)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.seconds_saved += entry[1]
+        return from_ipc(entry[0])
+
+    def put(self, key: str, table: pa.Table, elapsed: float = 0.0) -> None:
+        table = table.replace_schema_metadata(
+            {**(table.schema.metadata or {}), b"elapsed": str(elapsed).encode()}
+        )
+        data = to_ipc(table)
+        self._remember(key, (data, elapsed))
+        if self.path is not None and len(data) <= self.disk_bytes:
+            disk_path = self._disk_path(key)
+            self.path.mkdir(parents=True, exist_ok=True)
+            try:
+                replaced = disk_path.stat().st_size
+            except FileNotFoundError:
+                replaced = 0
+            tmp = disk_path.with_suffix(f".{threading.get_ident()}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, disk_path)
+            self._account_disk(len(data) - replaced)
+
+    def _remember(self, key: str, entry: tuple[bytes, float]) -> None:
+        if len(entry[0]) > self.memory_bytes:
+            return
+        with self._lock:
+            replaced = self.memory.get(key)
+            if replaced is not None:
+                self.memory_size -= len(replaced[0])
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            self.memory_size += len(entry[0])
+            while self.memory_size > self.memory_bytes:
+                _, (data, _) = self.memory.popitem(last=False)
+                self.memory_size -= len(data)
+                self.evictions += 1
+
+    def _account_disk(self, written: int) -> None:
+        """Count a result written to disk, pruning once over `disk_bytes`."""
+        with self._lock:
+            self._disk_puts += 1
+            recount = self.disk_size is None or self._disk_puts >= RECOUNT_PUTS
+            if not recount:
+                self.disk_size += written
+            if not recount and self.disk_size <= self.disk_bytes:
+                return
+        self._prune_disk()
+
+    def _prune_disk(self) -> None:
+        """Drop the least recently used results once over `disk_bytes`."""
+        files = []
+        for file in self.path.glob("*.arrow"):
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, file))
+        total = sum(size for _, size, _ in files)
+        for _, size, file in sorted(files):
+            if total <= self.disk_bytes:
+                break
+            file.unlink(missing_ok=True)
+            total -= size
+        with self._lock:
+            self.disk_size = total
+            self._disk_puts = 0
+
+    def clear(self) -> None:
+        with self._lock:
+            self.memory.clear()
+            self.memory_size = 0
+            self.disk_size = None
+        if self.path is not None:
+            for file in self.path.glob("*.arrow"):
+                file.unlink(missing_ok=True)
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_size,
+                "seconds_saved": self.seconds_saved,
+            }
+
+
+def _elapsed(data: bytes) -> float:
+    metadata = pa.ipc.open_stream(data).schema.metadata or {}
+    return float(metadata.get(b"elapsed", 0.0))
@@ -0,0 +1,249 @@
+"""In-process dataset retrieval.
+
+There are only a few dozen datasets, so their embeddings fit in one small
+matrix and a search is a single matrix product. The lexical scorer (BM25 over
+the name, info and note of each dataset) answers without calling the
+embeddings API at all; the hybrid mode only embeds the query when the lexical
+answer is ambiguous.
+"""
+
+import asyncio
+import logging
+import re
+import threading
+from collections import Counter
+from typing import TYPE_CHECKING, Literal
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from .settings import Settings
+from .vectorstore import get_datasets_vectorstore
+
+if TYPE_CHECKING:
+    from langchain_chroma import Chroma
+
+logger = logging.getLogger(__name__)
+
+RetrieverMode = Literal["vector", "lexical", "hybrid"]
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    [
+        "a",
+        "about",
+        "all",
+        "an",
+        "and",
+        "any",
+        "are",
+        "as",
+        "at",
+        "be",
+        "by",
+        "can",
+        "data",
+        "dataset",
+        "do",
+        "for",
+        "from",
+        "give",
+        "have",
+        "how",
+        "i",
+        "in",
+        "info",
+        "is",
+        "it",
+        "me",
+        "more",
+        "name",
+        "note",
+        "of",
+        "on",
+        "or",
+        "over",
+        "plot",
+        "show",
+        "some",
+        "that",
+        "the",
+        "this",
+        "to",
+        "use",
+        "used",
+        "what",
+        "which",
+        "with",
+        "you",
+    ]
+)
+
+
+def tokenize(text: str) -> list[str]:
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in STOPWORDS]
+
+
+def top_k(scores: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Indices and scores of the k best columns of each row, best first."""
+    k = min(k, scores.shape[1])
+    indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(scores, indices, axis=1)
+    order = np.argsort(-top, axis=1)
+    return (
+        np.take_along_axis(indices, order, axis=1),
+        np.take_along_axis(top, order, axis=1),
+    )
+
+
+class LexicalScorer:
+    """BM25 over the dataset documents."""
+
+    def __init__(self, texts: list[str], k1: float = 1.5, b: float = 0.75):
+        tokenized = [tokenize(text) for text in texts]
+        self.vocabulary = {
+            term: i
+            for i, term in enumerate(sorted({t for doc in tokenized for t in doc}))
+        }
+        n_docs = len(texts)
+        term_frequencies = np.zeros((len(self.vocabulary), n_docs), dtype=np.float32)
+        for j, doc in enumerate(tokenized):
+            for term, count in Counter(doc).items():
+                term_frequencies[self.vocabulary[term], j] = count
+
+        lengths = np.array([len(doc) for doc in tokenized], dtype=np.float32)
+        norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1.0))
+        document_frequency = (term_frequencies > 0).sum(axis=1)
+        idf = np.log(
+            1 + (n_docs - document_frequency + 0.5) / (document_frequency + 0.5)
+        )
+        # Precompute the whole BM25 weight per (term, document)
+        self.weights = (
+            idf[:, None]
+            * term_frequencies
+            * (k1 + 1)
+            / (term_frequencies + norm[None, :])
+        ).astype(np.float32)
+
+    def score(self, query: str) -> np.ndarray:
+        rows = [self.vocabulary[t] for t in tokenize(query) if t in self.vocabulary]
+        if not rows:
+            return np.zeros(self.weights.shape[1], dtype=np.float32)
+        return self.weights[rows].sum(axis=0)
+
+
+class DatasetRetriever:
+    """Cosine, BM25 or hybrid top-k search over the datasets.
+
+    Scores are similarities, higher is better (unlike the distances returned
+    by `Chroma.similarity_search_with_score`).
+    """
+
+    def __init__(
+        self,
+        documents: list[Document],
+        embeddings: np.ndarray,
+        embedder: Embeddings,
+        mode: RetrieverMode = "vector",
+        hybrid_margin: float = 0.3,
+    ):
+        self.documents = documents
+        self.embedder = embedder
+        self.mode = mode
+        self.hybrid_margin = hybrid_margin
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        self.matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True).clip(1e-12)
+        self.lexical = LexicalScorer([doc.page_content for doc in documents])
+        self.embedding_calls = 0
+
+    @classmethod
+    def from_vectorstore(
+        cls, vectorstore: "Chroma", mode: RetrieverMode, hybrid_margin: float
+    ) -> "DatasetRetriever":
+        collection = vectorstore.get(include=["embeddings", "metadatas", "documents"])
+        documents = [
+            Document(id=id_, page_content=text, metadata=metadata or {})
+            for id_, text, metadata in zip(
+                collection["ids"],
+                collection["documents"],
+                collection["metadatas"],
+                strict=True,
+            )
+        ]
+        return cls(
+            documents,
+            collection["embeddings"],
+            vectorstore.embeddings,
+            mode=mode,
+            hybrid_margin=hybrid_margin,
+        )
+
+    def _results(
+        self, indices: np.ndarray, scores: np.ndarray
+    ) -> list[tuple[Document, float]]:
+        return [
+            (self.documents[i], float(s)) for i, s in zip(indices, scores, strict=True)
+        ]
+
+    def search_by_vectors(
+        self, vectors: np.ndarray, k: int = 3
+    ) -> list[list[tuple[Document, float]]]:
+        """Batched cosine top-k, one result list per query vector."""
+        queries = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True).clip(1e-12)
+        indices, scores = top_k(queries @ self.matrix.T, k)
+        return [self._results(i, s) for i, s in zip(indices, scores, strict=True)]
+
+    def search_lexical(self, query: str, k: int = 3) -> list[tuple[Document, float]]:
+        indices, scores = top_k(self.lexical.score(query)[None, :], k)
+        return self._results(indices[0], scores[0])
+
+    def is_confident(self, results: list[tuple[Document, float]]) -> bool:
+        """Whether the best lexical match clearly beats the runner-up."""
+        if not results or results[0][1] <= 0:
+            return False
+        if len(results) == 1:
+            return True
+        best, runner_up = results[0][1], results[1][1]
+        return (best - runner_up) / best >= self.hybrid_margin
+
+    async def _search_vector(self, query: str, k: int) -> list[tuple[Document, float]]:
+        self.embedding_calls += 1
+        vector = await self.embedder.aembed_query(query)
+        return self.search_by_vectors(np.asarray(vector), k)[0]
+
+    async def asearch(self, query: str, k: int = 3) -> list[tuple[Document, float]]:
+        if self.mode == "vector":
+            return await self._search_vector(query, k)
+        lexical = self.search_lexical(query, k)
+        if self.mode == "lexical" or self.is_confident(lexical):
+            return lexical
+        logger.info(f"Lexical match for {query!r} is ambiguous, embedding the query")
+        return await self._search_vector(query, k)
+
+
+_retriever: DatasetRetriever | None = None
+_retriever_source: "Chroma | None" = None
+_retriever_lock = threading.Lock()
+
+
+def _build_retriever(settings: Settings, vectorstore: "Chroma") -> DatasetRetriever:
+    global _retriever, _retriever_source
+    with _retriever_lock:
+        if _retriever is None or _retriever_source is not vectorstore:
+            _retriever = DatasetRetriever.from_vectorstore(
+                vectorstore,
+                mode=settings.dataset_retriever,  # type: ignore
+                hybrid_margin=settings.hybrid_lexical_margin,
+            )
+            _retriever_source = vectorstore
+        return _retriever
+
+
+async def get_dataset_retriever(settings: Settings) -> DatasetRetriever:
+    """Return the shared retriever, rebuilt whenever the vector store is reloaded."""
+    vectorstore = await get_datasets_vectorstore(settings)
+    if _retriever is not None and _retriever_source is vectorstore:
+        return _retriever
+    return await asyncio.to_thread(_build_retriever, settings, vectorstore)
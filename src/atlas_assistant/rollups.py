@@ -0,0 +1,620 @@
+"""Pre-aggregated rollups of the datasets, and routing of chart queries to them.
+
+Most chart queries aggregate a dataset per country or region, scenario and
+time period. A rollup holds, per group of `rollup_levels` columns, the row
+count and the sum, count, min and max of every numeric column, which is all it
+takes to answer `sum`, `avg`, `min`, `max` and `count` over those groups. The
+rollups are written by `scripts/build_rollups.py`, along with the version of
+the file they were computed from.
+
+`RollupRouter` parses a query with DuckDB's own parser. If it only groups and
+filters by columns of a rollup and only aggregates in those ways, it is
+rewritten to read the smallest such rollup. Anything else, or a failure of the
+rewritten query, runs the original query on the detailed data.
+"""
+
+import asyncio
+import copy
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from functools import lru_cache
+from pathlib import Path
+from typing import Any
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pydantic import BaseModel, Field
+
+from . import engine
+from .catalog import (
+    FLOAT_TYPES,
+    INTEGER_TYPES,
+    DatasetProfile,
+    get_dataset_profile,
+)
+from .result_cache import file_version
+from .settings import Settings, get_settings
+
+logger = logging.getLogger(__name__)
+
+# Bump when the rollups change, older ones are then rebuilt
+ROLLUP_VERSION = 1
+# A rollup with more rows than this fraction of its dataset isn't worth keeping
+MAX_ROLLUP_RATIO = 0.5
+ROWS_COLUMN = "__rows"
+MEASURE_AGGREGATES = ["sum", "count", "min", "max"]
+
+
+class Rollup(BaseModel):
+    path: str
+    dimensions: list[str]
+    measures: list[str]
+    num_rows: int
+
+
+class DatasetRollups(BaseModel):
+    s3: str
+    file_version: str
+    rollups: list[Rollup]
+
+
+class RollupManifest(BaseModel):
+    version: int = ROLLUP_VERSION
+    datasets: dict[str, DatasetRollups] = Field(default_factory=dict)
+
+
+class NotRoutable(Exception):
+    pass
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def measure_column(measure: str, aggregate: str) -> str:
+    return f"{measure}__{aggregate}"
+
+
+def rollup_columns(
+    profile: DatasetProfile, levels: list[list[str]]
+) -> tuple[list[list[str]], list[str]]:
+    """The group by columns of each rollup of a dataset, and its measures.
+
+    Low cardinality columns outside of `levels`, e.g. a crop or a variable,
+    are grouped by at every level.
+    """
+    names = [column.name for column in profile.columns]
+    level_columns = {name for level in levels for name in level}
+    categories = [
+        column.name
+        for column in profile.columns
+        if column.distinct_values is not None and column.name not in level_columns
+    ]
+    dimension_sets = []
+    for level in levels:
+        dimensions = [name for name in level if name in names] + categories
+        if dimensions and dimensions not in dimension_sets:
+            dimension_sets.append(dimensions)
+    all_dimensions = {name for dimensions in dimension_sets for name in dimensions}
+    measures = [
+        column.name
+        for column in profile.columns
+        if column.type.split("(")[0] in INTEGER_TYPES | FLOAT_TYPES
+        and column.name not in all_dimensions
+    ]
+    return dimension_sets, measures
+
+
+def build_rollups(
+    dataset: dict,
+    profile: DatasetProfile,
+    settings: Settings | None = None,
+    version: str | None = None,
+) -> DatasetRollups:
+    """Compute and write the rollups of a dataset, blocking."""
+    settings = settings or get_settings()
+    path = dataset["s3"]
+    version = version or file_version(path, settings.duckdb_s3_endpoint)
+    dimension_sets, measures = rollup_columns(profile, settings.rollup_levels)
+    directory = settings.rollup_dir / profile.key
+    directory.mkdir(parents=True, exist_ok=True)
+
+    rollups = []
+    for i, dimensions in enumerate(dimension_sets):
+        aggregates = [f"count(*) AS {_quote(ROWS_COLUMN)}"] + [
+            f"{aggregate}({_quote(measure)})"
+            f" AS {_quote(measure_column(measure, aggregate))}"
+            for measure in measures
+            for aggregate in MEASURE_AGGREGATES
+        ]
+        table = engine.fetch_table(
+            f"""
+            SELECT {", ".join(map(_quote, dimensions))}, {", ".join(aggregates)}
+            FROM '{path}'
+            GROUP BY ALL
+            ORDER BY ALL
+            """,
+            settings,
+        )
+        if table.num_rows > MAX_ROLLUP_RATIO * profile.num_rows:
+            logger.info(
+                f"Skipping the {dimensions} rollup of {profile.key},"
+                f" {table.num_rows} rows out of {profile.num_rows}"
+            )
+            continue
+        rollup_path = directory / f"{i}.parquet"
+        tmp = rollup_path.with_suffix(f".{threading.get_ident()}.tmp")
+        pq.write_table(table, tmp)
+        os.replace(tmp, rollup_path)
+        rollups.append(
+            Rollup(
+                path=str(rollup_path),
+                dimensions=dimensions,
+                measures=measures,
+                num_rows=table.num_rows,
+            )
+        )
+    return DatasetRollups(s3=path, file_version=version, rollups=rollups)
+
+
+async def refresh_rollups(
+    datasets: list[dict],
+    settings: Settings | None = None,
+    manifest: RollupManifest | None = None,
+) -> RollupManifest:
+    """Rebuild the rollups of the datasets whose file changed, concurrently."""
+    settings = settings or get_settings()
+    if manifest is None or manifest.version != ROLLUP_VERSION:
+        manifest = RollupManifest()
+    loop = asyncio.get_running_loop()
+    executor = engine.get_executor(settings)
+
+    async def refresh(dataset: dict) -> tuple[str, DatasetRollups | None]:
+        key = dataset.get("key", dataset["s3"])
+        previous = manifest.datasets.get(key)
+        try:
+            version = await loop.run_in_executor(
+                executor, file_version, dataset["s3"], settings.duckdb_s3_endpoint
+            )
+            if (
+                previous is not None
+                and previous.s3 == dataset["s3"]
+                and previous.file_version == version
+            ):
+                return key, previous
+            profile = await get_dataset_profile(dataset, settings)
+            return key, await loop.run_in_executor(
+                executor, build_rollups, dataset, profile, settings, version
+            )
+        except Exception as e:
+            # Stale rollups are never routed to, no need to keep them
+            logger.warning(f"Can't build the rollups of {dataset['s3']}: {e}")
+            return key, None
+
+    results = await asyncio.gather(*(refresh(dataset) for dataset in datasets))
+    return RollupManifest(
+        datasets={key: rollups for key, rollups in results if rollups is not None}
+    )
+
+
+def load_manifest(path: Path) -> RollupManifest:
+    try:
+        return RollupManifest.model_validate_json(path.read_bytes())
+    except FileNotFoundError:
+        return RollupManifest()
+
+
+def save_manifest(manifest: RollupManifest, path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(manifest.model_dump_json(indent=1))
+    os.replace(tmp, path)
+
+
+@lru_cache
+def _aggregate_functions() -> frozenset[str]:
+    with duckdb.connect() as conn:
+        rows = conn.execute(
+            "SELECT DISTINCT function_name FROM duckdb_functions()"
+            " WHERE function_type = 'aggregate'"
+        ).fetchall()
+    return frozenset(name for (name,) in rows) | {"count_star"}
+
+
+def _parse(conn: duckdb.DuckDBPyConnection, sql: str) -> dict[str, Any]:
+    parsed = json.loads(
+        conn.execute("SELECT json_serialize_sql(?)", [sql]).fetchone()[0]
+    )
+    if parsed["error"]:
+        raise NotRoutable(parsed.get("error_message", "can't parse the query"))
+    return parsed
+
+
+def _render(conn: duckdb.DuckDBPyConnection, parsed: dict[str, Any]) -> str:
+    return conn.execute(
+        "SELECT json_deserialize_sql(?)", [json.dumps(parsed)]
+    ).fetchone()[0]
+
+
+def _column_ref(name: str) -> dict[str, Any]:
+    return {
+        "class": "COLUMN_REF",
+        "type": "COLUMN_REF",
+        "alias": "",
+        "query_location": 0,
+        "column_names": [name],
+    }
+
+
+class _QueryRewriter:
+    """Rewrites the aggregates of a query over a dataset into ones over a rollup.
+
+    Records the dimensions and measures the query needs along the way.
+    """
+
+    def __init__(self, dimensions: set[str], measures: set[str]):
+        self.dimensions = dimensions
+        self.measures = measures
+        self.aliases: set[str] = set()
+        self.needed_dimensions: set[str] = set()
+        self.needed_measures: set[str] = set()
+        self.aggregates = 0
+
+    def column(self, node: dict, allow_aliases: bool) -> None:
+        name = node["column_names"][-1]
+        if allow_aliases and name in self.aliases:
+            return
+        if name not in self.dimensions:
+            raise NotRoutable(f"{name} is not a dimension of the rollups")
+        self.needed_dimensions.add(name)
+
+    def aggregate(self, node: dict) -> dict:
+        name = node["function_name"].lower()
+        children = node["children"]
+        if node["filter"] is not None or node["order_bys"]["orders"]:
+            raise NotRoutable(f"{name} has a FILTER or ORDER BY")
+        if name in ("count_star", "count") and not children:
+            self.aggregates += 1
+            return self.count(ROWS_COLUMN, node)
+        if len(children) != 1 or children[0]["class"] != "COLUMN_REF":
+            raise NotRoutable(f"{name} is not over a single column")
+        column = children[0]["column_names"][-1]
+        self.aggregates += 1
+        if column in self.dimensions and (
+            name in ("min", "max") or (name == "count" and node["distinct"])
+        ):
+            # Aggregates of the group by columns themselves are the same
+            self.needed_dimensions.add(column)
+            return node
+        if column not in self.measures:
+            raise NotRoutable(f"{name}({column}) can't be computed from the rollups")
+        if node["distinct"]:
+            raise NotRoutable(f"{name}(DISTINCT {column})")
+        self.needed_measures.add(column)
+        if name in ("sum", "min", "max"):
+            rewritten = copy.deepcopy(node)
+            rewritten["children"] = [_column_ref(measure_column(column, name))]
+            return rewritten
+        if name == "count":
+            return self.count(measure_column(column, "count"), node)
+        if name in ("avg", "mean"):
+            return {
+                "class": "FUNCTION",
+                "type": "FUNCTION",
+                "alias": node["alias"],
+                "query_location": 0,
+                "function_name": "/",
+                "schema": "",
+                "children": [
+                    self.sum(measure_column(column, "sum"), node, alias=""),
+                    self.sum(measure_column(column, "count"), node, alias=""),
+                ],
+                "filter": None,
+                "order_bys": {"type": "ORDER_MODIFIER", "orders": []},
+                "distinct": False,
+                "is_operator": True,
+                "export_state": False,
+                "catalog": "",
+            }
+        raise NotRoutable(f"{name} can't be computed from the rollups")
+
+    @staticmethod
+    def sum(column: str, node: dict, alias: str | None = None) -> dict:
+        rewritten = copy.deepcopy(node)
+        rewritten.update(
+            function_name="sum",
+            children=[_column_ref(column)],
+            distinct=False,
+            alias=node["alias"] if alias is None else alias,
+        )
+        return rewritten
+
+    @classmethod
+    def count(cls, column: str, node: dict) -> dict:
+        """The sum of counts, as a BIGINT like `count` returns."""
+        return {
+            "class": "CAST",
+            "type": "OPERATOR_CAST",
+            "alias": node["alias"],
+            "query_location": 0,
+            "child": cls.sum(column, node, alias=""),
+            "cast_type": {"id": "BIGINT", "type_info": None},
+            "try_cast": False,
+        }
+
+    def rewrite(self, node: Any, allow_aliases: bool) -> Any:
+        """Rewrite an expression and what's under it."""
+        if isinstance(node, list):
+            return [self.rewrite(child, allow_aliases) for child in node]
+        if not isinstance(node, dict):
+            return node
+        node_class = node.get("class")
+        if node_class == "COLUMN_REF":
+            self.column(node, allow_aliases)
+            return node
+        if node_class in ("SUBQUERY", "WINDOW", "STAR", "LAMBDA"):
+            raise NotRoutable(f"{node_class} expressions aren't routed")
+        if (
+            node_class == "FUNCTION"
+            and node["function_name"].lower() in _aggregate_functions()
+        ):
+            return self.aggregate(node)
+        return {key: self.rewrite(value, allow_aliases) for key, value in node.items()}
+
+
+def _table_path(from_table: dict) -> str:
+    if from_table["type"] == "BASE_TABLE" and not from_table["schema_name"]:
+        return from_table["table_name"]
+    if from_table["type"] == "TABLE_FUNCTION":
+        function = from_table["function"]
+        children = function["children"]
+        if (
+            function["function_name"] in ("read_parquet", "parquet_scan")
+            and len(children) == 1
+            and children[0]["class"] == "CONSTANT"
+        ):
+            return children[0]["value"]["value"]
+    raise NotRoutable("the query doesn't read a single parquet file")
+
+
+def rewrite_for_rollups(
+    conn: duckdb.DuckDBPyConnection, sql: str, rollups: DatasetRollups
+) -> str:
+    """The query over the smallest rollup that can answer it.
+
+    Raises `NotRoutable` when none can.
+    """
+    parsed = _parse(conn, sql)
+    if len(parsed["statements"]) != 1:
+        raise NotRoutable("not a single statement")
+    node = parsed["statements"][0]["node"]
+    if node["type"] != "SELECT_NODE" or node["cte_map"]["map"]:
+        raise NotRoutable("not a plain SELECT")
+    if node["sample"] is not None or node["qualify"] is not None:
+        raise NotRoutable("SAMPLE and QUALIFY aren't routed")
+    if _table_path(node["from_table"]) != rollups.s3:
+        raise NotRoutable("the query doesn't read the dataset")
+
+    dimensions = {name for rollup in rollups.rollups for name in rollup.dimensions}
+    measures = {name for rollup in rollups.rollups for name in rollup.measures}
+    rewriter = _QueryRewriter(dimensions, measures)
+    rewriter.aliases = {
+        expression["alias"] for expression in node["select_list"] if expression["alias"]
+    }
+    select_list = []
+    for expression in node["select_list"]:
+        aggregates = rewriter.aggregates
+        rewritten = rewriter.rewrite(expression, allow_aliases=False)
+        if rewriter.aggregates > aggregates and not expression["alias"]:
+            # Keep the name DuckDB gives the original expression
+            single = copy.deepcopy(parsed)
+            single_node = single["statements"][0]["node"]
+            single_node.update(
+                select_list=[expression],
+                from_table={
+                    "type": "EMPTY",
+                    "alias": "",
+                    "sample": None,
+                    "query_location": 0,
+                },
+                where_clause=None,
+                group_expressions=[],
+                group_sets=[],
+                aggregate_handling="STANDARD_HANDLING",
+                having=None,
+                modifiers=[],
+            )
+            rewritten["alias"] = _render(conn, single).removeprefix("SELECT ")
+        select_list.append(rewritten)
+    node["select_list"] = select_list
+    node["where_clause"] = rewriter.rewrite(node["where_clause"], allow_aliases=False)
+    node["group_expressions"] = rewriter.rewrite(
+        node["group_expressions"], allow_aliases=False
+    )
+    node["having"] = rewriter.rewrite(node["having"], allow_aliases=True)
+    node["modifiers"] = rewriter.rewrite(node["modifiers"], allow_aliases=True)
+    grouped = bool(node["group_expressions"]) or any(
+        modifier["type"] == "DISTINCT_MODIFIER" for modifier in node["modifiers"]
+    )
+    if not grouped and rewriter.aggregates == 0:
+        raise NotRoutable("the query doesn't aggregate")
+
+    candidates = [
+        rollup
+        for rollup in rollups.rollups
+        if rewriter.needed_dimensions <= set(rollup.dimensions)
+        and rewriter.needed_measures <= set(rollup.measures)
+    ]
+    if not candidates:
+        raise NotRoutable("no rollup has all the columns of the query")
+    rollup = min(candidates, key=lambda rollup: rollup.num_rows)
+    node["from_table"] = {
+        "type": "BASE_TABLE",
+        "alias": node["from_table"]["alias"],
+        "sample": None,
+        "query_location": 0,
+        "schema_name": "",
+        "table_name": rollup.path,
+        "column_name_alias": [],
+        "catalog_name": "",
+        "at_clause": None,
+    }
+    return _render(conn, parsed)
+
+
+class RollupRouter:
+    """Runs queries on the rollups that can answer them, counting how often."""
+
+    def __init__(
+        self,
+        manifest_path: Path,
+        s3_endpoint: str = "https://{bucket}.s3.amazonaws.com",
+        version_ttl: float = 60.0,
+    ):
+        self.manifest_path = manifest_path
+        self.s3_endpoint = s3_endpoint
+        self.version_ttl = version_ttl
+        self.stats: defaultdict[str, Counter] = defaultdict(Counter)
+        self._manifest = RollupManifest()
+        self._manifest_mtime: int | None = None
+        self._versions: dict[str, tuple[float, str]] = {}
+        self._lock = threading.Lock()
+
+    def manifest(self) -> RollupManifest:
+        """The manifest, reloaded when the rollups are refreshed."""
+        try:
+            mtime = self.manifest_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return self._manifest
+        with self._lock:
+            if mtime != self._manifest_mtime:
+                manifest = load_manifest(self.manifest_path)
+                if manifest.version != ROLLUP_VERSION:
+                    logger.warning("The rollups are outdated, rebuild them")
+                    manifest = RollupManifest()
+                self._manifest = manifest
+                self._manifest_mtime = mtime
+            return self._manifest
+
+    def file_version(self, path: str) -> str:
+        """The version of a file, rechecked every `version_ttl` seconds."""
+        cached = self._versions.get(path)
+        if cached is not None and time.monotonic() - cached[0] < self.version_ttl:
+            return cached[1]
+        version = file_version(path, self.s3_endpoint)
+        self._versions[path] = (time.monotonic(), version)
+        return version
+
+    def route(self, sql: str, dataset: dict, settings: Settings) -> str | None:
+        """The query rewritten over a rollup, None if no fresh rollup answers it."""
+        key = dataset.get("key", dataset["s3"])
+        rollups = self.manifest().datasets.get(key)
+        outcome = "routed"
+        rewritten = None
+        try:
+            if rollups is None or rollups.s3 != dataset["s3"]:
+                outcome = "no_rollup"
+            elif self.file_version(rollups.s3) != rollups.file_version:
+                outcome = "stale"
+            else:
+                with engine.cursor(settings) as conn:
+                    rewritten = rewrite_for_rollups(conn, sql, rollups)
+        except NotRoutable as e:
+            logger.info(f"Query not routed to the rollups of {key}: {e}")
+            outcome = "not_routable"
+        except Exception as e:
+            logger.warning(f"Can't route the query to the rollups of {key}: {e}")
+            outcome = "error"
+        with self._lock:
+            self.stats[key][outcome] += 1
+        return rewritten
+
+    def fetch_table(
+        self,
+        sql: str,
+        dataset: dict,
+        settings: Settings | None = None,
+        query: engine.RunningQuery | None = None,
+    ) -> pa.Table:
+        """Run a query on a rollup if one answers it, on the dataset otherwise."""
+        settings = settings or get_settings()
+        rewritten = self.route(sql, dataset, settings)
+        if rewritten is not None:
+            try:
+                return engine.fetch_table(
+                    rewritten, settings, governed=True, query=query
+                )
+            except Exception as e:
+                logger.warning(f"The query on the rollups failed: {e}")
+                with self._lock:
+                    counts = self.stats[dataset.get("key", dataset["s3"])]
+                    counts["routed"] -= 1
+                    counts["fallback"] += 1
+        return engine.fetch_table(sql, settings, governed=True, query=query)
+
+    def report(self) -> str:
+        """How many queries of each dataset were answered by its rollups."""
+        lines = []
+        with self._lock:
+            for key, counts in sorted(self.stats.items()):
+                total = counts.total()
+                hits = counts["routed"]
+                details = ", ".join(
+                    f"{outcome} {count}"
+                    for outcome, count in sorted(counts.items())
+                    if outcome != "routed" and count
+                )
+                lines.append(
+                    f"{key}: {hits}/{total} queries on rollups ({hits / total:.0%})"
+                    + (f", {details}" if details else "")
+                )
+        return "\n".join(lines)
+
+
+_router: RollupRouter | None = None
+_router_lock = threading.Lock()
+
+
+def get_rollup_router(settings: Settings | None = None) -> RollupRouter:
+    """The router of the process, created on first use."""
+    global _router
+    with _router_lock:
+        if _router is None:
+            settings = settings or get_settings()
+            _router = RollupRouter(
+                settings.rollup_dir / "manifest.json",
+                s3_endpoint=settings.duckdb_s3_endpoint,
+                version_ttl=settings.result_cache_version_ttl,
+            )
+        return _router
+
+
+def reset_rollup_router() -> None:
+    global _router
+    with _router_lock:
+        _router = None
+
+
+async def run_chart_query(
+    sql: str, dataset: dict, settings: Settings | None = None
+) -> pa.Table:
+    """Run a chart query on the DuckDB thread pool, on a rollup if possible.
+
+    It runs within the limits of the query governor either way.
+    """
+    settings = settings or get_settings()
+    if not settings.rollups_enabled:
+        return await engine.run_query(sql, settings, governed=True)
+    async with engine.get_governor(settings).admit():
+        return await engine.run_on_pool(
+            get_rollup_router(settings).fetch_table,
+            sql,
+            dataset,
+            settings,
+            settings=settings,
+        )
@@ -0,0 +1,328 @@
+"""Semantic cache of the SQL and plot specs generated for charts.
+
+Users ask for the same charts in different words, "cattle heat stress by
+country" and "heat stress in cattle per country", and codestral answers them
+with the same SQL and plot each time, which is most of what a chart costs.
+Answers are cached with the embedding of the request they answered, and
+reused for requests at least `threshold` cosine-similar to it on the same
+dataset, schema and chart mode, that mention the same literals: values of
+the dataset, names and numbers, see `prompts.request_literals`. "rainfall in
+Kenya" and "rainfall in Mozambique" are close but don't share their SQL. A
+change of the dataset's columns drops its answers, one of the embedding model
+all of them.
+
+Entries live in memory and in a SQLite file, are dropped `ttl` seconds after
+they were generated and, past `max_entries`, least recently used first.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections.abc import Sequence
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from .settings import Settings, get_settings
+from .vectorstore import get_datasets_vectorstore
+
+logger = logging.getLogger(__name__)
+
+# Version of the layout of the SQLite file, older files are cleared
+FORMAT = "2"
+
+
+@dataclass
+class Entry:
+    id: int
+    dataset: str
+    schema: str
+    mode: str
+    query: str
+    literals: list[str]
+    vector: np.ndarray
+    answer: dict[str, Any]
+    # Seconds the LLM took to generate the answer
+    cost: float
+    created: float
+    used: float
+
+
+class SemanticCache:
+    def __init__(
+        self,
+        embedder: Embeddings,
+        model: str = "",
+        path: Path | None = None,
+        threshold: float = 0.92,
+        ttl: float | None = None,
+        max_entries: int = 5000,
+    ):
+        self.embedder = embedder
+        self.model = model
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: dict[int, Entry] = {}
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        if path is not None:
+            self._db = self._open(path)
+
+    def _open(self, path: Path) -> sqlite3.Connection:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(path, check_same_thread=False)
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        meta = {"model": self.model, "format": FORMAT}
+        stored = dict(db.execute("SELECT key, value FROM meta").fetchall())
+        if stored != meta:
+            # Vectors of another model can't be compared with this one's
+            if stored:
+                logger.info(
+                    f"Embedding model changed from {stored.get('model')} to"
+                    f" {self.model}, clearing the chart cache"
+                )
+            db.execute("DROP TABLE IF EXISTS answers")
+            db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", meta.items())
+            db.commit()
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY,
+                dataset TEXT NOT NULL,
+                schema TEXT NOT NULL,
+                mode TEXT NOT NULL,
+                query TEXT NOT NULL,
+                literals TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                answer TEXT NOT NULL,
+                cost REAL NOT NULL,
+                created REAL NOT NULL,
+                used REAL NOT NULL
+            )
+            """
+        )
+        for row in db.execute("SELECT * FROM answers"):
+            entry = Entry(*row)
+            entry.literals = json.loads(row[5])
+            entry.vector = np.frombuffer(row[6], dtype=np.float32)
+            entry.answer = json.loads(row[7])
+            self.entries[entry.id] = entry
+        self._next_id = max(self.entries, default=-1) + 1
+        return db
+
+    def _expired(self, entry: Entry, now: float) -> bool:
+        return self.ttl is not None and now - entry.created > self.ttl
+
+    def _delete(self, ids: list[int]) -> None:
+        for id in ids:
+            del self.entries[id]
+        if self._db is not None and ids:
+            self._db.executemany(
+                "DELETE FROM answers WHERE id = ?", [(i,) for i in ids]
+            )
+            self._db.commit()
+
+    async def embed(self, query: str) -> np.ndarray | None:
+        """The normalized embedding of a request, None if it can't be embedded."""
+        try:
+            embedding = await self.embedder.aembed_query(query)
+        except Exception as e:
+            # The cache only saves time, charts are still made without it
+            logger.warning(f"Can't embed {query!r} for the chart cache: {e}")
+            return None
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    async def get(
+        self,
+        query: str,
+        dataset: str,
+        schema: str,
+        mode: str,
+        vector: np.ndarray | None = None,
+        literals: Sequence[str] = (),
+    ) -> dict[str, Any] | None:
+        """The answer to the most similar request, if similar enough.
+
+        `vector` is the embedding of the request, if it was already computed.
+        Only requests with the same `literals` are candidates.
+        """
+        if vector is None:
+            vector = await self.embed(query)
+        now = time.time()
+        with self._lock:
+            self._delete(
+                [id for id, entry in self.entries.items() if self._expired(entry, now)]
+            )
+            if vector is None:
+                self.misses += 1
+                return None
+            key = (dataset, schema, mode, sorted(literals))
+            candidates = [
+                entry
+                for entry in self.entries.values()
+                if (entry.dataset, entry.schema, entry.mode, entry.literals) == key
+                and entry.vector.shape == vector.shape
+            ]
+            best = None
+            if candidates:
+                similarities = np.stack([entry.vector for entry in candidates]) @ vector
+                i = int(np.argmax(similarities))
+                if similarities[i] >= self.threshold:
+                    best = candidates[i]
+            if best is None:
+                self.misses += 1
+                return None
+            logger.info(
+                f"Reusing the answer to {best.query!r} for {query!r}"
+                f" (similarity {similarities[i]:.3f})"
+            )
+            self.hits += 1
+            self.seconds_saved += best.cost
+            best.used = now
+            if self._db is not None:
+                self._db.execute(
+                    "UPDATE answers SET used = ? WHERE id = ?", (now, best.id)
+                )
+                self._db.commit()
+            return best.answer
+
+    async def put(
+        self,
+        query: str,
+        dataset: str,
+        schema: str,
+        mode: str,
+        answer: dict[str, Any],
+        cost: float,
+        vector: np.ndarray | None = None,
+        literals: Sequence[str] = (),
+    ) -> None:
+        """Cache the answer to a request, which took `cost` seconds to generate."""
+        if vector is None:
+            vector = await self.embed(query)
+        if vector is None:
+            return
+        now = time.time()
+        with self._lock:
+            entry = Entry(
+                self._next_id,
+                dataset,
+                schema,
+                mode,
+                query,
+                sorted(literals),
+                vector,
+                answer,
+                cost,
+                now,
+                now,
+            )
+            self._next_id += 1
+            # Answers for another schema of the dataset are of no use anymore
+            self._delete(
+                [
+                    id
+                    for id, other in self.entries.items()
+                    if other.dataset == dataset and other.schema != schema
+                ]
+            )
+            self.entries[entry.id] = entry
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        entry.id,
+                        dataset,
+                        schema,
+                        mode,
+                        query,
+                        json.dumps(entry.literals),
+                        vector.tobytes(),
+                        json.dumps(answer),
+                        cost,
+                        now,
+                        now,
+                    ),
+                )
+                self._db.commit()
+            excess = len(self.entries) - self.max_entries
+            if excess > 0:
+                by_use = sorted(self.entries.values(), key=lambda entry: entry.used)
+                self._delete([entry.id for entry in by_use[:excess]])
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "seconds_saved": self.seconds_saved,
+                "entries": len(self.entries),
+            }
+
+    def report(self) -> str:
+        """The hit ratio and the time the hits saved."""
+        stats = self.stats()
+        lookups = stats["hits"] + stats["misses"]
+        if not lookups:
+            return ""
+        return (
+            f"{stats['hits']}/{lookups} charts from the cache"
+            f" ({stats['hit_ratio']:.0%}), {stats['seconds_saved']:.1f}s of LLM"
+            " calls saved"
+        )
+
+
+_cache: SemanticCache | None = None
+_cache_lock = threading.Lock()
+
+
+async def get_chart_cache(settings: Settings | None = None) -> SemanticCache | None:
+    """The chart cache of the process, None if disabled or nothing can embed."""
+    global _cache
+    settings = settings or get_settings()
+    if not settings.chart_cache_enabled:
+        return None
+    if _cache is not None:
+        return _cache
+    try:
+        # Shares the embedder, and its cache, of the dataset search
+        vectorstore = await get_datasets_vectorstore(settings)
+    except Exception as e:
+        logger.warning(f"No semantic cache of the charts, can't embed requests: {e}")
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = SemanticCache(
+                vectorstore.embeddings,
+                model=settings.embedding_model,
+                path=settings.chart_cache_path,
+                threshold=settings.chart_cache_threshold,
+                ttl=settings.chart_cache_ttl,
+                max_entries=settings.chart_cache_max_entries,
+            )
+        return _cache
+
+
+def chart_cache_report() -> str:
+    """The report of the chart cache, empty if it wasn't used."""
+    cache = _cache
+    return cache.report() if cache is not None else ""
+
+
+def reset_chart_cache() -> None:
+    global _cache
+    with _cache_lock:
+        _cache = None
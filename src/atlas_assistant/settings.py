@@ -1,22 +1,182 @@
 from functools import lru_cache
+from pathlib import Path
 from typing import Literal
 
-from langchain_mistralai import ChatMistralAI
+from langchain_mistralai import ChatMistralAI, MistralAIEmbeddings
 from pydantic import SecretStr
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+from .llm import get_llm_gateway
+
+DATA_DIR = Path(__file__).parents[2] / "data"
+
 
 class Settings(BaseSettings):
     mistral_api_key: SecretStr | None = None
     chat_model_size: Literal["large"] | Literal["medium"] | Literal["small"] = "small"
     chat_model_temperature: float = 0.0
+    embedding_model: str = "mistral-embed"
+    # Calls to the Mistral API share a gateway, see llm.py: a pool of
+    # `llm_max_connections` connections, the account's requests and tokens per
+    # minute (None for no limit), and up to `llm_max_retries` retries of rate
+    # limited and failed calls, backing off exponentially from `llm_backoff_base`
+    # seconds up to `llm_backoff_max`
+    mistral_endpoint: str = "https://api.mistral.ai"
+    llm_max_connections: int = 20
+    llm_timeout: float = 120.0
+    llm_requests_per_minute: int | None = None
+    llm_tokens_per_minute: int | None = None
+    llm_max_retries: int = 5
+    llm_backoff_base: float = 0.5
+    llm_backoff_max: float = 30.0
+    datasets_index_path: Path = DATA_DIR / "atlas-assistant-docs-mistral-index"
+    # "chroma" searches through the vector store, the others use the in-process
+    # retriever. "lexical" never embeds the query, "hybrid" only when the lexical
+    # best match doesn't beat the runner-up by `hybrid_lexical_margin`.
+    dataset_retriever: Literal["chroma", "vector", "lexical", "hybrid"] = "vector"
+    hybrid_lexical_margin: float = 0.3
+    # Query embeddings cache, set `embedding_cache_path` to None to keep it in memory
+    embedding_cache_path: Path | None = DATA_DIR / "embedding-cache.sqlite3"
+    embedding_cache_memory_size: int = 1024
+    embedding_cache_disk_size: int = 100_000
+    # Size of the thread pool DuckDB queries run on
+    duckdb_max_workers: int = 4
+    # Threads and memory of the shared DuckDB database, if unset sized for
+    # `query_max_concurrent` chart queries of `query_threads` and
+    # `query_memory_limit`, or DuckDB's defaults
+    duckdb_threads: int | None = None
+    duckdb_memory_limit: str | None = None
+    # Limits on the queries generated for charts, see governor.py. None disables
+    # a limit. Queries past `query_max_concurrent` wait up to `query_queue_timeout`
+    # seconds, those whose plan estimates more than `query_max_estimated_rows`
+    # rows in any step are rejected, and only the first `query_max_rows` rows of
+    # a result are plotted.
+    query_max_concurrent: int = 2
+    query_queue_timeout: float | None = 60.0
+    query_timeout: float | None = 30.0
+    query_max_estimated_rows: int | None = 1_000_000_000
+    query_max_rows: int | None = 100_000
+    query_threads: int | None = None
+    query_memory_limit: str | None = None
+    # On-disk cache of the S3 byte ranges read by DuckDB, None to read S3 directly
+    duckdb_cache_dir: Path | None = DATA_DIR / "s3-cache"
+    duckdb_cache_max_bytes: int = 10 * 1024**3
+    duckdb_s3_endpoint: str = "https://{bucket}.s3.amazonaws.com"
+    # Local copies of the datasets, see scripts/sync_datasets.py. Queries read
+    # them instead of S3 while they were synced less than this many seconds ago.
+    dataset_mirror_dir: Path | None = DATA_DIR / "mirror"
+    dataset_mirror_max_age: float | None = 24 * 3600
+    dataset_mirror_concurrency: int = 4
+    # Mirrored copies are rewritten sorted by the columns of these that they have,
+    # in row groups of this many rows, so that DuckDB skips the row groups of
+    # other countries and scenarios. Partitioning writes one directory per value.
+    # Empty lists keep the files as they are.
+    dataset_layout_sort_by: list[str] = [
+        "admin0_name",
+        "admin1_name",
+        "scenario",
+        "timeframe",
+    ]
+    dataset_layout_partition_by: list[str] = []
+    dataset_layout_row_group_size: int = 65_536
+    # Query results cache, keyed by SQL and the version of the files it reads
+    result_cache_enabled: bool = True
+    result_cache_dir: Path | None = DATA_DIR / "result-cache"
+    result_cache_memory_bytes: int = 256 * 1024**2
+    result_cache_disk_bytes: int = 2 * 1024**3
+    # How long a file version (ETag or mtime) is trusted before checking again
+    result_cache_version_ttl: float = 60.0
+    # Where chart data and figures are kept, the state only holds handles to them.
+    # "none" keeps them in the state itself. Least recently used ones are evicted
+    # past `blob_store_max_bytes`. Only "disk" outlives the process, as the
+    # "sqlite" checkpointer's conversations do.
+    blob_store: Literal["none", "memory", "disk"] = "memory"
+    blob_store_path: Path = DATA_DIR / "blobs"
+    blob_store_max_bytes: int = 512 * 1024**2
+    # "fast" asks codestral for the SQL and a structured plot spec in one call,
+    # "code" for the SQL, then Python plot code from the head of the result
+    chart_mode: Literal["fast", "code"] = "fast"
+    # Charts of datasets of more than `preview_min_rows` rows are first shown
+    # from a sample of about `preview_sample_rows` rows, see preview.py. Samples
+    # don't take the slots of chart queries, at most `preview_max_concurrent` run
+    # at once and charts past that aren't previewed.
+    preview_enabled: bool = True
+    preview_min_rows: int = 5_000_000
+    preview_sample_rows: int = 500_000
+    preview_max_concurrent: int = 2
+    # Line, scatter and area traces are downsampled to this many points, and
+    # larger histograms and box plots are aggregated, see payload.py
+    chart_max_points: int = 5000
+    # Token budgets of the chart prompts, see prompts.py: the dataset note is cut
+    # to `prompt_note_tokens`, columns least relevant to the request are only
+    # named past `prompt_profile_tokens`, and columns list at most
+    # `prompt_max_values` of their distinct values
+    prompt_note_tokens: int = 150
+    prompt_profile_tokens: int = 1500
+    prompt_max_values: int = 20
+    # Semantic cache of the SQL and plot specs codestral generated, see
+    # semantic_cache.py. Requests on the same dataset at least this cosine-similar
+    # to a cached one reuse its answer, for up to `chart_cache_ttl` seconds.
+    chart_cache_enabled: bool = True
+    chart_cache_path: Path | None = DATA_DIR / "chart-cache.sqlite3"
+    chart_cache_threshold: float = 0.92
+    chart_cache_ttl: float | None = 7 * 24 * 3600
+    chart_cache_max_entries: int = 5000
+    # Schema and statistics of the datasets, see scripts/parquet_analyzer.py
+    dataset_catalog_path: Path = DATA_DIR / "catalog.json"
+    # Distinct values are listed for columns with at most this many of them, read
+    # from the data only if the column is at most this many compressed bytes
+    catalog_max_distinct_values: int = 50
+    catalog_distinct_max_bytes: int = 1024**2
+    # Aggregates of the datasets that chart queries are routed to when they can
+    # answer them, see scripts/build_rollups.py. One rollup per level, grouped by
+    # the columns of the level that the dataset has.
+    rollups_enabled: bool = True
+    rollup_dir: Path = DATA_DIR / "rollups"
+    rollup_levels: list[list[str]] = [
+        ["admin0_name", "scenario", "timeframe"],
+        ["admin0_name", "admin1_name", "scenario", "timeframe"],
+    ]
+    # What the chat model sees of a conversation, see history.py: the last
+    # `history_keep_turns` turns, with the tool results of past turns cut to
+    # `history_tool_tokens`, older turns as a summary of `history_summary_tokens`,
+    # and at most `history_max_tokens` in all
+    history_keep_turns: int = 4
+    history_tool_tokens: int = 60
+    history_summary_tokens: int = 600
+    history_max_tokens: int = 4000
+    # Where conversations are checkpointed, "sqlite" survives restarts
+    checkpointer: Literal["memory", "sqlite"] = "memory"
+    checkpointer_path: Path = DATA_DIR / "checkpoints.sqlite3"
+    # Conversations idle for longer than this many seconds are dropped
+    checkpointer_ttl: float | None = 7 * 24 * 3600
+    # In memory, the least recently used conversations are dropped past this
+    checkpointer_max_threads: int = 1000
+    # Older checkpoints of a conversation are dropped, the latest is all the
+    # agent needs
+    checkpointer_keep_checkpoints: int = 10
+    checkpointer_compact_interval: float = 600.0
     model_config = SettingsConfigDict(env_file=".env")
 
     def get_chat_model(self) -> ChatMistralAI:
+        gateway = get_llm_gateway(self)
         return ChatMistralAI(
             model_name=f"mistral-{self.chat_model_size}-latest",  # type: ignore
             api_key=self.mistral_api_key,  # type: ignore
             temperature=self.chat_model_temperature,
+            endpoint=gateway.api_url,
+            async_client=gateway.client(gateway.api_url),
+            # The gateway retries
+            max_retries=1,
+        )
+
+    def get_embeddings(self) -> MistralAIEmbeddings:
+        gateway = get_llm_gateway(self)
+        return MistralAIEmbeddings(
+            model=self.embedding_model,
+            api_key=self.mistral_api_key,  # type: ignore
+            endpoint=gateway.api_url,
+            async_client=gateway.client(gateway.api_url),
         )
 
 
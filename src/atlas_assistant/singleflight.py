@@ -0,0 +1,66 @@
+"""Coalescing of identical concurrent requests.
+
+In workshops many users send the same example prompt at the same moment.
+`SingleFlight.run` lets the first of them start the work, the LLM calls and
+the query, and gives its result, or its exception, to all the others that
+arrive while it's in flight. Nothing is kept once it's done, a request that
+comes later does the work again.
+"""
+
+import asyncio
+import logging
+import re
+from collections import Counter
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+TRAILING_PUNCTUATION = re.compile(r"[\s.!?]+$")
+
+
+def normalize(text: str) -> str:
+    """A request as its key: case, spacing and final punctuation don't matter."""
+    return TRAILING_PUNCTUATION.sub("", " ".join(text.casefold().split()))
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self.stats: Counter[str] = Counter()
+        self._flights: dict[Hashable, _Flight] = {}
+
+    async def run(self, key: Hashable, work: Callable[[], Awaitable[Any]]) -> Any:
+        """The result of `work()`, shared with the concurrent calls with `key`.
+
+        Cancelling a caller doesn't cancel the work for the others, it is only
+        cancelled once every caller is.
+        """
+        flight = self._flights.get(key)
+        if flight is None or flight.task.done():
+            flight = _Flight(asyncio.ensure_future(work()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._land(key, flight))
+            self.stats["executions"] += 1
+        else:
+            logger.info(f"Joining the {self.name} request in flight for {key}")
+            self.stats["coalesced"] += 1
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1:
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _land(self, key: Hashable, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
@@ -3,6 +3,8 @@ from typing import Literal
 from langgraph.prebuilt.chat_agent_executor import AgentStatePydantic
 from pydantic import BaseModel, Field
 
+from .blobs import BlobRef
+
 
 class Base64Plot(BaseModel):
     type: Literal["image/png"] = "image/png"
@@ -20,7 +22,17 @@ class AgentState(AgentStatePydantic):
     python_code: str | None = Field(
         default=None, description="The Python code to use for the plot"
     )
-    chart_data: dict | None = Field(
-        default=None, description="The data to use for the plot"
+    chart_data: BlobRef | dict | None = Field(
+        default=None,
+        description="The data of the plot, see `columnar.encode_columns`",
+    )
+    chart: BlobRef | dict | None = Field(
+        default=None, description="Plotly express plot"
+    )
+    history_summary: list[str] = Field(
+        default_factory=list,
+        description="Summary of the turns the chat model no longer sees whole",
+    )
+    summarized_turns: int = Field(
+        default=0, description="The number of turns in `history_summary`"
     )
-    chart: dict | None = Field(default=None, description="Plotly express plot")
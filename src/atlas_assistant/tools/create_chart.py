@@ -2,25 +2,43 @@
 https://github.com/e2b-dev/e2b-cookbook/blob/main/examples/codestral-code-interpreter-python/codestral_code_interpreter.ipynb
 """
 
-import io
-import json
+import asyncio
+import inspect
+import logging
 import re
-from typing import Annotated, Literal
+import threading
+import time
+from collections.abc import Callable
+from functools import partial
+from typing import TYPE_CHECKING, Annotated, Any, Literal
 
-import duckdb
-import pandas as pd
-import plotly.express as px
+import pyarrow as pa
 from langchain_core.messages import ToolMessage
 from langchain_core.tools import tool
 from langchain_core.tools.base import InjectedToolCallId
+from langgraph.config import get_stream_writer
 from langgraph.prebuilt import InjectedState
 from langgraph.types import Command
-from mistralai import Mistral
 from pydantic import BaseModel, Field
 
-from ..settings import get_settings
+from ..blobs import store_json
+from ..catalog import get_dataset_profile, schema_version
+from ..columnar import compact_table, encode_columns
+from ..governor import is_truncated
+from ..llm import get_llm_gateway
+from ..payload import compact_figure
+from ..preview import ProgressiveQuery
+from ..prompts import build_prompt, dataset_context, request_literals
+from ..semantic_cache import get_chart_cache
+from ..settings import Settings, get_settings
+from ..singleflight import SingleFlight, normalize
 from ..state import AgentState
 
+if TYPE_CHECKING:
+    from mistralai import Mistral
+
+logger = logging.getLogger(__name__)
+
 
 class SQLQuery(BaseModel):
     """Structured output for SQL query generation."""
@@ -57,6 +75,13 @@ class PlotlyPlotArgs(BaseModel):
     explanation: str
 
 
+class ChartSpec(BaseModel):
+    """Structured output for the SQL query and the plot, in a single call."""
+
+    sql_query: str
+    plot: PlotlyPlotArgs
+
+
 GET_DATA_PROMPT = """You're a python data scientist that is analyzing datasets.
 
 You will write SQL code to extract and simplify data from a larger dataset.
@@ -67,10 +92,10 @@ The dataset is in a parquet file in S3. here is the info about the dataset
 
 {dataset_info}
 
-Here is a csv of the head of the dataset:
+The dataset has {num_rows} rows. Here are its columns with their statistics, as csv:
 
 ```csv
-{data_sample}
+{dataset_profile}
 ```
 
 Instructions:
@@ -137,6 +162,43 @@ Instructions:
 """
 
 
+FAST_CHART_PROMPT = """You're a data scientist that is analyzing datasets using duckdb and plotly express.
+
+You will write SQL code that extracts and simplifies data from a larger dataset,
+and the plotly express plot of the result of that query.
+
+The SQL code will be executed using duckdb database.
+
+The dataset is in a parquet file in S3. here is the info about the dataset
+
+{dataset_info}
+
+The dataset has {num_rows} rows. Here are its columns with their statistics, as csv:
+
+```csv
+{dataset_profile}
+```
+
+Example plotly express plot arguments:
+
+```json
+{{
+    "x": "category",
+    "y": "value",
+    "title": "Bar Chart"
+}}
+```
+
+Instructions:
+- Generate executable SQL code to extract the requested data
+- Always use the S3 path to read the parquet file in the sql code you write
+- Nicely indent the SQL code with 2 spaces
+- Pick the plot type and the plotly express arguments for the result of the query,
+  they can only refer to the columns the query returns
+- Provide a brief explanation of the visualization
+"""
+
+
 def extract_code_from_response(content: str) -> str:
     """Extract Python code from LLM response."""
     # Try to find markdown code blocks first
@@ -150,95 +212,43 @@ def extract_code_from_response(content: str) -> str:
     return content.strip()
 
 
-@tool("create_chart_tool")
-async def create_chart(
-    plot_query: str,
-    tool_call_id: Annotated[str, InjectedToolCallId],
-    state: Annotated[AgentState, InjectedState] = None,
-) -> Command:
-    """Create a plot from the list of available datasets.
+def get_codestral_client() -> "Mistral":
+    """The Mistral client shared by all chart requests, see llm.py."""
+    return get_llm_gateway(get_settings()).codestral()
 
-    Updates the `plot` state with the details of the best matching plot if found,
+
+_charts = SingleFlight("create_chart")
+
+_plotly_lock = threading.Lock()
+
+
+def plotly_express():
+    """plotly.express, imported on first use, by warm_up at the latest.
+
+    pandas is imported first, under a lock: plotly looks for pandas objects
+    whenever pandas is in sys.modules, and must not find it half imported by
+    another thread while a figure is being built.
     """
-    print(f"Creating plot for query: {plot_query}")
-    if not state.dataset:
-        return Command(
-            update={
-                "messages": [
-                    ToolMessage(
-                        content="No dataset selected", tool_call_id=tool_call_id
-                    )
-                ]
-            }
-        )
-    s3_path = state.dataset["s3"]
-    conn = duckdb.connect()
-    sql_to_extract_metadata = f"""SELECT * FROM '{s3_path}' LIMIT 5"""
-    result = conn.execute(sql_to_extract_metadata)
+    with _plotly_lock:
+        import pandas  # noqa: F401
+        import plotly.express as px
+    return px
 
-    column_names = [desc[0] for desc in result.description]
-    data_rows = result.fetchall()
-    data_sample = pd.DataFrame(data_rows, columns=column_names)
-    conn.close()
 
-    settings = get_settings()
+# Rows of the query result streamed as a preview, before the figure
+PREVIEW_ROWS = 10
 
-    client = Mistral(api_key=settings.mistral_api_key.get_secret_value())
-    response = client.chat.parse(
-        model="codestral-latest",
-        messages=[
-            {
-                "role": "system",
-                "content": GET_DATA_PROMPT.format(
-                    dataset_info=json.dumps(state.dataset),
-                    data_sample=data_sample.to_string(index=False),
-                ),
-            },
-            {"role": "user", "content": plot_query},
-        ],
-        response_format=SQLQuery,
-    )
-    sql_result = response.choices[0].message.parsed
-    duckdb_sql = sql_result.sql_query
-    print(f"SQL Query Explanation: {sql_result.explanation}")
-
-    print("DUCKDB CODE: \n", duckdb_sql)
-
-    conn = duckdb.connect()
-    result = conn.execute(duckdb_sql)
-
-    column_names = [desc[0] for desc in result.description]
-    data_rows = result.fetchall()
-    chart_data = pd.DataFrame(data_rows, columns=column_names)
-    conn.close()
-    chart_data = chart_data.dropna()
-
-    response = client.chat.parse(
-        model="codestral-latest",
-        messages=[
-            {
-                "role": "system",
-                "content": MAKE_PLOT_PROMPT_CODE.format(
-                    chart_data=chart_data.head(5).to_csv(index=False),
-                ),
-            },
-            {"role": "user", "content": plot_query},
-        ],
-        response_format=PlotlyPlot,
-    )
-    plot_result = response.choices[0].message.parsed
-    python_code = plot_result.python_code
-    print(f"Python Code Explanation: {plot_result.explanation}")
-    print("PYTHON CODE: \n", python_code)
 
+def build_figure(chart_data: pa.Table, python_code: str) -> dict:
+    """Build the plotly figure described by the generated code, as JSON."""
     # Extract px function calls and arguments
     px_pattern = r"px\.(\w+)\s*\(\s*([^)]*)\s*\)"
     px_matches = re.findall(px_pattern, python_code)
 
     px_calls = []
     for function_name, args_str in px_matches:
-        print(f"Plotly Express function: {function_name}")
-        print(f"Arguments: {args_str}")
+        logger.debug(f"Plotly Express function: {function_name}")
+        logger.debug(f"Arguments: {args_str}")
         args_dict = {}
 
         # Remove common patterns and split by commas
@@ -250,29 +260,323 @@ async def create_chart(
                 # Clean up the value
                 value = value.strip().strip("\"'")
                 args_dict[key] = value
-            print(f"Parsed arguments: {args_dict}")
+            logger.debug(f"Parsed arguments: {args_dict}")
             px_calls.append({"function_name": function_name, "args": args_dict})
 
+    px = plotly_express()
     for px_call in px_calls:
         fig = getattr(px, px_call["function_name"])(chart_data, **px_call["args"])
 
-    with io.StringIO() as buffer:
-        fig.write_json(buffer)
-        chart_json = buffer.getvalue()
+    return figure_to_json(fig)
+
+
+def build_figure_from_args(chart_data: pa.Table, plot: PlotlyPlotArgs) -> dict:
+    """Build the plotly figure of a structured plot spec, as JSON."""
+    function = getattr(plotly_express(), plot.plot_type)
+    parameters = inspect.signature(function).parameters
+    args = {
+        key: value
+        for key, value in plot.plotly_express_args.items()
+        if key in parameters and key != "data_frame"
+    }
+    return figure_to_json(function(chart_data, **args))
+
+
+def figure_to_json(fig) -> dict:
+    """The figure as plotly JSON, large traces compacted, see payload.py.
+
+    Arrays stay numpy arrays until the figure is stored, no JSON round trip.
+    """
+    figure = fig.to_plotly_json()
+    # Sized by the UI, as cl.Plotly does
+    layout = figure.setdefault("layout", {})
+    layout["autosize"] = True
+    layout.pop("width", None)
+    layout.pop("height", None)
+    return compact_figure(figure, get_settings().chart_max_points)
+
+
+def plot_code(plot: PlotlyPlotArgs) -> str:
+    """The Python code equivalent to a structured plot spec."""
+    args = "".join(
+        f", {key}={value!r}" for key, value in plot.plotly_express_args.items()
+    )
+    return f"px.{plot.plot_type}(chart_data{args})"
+
+
+def emit(stage: str, **payload: Any) -> None:
+    """Stream a stage of a chart to the `custom` stream mode of the graph.
+
+    The stages are "schema", "sql", "plot", "data" and "figure", in the order
+    they're done, which depends on the chart mode. For large datasets a
+    "preview" figure from a sample may come before the data, see preview.py.
+    """
+    try:
+        writer = get_stream_writer()
+    except RuntimeError:
+        # Not run by a graph, e.g. by a script
+        return
+    writer({"tool": "create_chart", "stage": stage, **payload})
+
+
+def emit_data(chart_data: pa.Table) -> None:
+    emit(
+        "data",
+        num_rows=chart_data.num_rows,
+        columns=chart_data.column_names,
+        preview=chart_data.slice(0, PREVIEW_ROWS).to_pylist(),
+    )
+
+
+def mark_approximate(chart: dict, fraction: float) -> dict:
+    """Mark the figure of a preview as approximate."""
+    layout = chart.setdefault("layout", {})
+    layout.setdefault("annotations", []).append(
+        {
+            "text": f"Preview from {fraction:.1%} of the rows, approximate",
+            "xref": "paper",
+            "yref": "paper",
+            "x": 1,
+            "y": 1,
+            "xanchor": "right",
+            "yanchor": "bottom",
+            "showarrow": False,
+            "font": {"color": "#b45309"},
+        }
+    )
+    return chart
+
+
+async def emit_preview(
+    make_figure: Callable[[], dict], fraction: float, settings: Settings
+) -> None:
+    chart = await asyncio.to_thread(make_figure)
+    emit(
+        "preview",
+        chart=store_json(mark_approximate(chart, fraction), settings),
+        fraction=fraction,
+    )
+
 
+async def build_chart(
+    plot_query: str, dataset: dict, settings: Settings
+) -> tuple[dict[str, Any], str]:
+    """The state update of a chart, and the message describing it.
+
+    Each stage is streamed as soon as it's done, see `emit`.
+    """
+    # Answers to similar requests on the same columns are reused, see
+    # semantic_cache.py. The request is embedded while the dataset is looked up.
+    cache = await get_chart_cache(settings)
+    embedding = asyncio.ensure_future(cache.embed(plot_query)) if cache else None
+    # Described from the catalog, no need to read the dataset itself
+    profile = await get_dataset_profile(dataset, settings)
+    vector = await embedding if embedding is not None else None
+    emit(
+        "schema",
+        dataset=profile.key,
+        num_rows=profile.num_rows,
+        columns=[column.name for column in profile.columns],
+    )
+    # Within the token budgets, see prompts.py
+    context = dataset_context(dataset, profile, plot_query, settings)
+
+    client = get_codestral_client()
+    # Per dataset, views of one file don't share their answers
+    scope = (profile.key, schema_version(profile), settings.chart_mode)
+    # Only reused for requests about the same places, values and numbers
+    literals = request_literals(plot_query, profile)
+    cached = (
+        await cache.get(plot_query, *scope, vector=vector, literals=literals)
+        if cache is not None
+        else None
+    )
+    llm_seconds = 0.0
+    if settings.chart_mode == "fast":
+        if cached is not None:
+            spec = ChartSpec.model_validate(cached)
+        else:
+            # The SQL and the plot in one call, from the schema and statistics
+            # of the dataset rather than the head of the query result
+            start = time.perf_counter()
+            response = await client.chat.parse_async(
+                model="codestral-latest",
+                messages=[
+                    {
+                        "role": "system",
+                        "content": build_prompt(
+                            "fast chart", FAST_CHART_PROMPT, **context
+                        ),
+                    },
+                    {"role": "user", "content": plot_query},
+                ],
+                response_format=ChartSpec,
+            )
+            spec = response.choices[0].message.parsed
+            llm_seconds += time.perf_counter() - start
+        duckdb_sql = spec.sql_query
+        python_code = plot_code(spec.plot)
+        explanation = spec.plot.explanation
+        answer = spec.model_dump()
+        logger.debug(f"DUCKDB CODE:\n{duckdb_sql}")
+        logger.debug(f"PLOT:\n{python_code}")
+        emit("sql", sql=duckdb_sql, cached=cached is not None)
+        emit("plot", python_code=python_code, explanation=explanation)
+
+        async with ProgressiveQuery(duckdb_sql, dataset, profile, settings) as query:
+            sample = await query.preview()
+            if sample is not None:
+                sample_data = await asyncio.to_thread(compact_table, sample)
+                await emit_preview(
+                    partial(build_figure_from_args, sample_data, spec.plot),
+                    query.fraction,
+                    settings,
+                )
+            result = await query.result()
+        chart_data = await asyncio.to_thread(compact_table, result)
+        emit_data(chart_data)
+        make_figure = partial(build_figure_from_args, chart_data, spec.plot)
+    else:
+        if cached is not None:
+            sql_result = SQLQuery.model_validate(cached["sql"])
+        else:
+            start = time.perf_counter()
+            response = await client.chat.parse_async(
+                model="codestral-latest",
+                messages=[
+                    {
+                        "role": "system",
+                        "content": build_prompt("SQL", GET_DATA_PROMPT, **context),
+                    },
+                    {"role": "user", "content": plot_query},
+                ],
+                response_format=SQLQuery,
+            )
+            sql_result = response.choices[0].message.parsed
+            llm_seconds += time.perf_counter() - start
+        duckdb_sql = sql_result.sql_query
+        logger.debug(f"SQL Query Explanation: {sql_result.explanation}")
+        logger.debug(f"DUCKDB CODE:\n{duckdb_sql}")
+        emit("sql", sql=duckdb_sql, cached=cached is not None)
+
+        async def make_plot(chart_data: pa.Table) -> PlotlyPlot:
+            nonlocal llm_seconds
+            if cached is not None:
+                plot_result = PlotlyPlot.model_validate(cached["plot"])
+            else:
+                start = time.perf_counter()
+                response = await client.chat.parse_async(
+                    model="codestral-latest",
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": build_prompt(
+                                "plot code",
+                                MAKE_PLOT_PROMPT_CODE,
+                                chart_data=chart_data.slice(0, 5)
+                                .to_pandas()
+                                .to_csv(index=False),
+                            ),
+                        },
+                        {"role": "user", "content": plot_query},
+                    ],
+                    response_format=PlotlyPlot,
+                )
+                plot_result = response.choices[0].message.parsed
+                llm_seconds += time.perf_counter() - start
+            logger.debug(f"Python Code Explanation: {plot_result.explanation}")
+            logger.debug(f"PYTHON CODE:\n{plot_result.python_code}")
+            emit(
+                "plot",
+                python_code=plot_result.python_code,
+                explanation=plot_result.explanation,
+            )
+            return plot_result
+
+        plot_result = None
+        async with ProgressiveQuery(duckdb_sql, dataset, profile, settings) as query:
+            sample = await query.preview()
+            if sample is not None:
+                # The plot code is written from the head of the sample while
+                # the exact query runs
+                sample_data = await asyncio.to_thread(compact_table, sample)
+                plot_result = await make_plot(sample_data)
+                if not query.done():
+                    await emit_preview(
+                        partial(build_figure, sample_data, plot_result.python_code),
+                        query.fraction,
+                        settings,
+                    )
+            result = await query.result()
+        chart_data = await asyncio.to_thread(compact_table, result)
+        emit_data(chart_data)
+        if plot_result is None:
+            plot_result = await make_plot(chart_data)
+        python_code = plot_result.python_code
+        explanation = plot_result.explanation
+        answer = {"sql": sql_result.model_dump(), "plot": plot_result.model_dump()}
+        make_figure = partial(build_figure, chart_data, python_code)
+
+    content = f"Created chart with explanation: {explanation}"
+    if is_truncated(result):
+        content += (
+            f" Only the first {result.num_rows} rows of the query result are"
+            " plotted, aggregate the data to plot all of it."
+        )
+
+    # Building and serializing the figure is CPU bound for large results
+    chart, encoded_data = await asyncio.gather(
+        asyncio.to_thread(make_figure),
+        asyncio.to_thread(encode_columns, chart_data),
+    )
+    update = {
+        "chart_data": store_json(encoded_data, settings),
+        "chart": store_json(chart, settings),
+        "chart_query": duckdb_sql,
+        "python_code": python_code,
+    }
+    emit("figure", chart=update["chart"])
+    # Only answers that made a chart are worth reusing
+    if cache is not None and cached is None:
+        await cache.put(
+            plot_query, *scope, answer, llm_seconds, vector=vector, literals=literals
+        )
+    return update, content
+
+
+@tool("create_chart_tool")
+async def create_chart(
+    plot_query: str,
+    tool_call_id: Annotated[str, InjectedToolCallId],
+    state: Annotated[AgentState, InjectedState] = None,
+) -> Command:
+    """Create a plot from the list of available datasets.
+
+    Updates the `plot` state with the details of the best matching plot if found,
+    """
+    logger.debug(f"Creating plot for query: {plot_query}")
+    if not state.dataset:
+        return Command(
+            update={
+                "messages": [
+                    ToolMessage(
+                        content="No dataset selected", tool_call_id=tool_call_id
+                    )
+                ]
+            }
+        )
+    settings = get_settings()
+    # Users sending the same prompt at once get the same chart, built once.
+    # Only the session building it sees its stages streamed.
+    # Views of one file are different datasets
+    dataset = state.dataset.get("key", state.dataset.get("s3"))
+    key = (normalize(plot_query), dataset, settings.chart_mode)
+    update, content = await _charts.run(
+        key, partial(build_chart, plot_query, state.dataset, settings)
+    )
     return Command(
         update={
-            "chart_data": chart_data.to_dict(),
-            "chart": json.loads(chart_json),
-            "chart_query": duckdb_sql,
-            "python_code": python_code,
-            "messages": [
-                ToolMessage(
-                    content=(
-                        f"Created chart with explanation: {plot_result.explanation}"
-                    ),
-                    tool_call_id=tool_call_id,
-                )
-            ],
+            **update,
+            "messages": [ToolMessage(content=content, tool_call_id=tool_call_id)],
         },
     )
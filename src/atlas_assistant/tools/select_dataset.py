@@ -1,29 +1,34 @@
+import asyncio
 import logging
-from pathlib import Path
+from functools import partial
 from typing import Annotated
 
-from langchain_chroma import Chroma
 from langchain_core.messages import ToolMessage
 from langchain_core.tools import tool
 from langchain_core.tools.base import InjectedToolCallId
-from langchain_mistralai import MistralAIEmbeddings
 from langgraph.types import Command
 
+from ..retriever import get_dataset_retriever
 from ..settings import Settings, get_settings
+from ..singleflight import SingleFlight, normalize
+from ..vectorstore import get_datasets_vectorstore
 
 logger = logging.getLogger(__name__)
 
+_searches = SingleFlight("select_dataset")
 
-async def load_datasets_vector_embeddings(settings: Settings) -> Chroma:
-    # Initialize ChromaDB with existing database
-    db_path = Path(__file__).parents[3] / "data" / "atlas-assistant-docs-mistral-index"
-    if not Path(db_path).exists():
-        raise RuntimeError(f"Database does not exist at path {db_path}.")
-    embedder = MistralAIEmbeddings(
-        model="mistral-embed", api_key=settings.mistral_api_key
-    )
-    vectorstore = Chroma(persist_directory=str(db_path), embedding_function=embedder)
-    return vectorstore
+
+async def search_datasets(dataset_query: str, settings: Settings) -> list[tuple]:
+    """The 3 datasets that best match a query, with their scores."""
+    if settings.dataset_retriever == "chroma":
+        vectorstore = await get_datasets_vectorstore(settings)
+        # Embedded through the gateway, searched off the event loop
+        vector = await vectorstore.embeddings.aembed_query(dataset_query)
+        return await asyncio.to_thread(
+            vectorstore.similarity_search_by_vector_with_relevance_scores, vector, k=3
+        )
+    retriever = await get_dataset_retriever(settings)
+    return await retriever.asearch(dataset_query, k=3)
 
 
 @tool("select_dataset_tool")
@@ -38,13 +43,15 @@ async def select_dataset(
     """
     logger.info(f"Finding dataset for query: {dataset_query}")
     settings = get_settings()
-    vectorstore = await load_datasets_vector_embeddings(settings)
-
-    results = vectorstore.similarity_search_with_score(dataset_query, k=3)
+    results = await _searches.run(
+        (normalize(dataset_query), settings.dataset_retriever),
+        partial(search_datasets, dataset_query, settings),
+    )
 
     return Command(
         update={
-            "dataset": results[0][0].metadata,
+            # Copied, the results may be shared with other sessions
+            "dataset": dict(results[0][0].metadata),
             "messages": [
                 ToolMessage(
                     content=("Returning dataset: " + results[0][0].page_content),
@@ -0,0 +1,87 @@
+"""Process-wide access to the datasets vector store.
+
+Opening the Chroma persist directory and building the embeddings client is
+far more expensive than a similarity search over ~30 documents, so the store
+is built once per process and shared by every session.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from langchain_core.embeddings import Embeddings
+
+from .embedding_cache import CachedEmbeddings
+from .settings import DATA_DIR, Settings
+
+if TYPE_CHECKING:
+    # chromadb is slow to import, it's only loaded when the index is opened
+    from langchain_chroma import Chroma
+
+logger = logging.getLogger(__name__)
+
+_vectorstore: "Chroma | None" = None
+_vectorstore_lock = threading.Lock()
+
+
+def load_datasets(path: Path = DATA_DIR / "datasets.json") -> list[dict]:
+    with open(path) as f:
+        return json.load(f)
+
+
+def dataset_document(dataset: dict) -> str:
+    """The text that is embedded for a dataset."""
+    return f"Name: {dataset['name']}, Info: {dataset['info']}, Note: {dataset['note']}"
+
+
+def load_datasets_vector_embeddings(
+    settings: Settings, embedder: Embeddings | None = None
+) -> "Chroma":
+    """Open the datasets index on disk. Prefer `get_datasets_vectorstore`."""
+    db_path = settings.datasets_index_path
+    if not db_path.exists():
+        raise RuntimeError(f"Database does not exist at path {db_path}.")
+    if embedder is None:
+        embedder = CachedEmbeddings(
+            settings.get_embeddings(),
+            model=settings.embedding_model,
+            path=settings.embedding_cache_path,
+            max_memory_entries=settings.embedding_cache_memory_size,
+            max_disk_entries=settings.embedding_cache_disk_size,
+        )
+    from langchain_chroma import Chroma
+
+    return Chroma(persist_directory=str(db_path), embedding_function=embedder)
+
+
+def _get_or_build(settings: Settings) -> "Chroma":
+    global _vectorstore
+    with _vectorstore_lock:
+        if _vectorstore is None:
+            logger.info(f"Loading datasets index from {settings.datasets_index_path}")
+            _vectorstore = load_datasets_vector_embeddings(settings)
+        return _vectorstore
+
+
+async def get_datasets_vectorstore(settings: Settings) -> "Chroma":
+    """Return the shared vector store, building it on first use."""
+    vectorstore = _vectorstore
+    if vectorstore is not None:
+        return vectorstore
+    # Opening the index touches SQLite and HNSW files, keep it off the event loop
+    return await asyncio.to_thread(_get_or_build, settings)
+
+
+def reload_datasets_vectorstore(settings: Settings | None = None) -> None:
+    """Drop the shared vector store, e.g. after the index on disk was rebuilt.
+
+    If `settings` is given, the new store is built immediately so that the
+    next lookup doesn't pay for it; otherwise it's rebuilt lazily.
+    """
+    global _vectorstore
+    vectorstore = load_datasets_vector_embeddings(settings) if settings else None
+    with _vectorstore_lock:
+        _vectorstore = vectorstore
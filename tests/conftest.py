@@ -1,12 +1,76 @@
-from collections.abc import Callable
+import asyncio
+import functools
+import http.server
+import io
+import re
+import threading
+from collections.abc import Callable, Iterator
+from pathlib import Path
+from types import SimpleNamespace
 from typing import Any
 from uuid import uuid4
 
+import duckdb
+import numpy as np
 import pytest
+from langchain_chroma import Chroma
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from pydantic import BaseModel
 from pytest import Config, Parser
 
+import atlas_assistant.tools.create_chart as create_chart_module
+from atlas_assistant import (
+    agent,
+    blobs,
+    catalog,
+    checkpointer,
+    engine,
+    llm,
+    rollups,
+    semantic_cache,
+    vectorstore,
+)
 from atlas_assistant.agent import create_graph
-from atlas_assistant.settings import Settings
+from atlas_assistant.settings import Settings, get_settings
+
+
+@pytest.fixture(autouse=True)
+def isolated_caches(
+    tmp_path_factory: pytest.TempPathFactory, monkeypatch: pytest.MonkeyPatch
+) -> Iterator[None]:
+    """Keep the on-disk caches of the default settings out of the data directory."""
+    cache_dir = tmp_path_factory.mktemp("caches")
+    monkeypatch.setenv("EMBEDDING_CACHE_PATH", str(cache_dir / "embeddings.sqlite3"))
+    monkeypatch.setenv("DUCKDB_CACHE_DIR", str(cache_dir / "s3-cache"))
+    monkeypatch.setenv("RESULT_CACHE_DIR", str(cache_dir / "result-cache"))
+    monkeypatch.setenv("BLOB_STORE_PATH", str(cache_dir / "blobs"))
+    monkeypatch.setenv("CHECKPOINTER_PATH", str(cache_dir / "checkpoints.sqlite3"))
+    monkeypatch.setenv("DATASET_CATALOG_PATH", str(cache_dir / "catalog.json"))
+    monkeypatch.setenv("DATASET_MIRROR_DIR", str(cache_dir / "mirror"))
+    monkeypatch.setenv("ROLLUP_DIR", str(cache_dir / "rollups"))
+    monkeypatch.setenv("CHART_CACHE_PATH", str(cache_dir / "chart-cache.sqlite3"))
+    get_settings.cache_clear()
+    engine.close_database()
+    blobs.reset_blob_store()
+    checkpointer.reset_checkpointer()
+    catalog.reset_catalog()
+    rollups.reset_rollup_router()
+    semantic_cache.reset_chart_cache()
+    llm.reset_llm_gateway()
+    agent.reset_graph()
+    yield
+    engine.close_database()
+    blobs.reset_blob_store()
+    checkpointer.reset_checkpointer()
+    catalog.reset_catalog()
+    rollups.reset_rollup_router()
+    semantic_cache.reset_chart_cache()
+    llm.reset_llm_gateway()
+    agent.reset_graph()
+    get_settings.cache_clear()
 
 
 @pytest.fixture
@@ -14,6 +78,47 @@ def settings() -> Settings:
     return Settings()
 
 
+class UnitFakeEmbedding(DeterministicFakeEmbedding):
+    """Deterministic unit-length embeddings, like mistral-embed returns."""
+
+    def _get_embedding(self, seed: int) -> list[float]:
+        vector = np.random.default_rng(seed).normal(size=self.size)
+        return list(vector / np.linalg.norm(vector))
+
+
+@pytest.fixture
+def fake_embeddings() -> DeterministicFakeEmbedding:
+    return UnitFakeEmbedding(size=64)
+
+
+@pytest.fixture
+def datasets_index(tmp_path: Path, fake_embeddings: DeterministicFakeEmbedding) -> Path:
+    """A datasets index built with a local stand-in embedder."""
+    datasets = vectorstore.load_datasets()
+    path = tmp_path / "index"
+    Chroma.from_texts(
+        texts=[vectorstore.dataset_document(ds) for ds in datasets],
+        embedding=fake_embeddings,
+        metadatas=datasets,
+        persist_directory=str(path),
+    )
+    return path
+
+
+@pytest.fixture
+def offline_settings(
+    monkeypatch: pytest.MonkeyPatch,
+    datasets_index: Path,
+    fake_embeddings: DeterministicFakeEmbedding,
+) -> Iterator[Settings]:
+    """Settings that point at the local index and never call the embeddings API."""
+    settings = Settings(datasets_index_path=datasets_index, embedding_cache_path=None)
+    monkeypatch.setattr(Settings, "get_embeddings", lambda self: fake_embeddings)
+    vectorstore.reload_datasets_vectorstore()
+    yield settings
+    vectorstore.reload_datasets_vectorstore()
+
+
 @pytest.fixture
 async def run_agent(settings: Settings) -> Callable[[str], Any]:
     graph = await create_graph(settings)
@@ -29,6 +134,167 @@ async def run_agent(settings: Settings) -> Callable[[str], Any]:
     return run
 
 
+class ScriptedChatModel(BaseChatModel):
+    """A chat model whose answers are computed from the conversation by `script`."""
+
+    script: Callable[[list[BaseMessage]], AIMessage]
+    inputs: list[list[BaseMessage]] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def bind_tools(self, tools: Any, **kwargs: Any) -> "ScriptedChatModel":
+        return self
+
+    def _generate(
+        self, messages: list[BaseMessage], *args: Any, **kwargs: Any
+    ) -> ChatResult:
+        self.inputs.append(messages)
+        return ChatResult(generations=[ChatGeneration(message=self.script(messages))])
+
+
+@pytest.fixture
+def parquet_dataset(tmp_path: Path) -> dict:
+    """A dataset entry whose parquet file is local."""
+    path = tmp_path / "heat_impact.parquet"
+    duckdb.execute(
+        f"""
+        COPY (
+          SELECT
+            ['Kenya', 'Mozambique', 'Ethiopia', 'Ghana'][i % 4 + 1] AS admin0_name,
+            'region ' || (i % 17) AS admin1_name,
+            [126, 585][i % 2 + 1] AS scenario,
+            [2045, 2085][i // 2 % 2 + 1] AS timeframe,
+            (i % 100) / 10.0 AS value
+          FROM range(10000) t(i)
+        ) TO '{path}' (FORMAT parquet)
+        """
+    )
+    return {
+        "key": "test_heat",
+        "active": True,
+        "info": "Cattle heatstress, test data",
+        "note": "Scenarios available = 126, 585",
+        "s3": str(path),
+        "name": "tbl_test_heat",
+        "sql": None,
+    }
+
+
+class ObjectStoreHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves a directory like S3 does: ETags and byte range requests."""
+
+    def send_head(self):
+        path = Path(self.translate_path(self.path))
+        if not path.is_file():
+            return super().send_head()
+        self.server.requests.append((self.command, self.headers.get("Range")))
+        data = path.read_bytes()
+        stat = path.stat()
+        status = 200
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+        if match:
+            start = int(match[1])
+            end = int(match[2]) if match[2] else len(data) - 1
+            content_range = f"bytes {start}-{end}/{len(data)}"
+            data = data[start : end + 1]
+            status = 206
+        self.send_response(status)
+        if status == 206:
+            self.send_header("Content-Range", content_range)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"')
+        self.send_header("Last-Modified", self.date_time_string(int(stat.st_mtime)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        return io.BytesIO(data)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+@pytest.fixture
+def object_store(tmp_path: Path) -> Iterator[SimpleNamespace]:
+    """A local HTTP stand-in for S3, buckets are directories of `root`."""
+    root = tmp_path / "object-store"
+    root.mkdir()
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0),
+        functools.partial(ObjectStoreHandler, directory=str(root)),
+    )
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    yield SimpleNamespace(
+        root=root,
+        endpoint=f"http://{host}:{port}/{{bucket}}",
+        requests=server.requests,
+    )
+    server.shutdown()
+    server.server_close()
+
+
+class FakeCodestral:
+    """Stands in for the Mistral client, answering `chat.parse_async` from a script."""
+
+    def __init__(
+        self,
+        respond: Callable[[type[BaseModel], list[dict]], BaseModel],
+        latency: float = 0.0,
+    ):
+        self.chat = self
+        self.respond = respond
+        self.latency = latency
+        self.calls: list[dict] = []
+
+    async def parse_async(self, response_format: type[BaseModel], **kwargs: Any):
+        self.calls.append({"response_format": response_format, **kwargs})
+        await asyncio.sleep(self.latency)
+        parsed = self.respond(response_format, kwargs["messages"])
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(parsed=parsed))]
+        )
+
+
+@pytest.fixture
+def fake_codestral(
+    monkeypatch: pytest.MonkeyPatch, parquet_dataset: dict
+) -> FakeCodestral:
+    """Codestral answering every chart request with a mean per country bar chart."""
+
+    def respond(response_format: type[BaseModel], messages: list[dict]) -> BaseModel:
+        if response_format is create_chart_module.SQLQuery:
+            return create_chart_module.SQLQuery(
+                sql_query=(
+                    "SELECT admin0_name, avg(value) AS value "
+                    f"FROM '{parquet_dataset['s3']}' GROUP BY admin0_name"
+                ),
+                explanation="Mean value per country",
+            )
+        if response_format is create_chart_module.ChartSpec:
+            return create_chart_module.ChartSpec(
+                sql_query=(
+                    "SELECT admin0_name, avg(value) AS value "
+                    f"FROM '{parquet_dataset['s3']}' GROUP BY admin0_name"
+                ),
+                plot=create_chart_module.PlotlyPlotArgs(
+                    plotly_express_args={"x": "admin0_name", "y": "value"},
+                    plot_type="bar",
+                    explanation="Bar chart of the mean value per country",
+                ),
+            )
+        return create_chart_module.PlotlyPlot(
+            python_code='px.bar(chart_data, x="admin0_name", y="value")',
+            explanation="Bar chart of the mean value per country",
+        )
+
+    fake = FakeCodestral(respond)
+    monkeypatch.setattr(create_chart_module, "get_codestral_client", lambda: fake)
+    return fake
+
+
 def pytest_addoption(parser: Parser) -> None:
     parser.addoption(
         "--agent",
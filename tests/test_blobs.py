@@ -0,0 +1,173 @@
+import os
+import resource
+from pathlib import Path
+
+import pytest
+from conftest import FakeCodestral, ScriptedChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langgraph.checkpoint.memory import InMemorySaver
+
+import atlas_assistant.tools.create_chart as create_chart_module
+from atlas_assistant import blobs, checkpointer
+from atlas_assistant.agent import create_graph
+from atlas_assistant.settings import Settings, get_settings
+
+TURNS = 20
+
+
+def test_memory_blob_store():
+    store = blobs.MemoryBlobStore(max_bytes=10)
+    first = store.put(b"123456")
+    assert store.put(b"123456") == first
+    assert store.size == 6
+    second = store.put(b"abcdef")
+    assert store.get(first) is None
+    assert store.get(second) == b"abcdef"
+
+
+def test_disk_blob_store(tmp_path: Path):
+    digest = blobs.DiskBlobStore(tmp_path).put(b"chart")
+    assert blobs.DiskBlobStore(tmp_path).get(digest) == b"chart"
+    assert blobs.DiskBlobStore(tmp_path).get("0" * 64) is None
+
+
+def test_disk_blob_store_evicts_least_recently_used(tmp_path: Path):
+    store = blobs.DiskBlobStore(tmp_path, max_bytes=12)
+    first = store.put(b"123456")
+    second = store.put(b"abcdef")
+    # Both old, then the first one read again
+    os.utime(store._file(first), (1000, 1000))
+    os.utime(store._file(second), (2000, 2000))
+    assert store.get(first) == b"123456"
+    third = store.put(b"ghijkl")
+    assert store.get(second) is None
+    assert store.get(first) == b"123456"
+    assert store.get(third) == b"ghijkl"
+    assert store.size == 12
+    # Another worker's store counts the files, and keeps the blob it writes
+    other = blobs.DiskBlobStore(tmp_path, max_bytes=6)
+    fourth = other.put(b"mnopqr")
+    assert other.get(fourth) == b"mnopqr"
+    assert other.size == 6
+
+
+def test_missing_blob_resolves_to_none(caplog: pytest.LogCaptureFixture):
+    settings = Settings(blob_store="memory", checkpointer="sqlite")
+    blobs.reset_blob_store()
+    # A handle from before a restart
+    ref = blobs.BlobRef(blob="0" * 64, size=2)
+    assert blobs.resolve(ref, settings) is None
+    assert "BLOB_STORE=disk" in caplog.text
+
+
+def test_store_and_resolve():
+    settings = Settings(blob_store="memory")
+    blobs.reset_blob_store()
+    ref = blobs.store_json({"data": [1, 2, 3]}, settings)
+    assert isinstance(ref, blobs.BlobRef)
+    assert blobs.resolve(ref, settings) == {"data": [1, 2, 3]}
+    assert blobs.resolve(ref.model_dump(), settings) == {"data": [1, 2, 3]}
+    assert blobs.resolve({"data": []}, settings) == {"data": []}
+
+    inline = Settings(blob_store="none")
+    assert blobs.store_json({"data": [1]}, inline) == {"data": [1]}
+
+
+def checkpoint_bytes(saver: InMemorySaver) -> int:
+    """Serialized size of everything the checkpointer holds."""
+    channel_values = sum(len(data) for _, data in saver.blobs.values())
+    checkpoints = sum(
+        len(checkpoint[1]) + len(metadata[1])
+        for namespaces in saver.storage.values()
+        for checkpoints in namespaces.values()
+        for checkpoint, metadata, _ in checkpoints.values()
+    )
+    writes = sum(
+        len(write[2][1])
+        for writes in saver.writes.values()
+        for write in writes.values()
+    )
+    return channel_values + checkpoints + writes
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except FileNotFoundError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def chart_every_turn(messages: list[BaseMessage]) -> AIMessage:
+    last = messages[-1]
+    if isinstance(last, HumanMessage):
+        return AIMessage(
+            content="",
+            tool_calls=[
+                {
+                    "name": "create_chart_tool",
+                    "args": {"plot_query": last.content},
+                    "id": f"call_{len(messages)}",
+                }
+            ],
+        )
+    return AIMessage(content="Here is your chart")
+
+
+async def conversation(
+    blob_store: str,
+    monkeypatch: pytest.MonkeyPatch,
+    parquet_dataset: dict,
+) -> tuple[int, int]:
+    monkeypatch.setenv("BLOB_STORE", blob_store)
+    # Keep the whole history to measure what every checkpoint holds
+    monkeypatch.setenv("CHECKPOINTER_KEEP_CHECKPOINTS", "1000")
+    # Every point of the figure, as a chart of a large result would have
+    monkeypatch.setenv("CHART_MAX_POINTS", "1000000")
+    get_settings.cache_clear()
+    blobs.reset_blob_store()
+    checkpointer.reset_checkpointer()
+    model = ScriptedChatModel(script=chart_every_turn)
+    monkeypatch.setattr(Settings, "get_chat_model", lambda self: model)
+    graph = await create_graph(get_settings())
+    config = {"configurable": {"thread_id": blob_store}}
+
+    rss_before = rss_bytes()
+    for turn in range(TURNS):
+        await graph.ainvoke(
+            {
+                "messages": [("user", f"values by region, take {turn}")],
+                "dataset": parquet_dataset,
+            },
+            config,
+        )
+    state = await graph.aget_state(config)
+    chart = blobs.resolve(state.values["chart"])
+    assert chart["data"][0]["type"].startswith("scatter")
+    return checkpoint_bytes(graph.checkpointer), rss_bytes() - rss_before
+
+
+async def test_checkpoints_stay_small_with_blob_store(
+    fake_codestral: FakeCodestral,
+    parquet_dataset: dict,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    def respond(response_format, messages):
+        return create_chart_module.ChartSpec(
+            sql_query=f"SELECT admin1_name, value FROM '{parquet_dataset['s3']}'",
+            plot=create_chart_module.PlotlyPlotArgs(
+                plotly_express_args={"x": "admin1_name", "y": "value"},
+                plot_type="scatter",
+                explanation="Scatter plot of every value",
+            ),
+        )
+
+    fake_codestral.respond = respond
+    inline_bytes, inline_rss = await conversation("none", monkeypatch, parquet_dataset)
+    blob_bytes, blob_rss = await conversation("memory", monkeypatch, parquet_dataset)
+    print(
+        f"\n{TURNS} turns, checkpoints: inline {inline_bytes / 1e6:.2f} MB, "
+        f"blob store {blob_bytes / 1e6:.2f} MB; RSS growth: inline "
+        f"{inline_rss / 1e6:.1f} MB, blob store {blob_rss / 1e6:.1f} MB"
+    )
+    assert blob_bytes < inline_bytes / 10
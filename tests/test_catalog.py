@@ -0,0 +1,123 @@
+import os
+import re
+from pathlib import Path
+from types import SimpleNamespace
+
+import duckdb
+import pytest
+from conftest import FakeCodestral
+from test_create_chart import make_chart
+
+from atlas_assistant import catalog, engine
+from atlas_assistant.settings import Settings, get_settings
+
+
+def test_profile_dataset(parquet_dataset: dict):
+    profile = catalog.profile_dataset(parquet_dataset, Settings())
+    assert profile.num_rows == 10_000
+    columns = {column.name: column for column in profile.columns}
+    assert columns["admin0_name"].distinct_values == [
+        "Ethiopia",
+        "Ghana",
+        "Kenya",
+        "Mozambique",
+    ]
+    assert columns["scenario"].distinct_values == [126, 585]
+    assert (columns["value"].min, columns["value"].max) == (0.0, 9.9)
+    assert columns["value"].null_count == 0
+    assert len(columns["admin1_name"].distinct_values) == 17
+    assert columns["value"].distinct_values is None
+
+    description = catalog.describe_dataset(profile)
+    assert (
+        "admin0_name,VARCHAR,Ethiopia,Mozambique,0,Ethiopia|Ghana|Kenya|Mozambique"
+        in description
+    )
+
+
+def test_profiling_reads_only_footers(tmp_path: Path, object_store: SimpleNamespace):
+    path = object_store.root / "digital-atlas" / "big.parquet"
+    path.parent.mkdir()
+    duckdb.execute(
+        f"""
+        COPY (
+          SELECT
+            'region ' || (i // 102_400) AS admin1_name,
+            random() AS value
+          FROM range(20 * 102_400) t(i)
+        ) TO '{path}' (FORMAT parquet, ROW_GROUP_SIZE 102_400)
+        """
+    )
+    settings = Settings(
+        duckdb_cache_dir=tmp_path / "s3-cache",
+        duckdb_s3_endpoint=object_store.endpoint,
+    )
+    profile = catalog.profile_dataset(
+        {"key": "big", "s3": "s3://digital-atlas/big.parquet"}, settings
+    )
+    columns = {column.name: column for column in profile.columns}
+    # From the row group statistics, the data is sorted by region
+    assert len(columns["admin1_name"].distinct_values) == 20
+    fetched = sum(
+        int(end) - int(start) + 1
+        for method, range_header in object_store.requests
+        if method == "GET"
+        for start, end in [re.match(r"bytes=(\d+)-(\d+)", range_header).groups()]
+    )
+    assert fetched < path.stat().st_size / 4
+
+
+async def test_build_catalog_is_incremental(
+    parquet_dataset: dict, monkeypatch: pytest.MonkeyPatch
+):
+    profiled = []
+    profile_dataset = catalog.profile_dataset
+
+    def counting_profile_dataset(dataset, *args):
+        profiled.append(dataset["key"])
+        return profile_dataset(dataset, *args)
+
+    monkeypatch.setattr(catalog, "profile_dataset", counting_profile_dataset)
+    datasets = catalog.active_datasets(
+        [parquet_dataset, {**parquet_dataset, "key": "inactive", "active": False}]
+    )
+    first = await catalog.build_catalog(datasets)
+    assert list(first.datasets) == ["test_heat"]
+
+    path = get_settings().dataset_catalog_path
+    catalog.save_catalog(first, path)
+    second = await catalog.build_catalog(datasets, catalog=catalog.load_catalog(path))
+    assert second == first
+    assert profiled == ["test_heat"]
+
+    stat = os.stat(parquet_dataset["s3"])
+    os.utime(parquet_dataset["s3"], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    await catalog.build_catalog(datasets, catalog=second)
+    assert profiled == ["test_heat", "test_heat"]
+
+
+async def test_chart_prompt_comes_from_the_catalog(
+    fake_codestral: FakeCodestral,
+    parquet_dataset: dict,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    profile = catalog.profile_dataset(parquet_dataset)
+    profile.num_rows = 12_345
+    catalog.get_catalog().datasets[profile.key] = profile
+    queries = []
+    fetch_table = engine.fetch_table
+    monkeypatch.setattr(
+        engine,
+        "fetch_table",
+        lambda sql, settings=None, **kwargs: (
+            queries.append(sql) or fetch_table(sql, settings, **kwargs)
+        ),
+    )
+
+    await make_chart(parquet_dataset)
+    assert (
+        "The dataset has 12345 rows"
+        in fake_codestral.calls[0]["messages"][0]["content"]
+    )
+    # Only the chart query itself
+    assert len(queries) == 1
@@ -0,0 +1,121 @@
+from pathlib import Path
+
+import pytest
+from conftest import ScriptedChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langgraph.graph.state import CompiledStateGraph
+
+from atlas_assistant import checkpointer
+from atlas_assistant.agent import create_graph
+from atlas_assistant.checkpointer import BoundedMemorySaver, open_sqlite_saver
+from atlas_assistant.history import SUMMARY_HEADER
+from atlas_assistant.settings import Settings, get_settings
+
+
+def count_turns(messages: list[BaseMessage]) -> AIMessage:
+    # Older turns are only in the summary of the history, one line each
+    summarized = sum(
+        line.startswith("- ")
+        for m in messages
+        if m.type == "system" and m.content.startswith(SUMMARY_HEADER)
+        for line in m.content.splitlines()
+    )
+    turns = summarized + sum(m.type == "human" for m in messages)
+    return AIMessage(content=f"Turn {turns}")
+
+
+@pytest.fixture
+def scripted_model(monkeypatch: pytest.MonkeyPatch) -> ScriptedChatModel:
+    model = ScriptedChatModel(script=count_turns)
+    monkeypatch.setattr(Settings, "get_chat_model", lambda self: model)
+    return model
+
+
+async def chat(graph: CompiledStateGraph, thread_id: str, turns: int) -> dict:
+    config = {"configurable": {"thread_id": thread_id}}
+    for turn in range(turns):
+        state = await graph.ainvoke({"messages": [("user", f"hello {turn}")]}, config)
+    return state
+
+
+async def test_threads_are_separate(scripted_model: ScriptedChatModel):
+    graph = await create_graph(get_settings())
+    await chat(graph, "alice", 3)
+    state = await chat(graph, "bob", 1)
+    assert state["messages"][-1].content == "Turn 1"
+
+
+async def test_memory_saver_is_bounded(scripted_model: ScriptedChatModel):
+    saver = BoundedMemorySaver(max_threads=2, keep_checkpoints=3)
+    checkpointer._checkpointer = saver
+    graph = await create_graph(get_settings())
+
+    state = await chat(graph, "first", 20)
+    # The conversation is whole even though old checkpoints are dropped
+    assert len(state["messages"]) == 40
+    assert len(saver.storage["first"][""]) == 3
+    blobs_per_conversation = len(saver.blobs)
+    await chat(graph, "first", 20)
+    assert len(saver.blobs) == blobs_per_conversation
+
+    await chat(graph, "second", 1)
+    await chat(graph, "third", 1)
+    assert list(saver.last_used) == ["second", "third"]
+    assert "first" not in saver.storage
+    assert all(key[0] != "first" for key in saver.blobs)
+
+
+async def test_memory_saver_expires_idle_threads(scripted_model: ScriptedChatModel):
+    saver = BoundedMemorySaver(ttl=0)
+    checkpointer._checkpointer = saver
+    graph = await create_graph(get_settings())
+    await chat(graph, "idle", 1)
+    await chat(graph, "active", 1)
+    assert "idle" not in saver.storage
+
+
+async def test_sqlite_conversations_survive_restart(
+    scripted_model: ScriptedChatModel, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setenv("CHECKPOINTER", "sqlite")
+    get_settings.cache_clear()
+    graph = await create_graph(get_settings())
+    await chat(graph, "session", 2)
+    await checkpointer.close_checkpointer()
+
+    graph = await create_graph(get_settings())
+    state = await chat(graph, "session", 1)
+    assert state["messages"][-1].content == "Turn 3"
+    await checkpointer.close_checkpointer()
+
+
+async def test_sqlite_compaction(scripted_model: ScriptedChatModel, tmp_path: Path):
+    saver = await open_sqlite_saver(
+        tmp_path / "checkpoints.sqlite3", keep_checkpoints=2
+    )
+    checkpointer._checkpointer = saver
+    graph = await create_graph(get_settings())
+    try:
+        await chat(graph, "old", 5)
+        await chat(graph, "new", 5)
+
+        stats = await saver.compact()
+        # Every turn checkpoints the input, the history trimming, the model
+        # call and the answer
+        assert stats == {"expired_threads": 0, "deleted_checkpoints": 2 * (20 - 2)}
+        async with saver.conn.execute(
+            "SELECT thread_id, count(*) FROM checkpoints GROUP BY thread_id"
+        ) as cursor:
+            assert await cursor.fetchall() == [("new", 2), ("old", 2)]
+        state = await chat(graph, "old", 1)
+        assert state["messages"][-1].content == "Turn 6"
+
+        saver.ttl = 0
+        stats = await saver.compact()
+        assert stats["expired_threads"] == 2
+        state = await graph.aget_state({"configurable": {"thread_id": "old"}})
+        assert not state.values
+        async with saver.conn.execute("SELECT count(*) FROM checkpoints") as cursor:
+            assert await cursor.fetchone() == (0,)
+    finally:
+        await checkpointer.close_checkpointer()
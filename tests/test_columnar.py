@@ -0,0 +1,50 @@
+import math
+
+import pyarrow as pa
+
+from atlas_assistant.columnar import compact_table, decode_columns, encode_columns
+
+
+def test_compact_table():
+    table = pa.table(
+        {
+            "admin0_name": ["Kenya", "Ghana", "Kenya", "Kenya", None, "Ghana"],
+            "id": ["a", "b", "c", "d", "e", "f"],
+            "value": [1.5, math.nan, 2.5, 3.5, 4.5, 5.5],
+            "year": [2045, 2045, 2085, 2085, 2045, 2085],
+            "big": [0, 0, 0, 0, 0, 10**12],
+        }
+    )
+    compact = compact_table(table)
+    assert compact.num_rows == 4
+    assert compact.schema.field("admin0_name").type == pa.dictionary(
+        pa.int32(), pa.string()
+    )
+    assert compact.schema.field("id").type == pa.string()
+    assert compact.schema.field("value").type == pa.float32()
+    assert compact.schema.field("year").type == pa.int16()
+    assert compact.schema.field("big").type == pa.int64()
+    assert compact.column("admin0_name").to_pylist() == [
+        "Kenya",
+        "Kenya",
+        "Kenya",
+        "Ghana",
+    ]
+
+
+def test_encode_columns_round_trip():
+    table = compact_table(
+        pa.table(
+            {
+                "admin0_name": ["Kenya", "Ghana", "Kenya", "Kenya"],
+                "value": [1, 2, 3, 4],
+            }
+        )
+    )
+    encoded = encode_columns(table)
+    assert encoded["columns"]["admin0_name"] == {
+        "type": "string",
+        "dictionary": ["Kenya", "Ghana"],
+        "indices": [0, 1, 0, 0],
+    }
+    assert decode_columns(encoded).equals(table)
@@ -0,0 +1,265 @@
+import asyncio
+import time
+from pathlib import Path
+
+import duckdb
+import pyarrow as pa
+import pytest
+from conftest import FakeCodestral, ScriptedChatModel
+from langchain_core.messages import AIMessage, BaseMessage, ToolMessage
+
+import atlas_assistant.preview
+from atlas_assistant.agent import create_graph
+from atlas_assistant.blobs import resolve
+from atlas_assistant.catalog import get_dataset_profile
+from atlas_assistant.engine import run_query
+from atlas_assistant.layout import Layout
+from atlas_assistant.preview import sample_row_groups, sample_sql
+from atlas_assistant.settings import Settings, get_settings
+from atlas_assistant.state import AgentState
+from atlas_assistant.tools.create_chart import (
+    PlotlyPlotArgs,
+    build_figure_from_args,
+    create_chart,
+    plot_code,
+)
+
+LLM_LATENCY = 0.2
+
+
+async def make_chart(
+    dataset: dict,
+    tool_call_id: str = "call",
+    plot_query: str = "mean value per country",
+):
+    return await create_chart.coroutine(
+        plot_query=plot_query,
+        tool_call_id=tool_call_id,
+        state=AgentState(messages=[], dataset=dataset),
+    )
+
+
+@pytest.mark.parametrize("mode, llm_calls", [("fast", 1), ("code", 2)])
+async def test_create_chart(
+    fake_codestral: FakeCodestral,
+    parquet_dataset: dict,
+    monkeypatch: pytest.MonkeyPatch,
+    mode: str,
+    llm_calls: int,
+):
+    monkeypatch.setenv("CHART_MODE", mode)
+    get_settings.cache_clear()
+    command = await make_chart(parquet_dataset)
+    assert resolve(command.update["chart"])["data"][0]["type"] == "bar"
+    assert "admin0_name" in resolve(command.update["chart_data"])["columns"]
+    assert command.update["python_code"].startswith("px.bar(chart_data")
+    assert len(fake_codestral.calls) == llm_calls
+
+
+async def test_fast_chart_prompt_has_statistics(
+    fake_codestral: FakeCodestral, parquet_dataset: dict
+):
+    await make_chart(parquet_dataset)
+    prompt = fake_codestral.calls[0]["messages"][0]["content"]
+    assert "column_name,column_type,min,max" in prompt
+    assert "admin0_name,VARCHAR,Ethiopia,Mozambique" in prompt
+
+
+def test_build_figure_from_args_ignores_unknown_args():
+    plot = PlotlyPlotArgs(
+        plotly_express_args={"x": "a", "y": "b", "data_frame": "df", "bogus": 1},
+        plot_type="line",
+        explanation="",
+    )
+    figure = build_figure_from_args(pa.table({"a": [1, 2], "b": [3, 4]}), plot)
+    assert figure["data"][0]["mode"] == "lines"
+    assert figure["layout"]["xaxis"]["title"]["text"] == "a"
+    assert plot_code(plot).startswith("px.line(chart_data, x='a', y='b'")
+
+
+async def test_concurrent_charts_overlap(
+    fake_codestral: FakeCodestral, parquet_dataset: dict
+):
+    fake_codestral.latency = LLM_LATENCY
+    n = 8
+    start = time.perf_counter()
+    commands = await asyncio.gather(
+        *(
+            make_chart(parquet_dataset, f"call-{i}", f"mean value per country #{i}")
+            for i in range(n)
+        )
+    )
+    elapsed = time.perf_counter() - start
+    assert all(command.update["chart"] for command in commands)
+    # Each chart makes at least one LLM call, serialized that's n * 0.2s
+    assert elapsed < n * LLM_LATENCY / 2
+
+
+async def test_queries_do_not_block_the_event_loop():
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.005)
+            ticks += 1
+
+    task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    await run_query("SELECT sum(i * i) FROM range(200_000_000) t(i)")
+    elapsed = time.perf_counter() - start
+    task.cancel()
+    assert ticks >= elapsed / 0.005 / 4
+
+
+def chart_then_answer(messages: list[BaseMessage]) -> AIMessage:
+    if isinstance(messages[-1], ToolMessage):
+        return AIMessage("Here is the chart")
+    call = {
+        "name": "create_chart_tool",
+        "args": {"plot_query": "mean value per country"},
+        "id": "call",
+    }
+    return AIMessage("", tool_calls=[call])
+
+
+@pytest.mark.parametrize(
+    "mode, stages",
+    [
+        ("fast", ["schema", "sql", "plot", "data", "figure"]),
+        ("code", ["schema", "sql", "data", "plot", "figure"]),
+    ],
+)
+async def test_chart_stages_are_streamed(
+    fake_codestral: FakeCodestral,
+    parquet_dataset: dict,
+    monkeypatch: pytest.MonkeyPatch,
+    mode: str,
+    stages: list[str],
+):
+    monkeypatch.setenv("CHART_MODE", mode)
+    get_settings.cache_clear()
+    model = ScriptedChatModel(script=chart_then_answer)
+    monkeypatch.setattr(Settings, "get_chat_model", lambda self: model)
+    graph = await create_graph(get_settings())
+
+    events = []
+    async for stream_mode, update in graph.astream(
+        {"messages": [("user", "plot it")], "dataset": parquet_dataset},
+        {"configurable": {"thread_id": "stream"}},
+        stream_mode=["updates", "custom"],
+    ):
+        if stream_mode == "custom":
+            events.append(update)
+        elif "tools" in update:
+            events.append({"stage": "tool done"})
+
+    # Every stage arrives before the tool returns
+    assert [event["stage"] for event in events] == [*stages, "tool done"]
+    sql, data = (
+        next(event for event in events if event["stage"] == stage)
+        for stage in ["sql", "data"]
+    )
+    assert sql["sql"].startswith("SELECT admin0_name")
+    assert data["num_rows"] == 4
+    assert {row["admin0_name"] for row in data["preview"]} == {
+        "Ethiopia",
+        "Ghana",
+        "Kenya",
+        "Mozambique",
+    }
+    assert resolve(events[-2]["chart"])["data"][0]["type"] == "bar"
+
+
+@pytest.fixture
+def large_dataset(parquet_dataset: dict, monkeypatch: pytest.MonkeyPatch) -> dict:
+    """The test dataset in 20 row groups, large enough to be previewed."""
+    duckdb.execute(
+        f"""
+        COPY (
+          SELECT * FROM '{parquet_dataset["s3"]}', range(20)
+        ) TO '{parquet_dataset["s3"]}' (FORMAT parquet, ROW_GROUP_SIZE 10000)
+        """
+    )
+    monkeypatch.setenv("PREVIEW_MIN_ROWS", "100000")
+    monkeypatch.setenv("PREVIEW_SAMPLE_ROWS", "30000")
+    get_settings.cache_clear()
+    return parquet_dataset
+
+
+async def test_sample_reads_whole_row_groups(large_dataset: dict):
+    settings = get_settings()
+    profile = await get_dataset_profile(large_dataset, settings)
+    row_groups = sample_row_groups(profile, settings)
+    assert row_groups == [3, 10, 16]
+    sql = f"SELECT count(*) AS n FROM read_parquet('{large_dataset['s3']}')"
+    sampled = sample_sql(sql, profile, row_groups)
+    assert (await run_query(sampled)).column("n").to_pylist() == [30_000]
+    assert sample_sql("SELECT 1", profile, row_groups) is None
+
+    profile.num_rows = 10_000
+    assert sample_row_groups(profile, settings) == []
+
+
+async def test_sorted_copies_are_not_sampled(large_dataset: dict, tmp_path: Path):
+    path = tmp_path / "sorted.parquet"
+    duckdb.execute(
+        f"""
+        COPY (
+          SELECT * FROM '{large_dataset["s3"]}' ORDER BY admin0_name
+        ) TO '{path}' (FORMAT parquet, ROW_GROUP_SIZE 10000)
+        """
+    )
+    dataset = {**large_dataset, "key": "test_heat_sorted", "s3": str(path)}
+    settings = get_settings()
+    profile = await get_dataset_profile(dataset, settings)
+    # Evenly spaced row groups of the sorted file miss whole countries
+    sampled = sample_sql(
+        f"SELECT DISTINCT admin0_name FROM '{path}'",
+        profile,
+        sample_row_groups(profile, settings),
+    )
+    assert (await run_query(sampled)).num_rows < 4
+
+    profile.layout = Layout(sort_by=["admin0_name"])
+    assert sample_row_groups(profile, settings) == []
+
+
+@pytest.mark.parametrize("mode", ["fast", "code"])
+async def test_preview_comes_before_the_exact_chart(
+    fake_codestral: FakeCodestral,
+    large_dataset: dict,
+    monkeypatch: pytest.MonkeyPatch,
+    mode: str,
+):
+    monkeypatch.setenv("CHART_MODE", mode)
+    get_settings.cache_clear()
+    run_chart_query = atlas_assistant.preview.run_chart_query
+
+    async def slow_chart_query(*args):
+        await asyncio.sleep(0.5)
+        return await run_chart_query(*args)
+
+    monkeypatch.setattr(atlas_assistant.preview, "run_chart_query", slow_chart_query)
+    events = []
+    monkeypatch.setattr(
+        "atlas_assistant.tools.create_chart.get_stream_writer", lambda: events.append
+    )
+    command = await make_chart(large_dataset)
+
+    # In code mode too, the plot code is written from the sample
+    assert [event["stage"] for event in events] == [
+        "schema",
+        "sql",
+        "plot",
+        "preview",
+        "data",
+        "figure",
+    ]
+    preview = resolve(events[3]["chart"])
+    assert preview["layout"]["annotations"][0]["text"].startswith(
+        "Preview from 15.0% of the rows"
+    )
+    # The exact chart isn't marked
+    assert "annotations" not in resolve(command.update["chart"])["layout"]
+    assert events[4]["num_rows"] == 4
@@ -0,0 +1,106 @@
+import threading
+from pathlib import Path
+
+import pytest
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from atlas_assistant import embedding_cache
+from atlas_assistant.embedding_cache import CachedEmbeddings
+
+
+class CountingEmbedding(DeterministicFakeEmbedding):
+    calls: int = 0
+
+    def embed_query(self, text: str) -> list[float]:
+        self.calls += 1
+        return super().embed_query(text)
+
+
+def test_repeated_queries_skip_the_embedder():
+    embedder = CountingEmbedding(size=8)
+    cache = CachedEmbeddings(embedder, model="fake")
+    first = cache.embed_query("Cattle heat stress")
+    assert cache.embed_query("  cattle   HEAT stress ") == first
+    assert embedder.calls == 1
+    assert cache.stats()["memory_hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+async def test_async_queries_are_cached():
+    embedder = CountingEmbedding(size=8)
+    cache = CachedEmbeddings(embedder, model="fake")
+    await cache.aembed_query("crop suitability Kenya")
+    await cache.aembed_query("crop suitability kenya")
+    assert embedder.calls == 1
+
+
+def test_memory_lru_eviction():
+    embedder = CountingEmbedding(size=8)
+    cache = CachedEmbeddings(embedder, model="fake", max_memory_entries=2)
+    for query in ["a", "b", "a", "c"]:
+        cache.embed_query(query)
+    assert list(cache.memory) == [cache._key("a"), cache._key("c")]
+    cache.embed_query("b")
+    assert embedder.calls == 4
+
+
+def test_disk_tier_survives_restart(tmp_path: Path):
+    path = tmp_path / "cache.sqlite3"
+    embedder = CountingEmbedding(size=8)
+    vector = CachedEmbeddings(embedder, model="fake", path=path).embed_query("drought")
+
+    cache = CachedEmbeddings(embedder, model="fake", path=path)
+    assert cache.embed_query("drought") == vector
+    assert embedder.calls == 1
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_disk_size_limit(tmp_path: Path):
+    embedder = CountingEmbedding(size=8)
+    cache = CachedEmbeddings(
+        embedder, model="fake", path=tmp_path / "cache.sqlite3", max_disk_entries=3
+    )
+    for query in "abcde":
+        cache.embed_query(query)
+    assert cache.stats()["disk_entries"] == 3
+
+
+async def test_disk_tier_stays_off_the_event_loop(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(embedding_cache, "USED_BATCH", 3)
+    path = tmp_path / "cache.sqlite3"
+    embedder = CountingEmbedding(size=8)
+    writer = CachedEmbeddings(embedder, model="fake", path=path, max_disk_entries=4)
+    for query in "abc":
+        writer.embed_query(query)
+
+    cache = CachedEmbeddings(embedder, model="fake", path=path, max_disk_entries=4)
+    statements = []
+    cache._db.set_trace_callback(
+        lambda sql: statements.append((threading.get_ident(), sql.split()[0]))
+    )
+    await cache.aembed_query("a")
+    await cache.aembed_query("b")
+    # Recency updates wait for a batch
+    assert [sql for _, sql in statements] == ["SELECT", "SELECT"]
+    await cache.aembed_query("c")
+    assert [sql for _, sql in statements].count("UPDATE") == 3
+    # Trimmed once over the limit only
+    await cache.aembed_query("d")
+    assert "DELETE" not in [sql for _, sql in statements]
+    await cache.aembed_query("e")
+    assert "DELETE" in [sql for _, sql in statements]
+    assert threading.get_ident() not in {thread for thread, _ in statements}
+    assert cache.stats()["disk_entries"] == 3
+
+
+def test_model_change_invalidates(tmp_path: Path):
+    path = tmp_path / "cache.sqlite3"
+    embedder = CountingEmbedding(size=8)
+    CachedEmbeddings(embedder, model="old", path=path).embed_query("drought")
+
+    cache = CachedEmbeddings(embedder, model="new", path=path)
+    assert cache.stats()["disk_entries"] == 0
+    cache.embed_query("drought")
+    assert embedder.calls == 2
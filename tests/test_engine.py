@@ -0,0 +1,148 @@
+import os
+import shutil
+from collections.abc import Iterator
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from atlas_assistant import engine
+from atlas_assistant.range_cache import RangeCacheFileSystem
+from atlas_assistant.settings import Settings
+
+S3_PATH = "s3://digital-atlas/hazards/test.parquet"
+QUERY = f"SELECT admin0_name, avg(value) FROM '{S3_PATH}' GROUP BY ALL ORDER BY 1"
+
+
+@pytest.fixture
+def engine_settings(
+    tmp_path: Path, object_store: SimpleNamespace, parquet_dataset: dict
+) -> Iterator[Settings]:
+    path = object_store.root / "digital-atlas" / "hazards" / "test.parquet"
+    path.parent.mkdir(parents=True)
+    shutil.copy(parquet_dataset["s3"], path)
+    engine.close_database()
+    yield Settings(
+        duckdb_cache_dir=tmp_path / "s3-cache",
+        duckdb_s3_endpoint=object_store.endpoint,
+        duckdb_threads=2,
+        duckdb_memory_limit="512MB",
+    )
+    engine.close_database()
+
+
+def range_requests(object_store: SimpleNamespace) -> list:
+    return [request for request in object_store.requests if request[0] == "GET"]
+
+
+async def test_shared_database_settings(engine_settings: Settings):
+    with engine.cursor(engine_settings) as first, engine.cursor() as second:
+        assert first.execute("SELECT current_setting('threads')").fetchone() == (2,)
+        first.execute("CREATE TABLE shared AS SELECT 1 AS x")
+        assert second.execute("SELECT x FROM shared").fetchone() == (1,)
+        limit = second.execute("SELECT current_setting('memory_limit')").fetchone()
+        assert limit[0].startswith("488")
+
+
+async def test_repeated_queries_are_served_from_the_range_cache(
+    engine_settings: Settings, object_store: SimpleNamespace
+):
+    expected = engine.fetch_table(
+        QUERY.replace(S3_PATH, _local(object_store)), engine_settings
+    )
+    first = await engine.run_query(QUERY, engine_settings)
+    assert first.equals(expected)
+    fetched = range_requests(object_store)
+    assert fetched
+
+    second = await engine.run_query(QUERY, engine_settings)
+    assert second.equals(expected)
+    assert range_requests(object_store) == fetched
+
+    # Blocks are on disk, so a fresh process doesn't fetch them again either
+    engine.close_database()
+    await engine.run_query(QUERY, engine_settings)
+    assert range_requests(object_store) == fetched
+
+
+async def test_changed_object_is_refetched(
+    engine_settings: Settings, object_store: SimpleNamespace, parquet_dataset: dict
+):
+    await engine.run_query(QUERY, engine_settings)
+    fetched = len(range_requests(object_store))
+
+    engine.close_database()
+    path = Path(_local(object_store))
+    engine.fetch_table(
+        f"COPY (SELECT * FROM '{parquet_dataset['s3']}' LIMIT 10) TO '{path}'",
+        engine_settings,
+    )
+    result = await engine.run_query(
+        f"SELECT count(*) AS n FROM '{S3_PATH}'", engine_settings
+    )
+    assert result["n"][0].as_py() == 10
+    assert len(range_requests(object_store)) > fetched
+
+
+def test_prepare_sql_without_cache():
+    engine.close_database()
+    engine.get_database(Settings(duckdb_cache_dir=None))
+    assert engine.prepare_sql(QUERY) == QUERY
+    engine.close_database()
+
+
+def _local(object_store: SimpleNamespace) -> str:
+    return str(object_store.root / S3_PATH.removeprefix("s3://"))
+
+
+def test_range_cache_evicts_least_recently_read(
+    tmp_path: Path, object_store: SimpleNamespace
+):
+    bucket = object_store.root / "bucket"
+    bucket.mkdir()
+    for name in "abc":
+        (bucket / name).write_bytes(name.encode() * 4096)
+    cache = RangeCacheFileSystem(
+        tmp_path / "cache",
+        endpoint=object_store.endpoint,
+        block_size=1024,
+        max_bytes=10_000,
+    )
+    for name in "ab":
+        cache.read_range(f"bucket/{name}", 0, 4096)
+    # Both written long ago, the first one before, then read again
+    os.utime(cache._blocks_dir("bucket/a"), (1000, 1000))
+    os.utime(cache._blocks_dir("bucket/b"), (2000, 2000))
+    assert cache.read_range("bucket/a", 0, 10) == b"a" * 10
+
+    cache.read_range("bucket/c", 0, 4096)
+    assert {blocks_dir for _, _, blocks_dir in cache._objects()} == {
+        cache._blocks_dir("bucket/a"),
+        cache._blocks_dir("bucket/c"),
+    }
+
+
+def test_range_cache_is_walked_only_over_budget(
+    tmp_path: Path, object_store: SimpleNamespace, monkeypatch: pytest.MonkeyPatch
+):
+    bucket = object_store.root / "bucket"
+    bucket.mkdir()
+    for name in "abc":
+        (bucket / name).write_bytes(name.encode() * 4096)
+    cache = RangeCacheFileSystem(
+        tmp_path / "cache",
+        endpoint=object_store.endpoint,
+        block_size=1024,
+        max_bytes=10_000,
+    )
+    walks = []
+    objects = cache._objects
+    monkeypatch.setattr(cache, "_objects", lambda: walks.append(1) or objects())
+
+    for name in "abc":
+        assert cache.read_range(f"bucket/{name}", 0, 4096) == name.encode() * 4096
+    # Once to count what's on disk, then once past the budget
+    assert len(walks) == 2
+    assert [size for _, size, _ in objects()] == [4096, 4096]
+    assert cache.read_range("bucket/c", 0, 10) == b"c" * 10
+    assert len(walks) == 2
@@ -0,0 +1,130 @@
+import asyncio
+import time
+
+import pytest
+
+from atlas_assistant import engine
+from atlas_assistant.governor import QueryRejected, is_truncated, parse_size
+from atlas_assistant.settings import Settings
+
+
+def test_parse_size():
+    assert parse_size("512MiB") == 512 * 1024**2
+    assert parse_size("2GB") == 2 * 1000**3
+    assert parse_size("1.5 kb") == 1500
+
+
+async def test_exploding_joins_are_rejected_before_running(parquet_dataset: dict):
+    path = parquet_dataset["s3"]
+    sql = f"SELECT count(*) FROM '{path}' a, '{path}' b, '{path}' c"
+    start = time.perf_counter()
+    with pytest.raises(QueryRejected, match="about 1,000,000,000,000 rows"):
+        await engine.run_query(sql, Settings(), governed=True)
+    assert time.perf_counter() - start < 1
+    assert engine.get_governor().stats["too_large"] == 1
+
+
+async def test_slow_queries_are_interrupted():
+    settings = Settings(query_timeout=0.2, query_max_estimated_rows=None)
+    start = time.perf_counter()
+    with pytest.raises(QueryRejected, match="longer than 0.2 seconds"):
+        await engine.run_query(
+            "SELECT sum(hash(i)) FROM range(1_000_000_000_000) t(i)",
+            settings,
+            governed=True,
+        )
+    assert time.perf_counter() - start < 2
+    # The database is still usable afterwards
+    table = await engine.run_query("SELECT 42 AS answer", settings, governed=True)
+    assert table.to_pylist() == [{"answer": 42}]
+
+
+async def test_results_are_capped(parquet_dataset: dict):
+    settings = Settings(query_max_rows=1000)
+    sql = f"SELECT * FROM '{parquet_dataset['s3']}'"
+    table = await engine.run_query(sql, settings, governed=True)
+    assert table.num_rows == 1000
+    assert is_truncated(table)
+    # Truncated results aren't cached, complete ones are capped when served
+    assert (await engine.run_query(sql, settings)).num_rows == 10_000
+    table = await engine.run_query(sql, settings, governed=True)
+    assert table.num_rows == 1000
+    assert is_truncated(table)
+
+
+async def test_queries_running_out_of_memory_are_rejected():
+    settings = Settings(query_memory_limit="32MiB", query_max_concurrent=1)
+    conn = engine.get_database(settings)
+    assert conn.sql("SELECT current_setting('memory_limit')").fetchone()[0] in (
+        "32.0 MiB",
+        "33.5 MB",
+    )
+    with pytest.raises(QueryRejected, match="out of memory"):
+        await engine.run_query(
+            "SELECT list(i) FROM range(50_000_000) t(i)", settings, governed=True
+        )
+
+
+async def test_queries_wait_for_a_slot():
+    settings = Settings(query_max_concurrent=1, query_queue_timeout=0.1)
+    governor = engine.get_governor(settings)
+    async with governor.admit():
+        with pytest.raises(QueryRejected, match="busy"):
+            await engine.run_query("SELECT 1", settings, governed=True)
+
+    governor.queue_timeout = 5
+    async with governor.admit():
+        query = asyncio.create_task(
+            engine.run_query("SELECT 1 AS one", settings, governed=True)
+        )
+        await asyncio.sleep(0.1)
+        assert governor.waiting == 1
+    assert (await query).to_pylist() == [{"one": 1}]
+    assert governor.stats["busy"] == 1
+    assert governor.stats["queued"] == 1
+
+
+async def test_cancelled_waiters_give_their_slot_back():
+    settings = Settings(query_max_concurrent=2, query_queue_timeout=5)
+    governor = engine.get_governor(settings)
+
+    async def wait_for_slot() -> None:
+        async with governor.admit():
+            pass
+
+    async with governor.admit(), governor.admit():
+        waiter = asyncio.create_task(wait_for_slot())
+        await asyncio.sleep(0.1)
+        assert governor.waiting == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+    # The waiter's thread took a slot as they were released, and gave it back
+    await asyncio.sleep(0.1)
+    governor.queue_timeout = 0.5
+    async with governor.admit(), governor.admit():
+        assert governor.waiting == 0
+    assert governor.stats["busy"] == 0
+
+
+async def test_cancelled_queries_are_interrupted():
+    workers = engine.get_executor()._max_workers
+    settings = Settings(query_max_estimated_rows=None, query_max_concurrent=workers)
+    governor = engine.get_governor(settings)
+    sql = "SELECT sum(hash(i)) FROM range(1_000_000_000_000) t(i)"
+    queries = [
+        asyncio.create_task(engine.run_query(sql, settings, governed=True))
+        for _ in range(workers)
+    ]
+    await asyncio.sleep(0.2)
+    start = time.perf_counter()
+    for query in queries:
+        query.cancel()
+    await asyncio.gather(*queries, return_exceptions=True)
+    assert time.perf_counter() - start < 2
+    assert governor.stats["timeout"] == 0
+    # Their threads are free again, not still scanning
+    table = await asyncio.wait_for(
+        engine.run_query("SELECT 42 AS answer", settings, governed=True), 2
+    )
+    assert table.to_pylist() == [{"answer": 42}]
@@ -0,0 +1,69 @@
+import pytest
+from conftest import ScriptedChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+
+from atlas_assistant.agent import create_graph
+from atlas_assistant.history import SUMMARY_HEADER, message_tokens, trim_history
+from atlas_assistant.settings import Settings
+
+ANSWER = "The cattle heat stress dataset covers Kenya and Mozambique. " * 20
+
+
+def tool_turn(i: int) -> list[BaseMessage]:
+    call = {"name": "create_chart_tool", "args": {"plot_query": f"q{i}"}, "id": f"c{i}"}
+    return [
+        HumanMessage(f"chart {i}"),
+        AIMessage("", tool_calls=[call]),
+        ToolMessage(
+            f"Created chart {i} with explanation: " + "bars " * 300,
+            tool_call_id=f"c{i}",
+            name="create_chart_tool",
+        ),
+        AIMessage(f"Here is chart {i}"),
+    ]
+
+
+async def test_input_stays_bounded_over_50_turns(monkeypatch: pytest.MonkeyPatch):
+    model = ScriptedChatModel(script=lambda messages: AIMessage(ANSWER))
+    monkeypatch.setattr(Settings, "get_chat_model", lambda self: model)
+    settings = Settings(history_keep_turns=3, history_max_tokens=2000)
+    graph = await create_graph(settings)
+    config = {"configurable": {"thread_id": "long"}}
+    for turn in range(50):
+        state = await graph.ainvoke(
+            {"messages": [("user", f"question {turn}")]}, config
+        )
+
+    sizes = [sum(map(message_tokens, messages)) for messages in model.inputs]
+    # The agent's system prompt comes on top of the trimmed history
+    assert max(sizes) <= settings.history_max_tokens + 200
+    assert sizes[-1] <= sizes[10] * 1.2
+    assert max(len(messages) for messages in model.inputs) <= 2 + 2 * 3
+    # The conversation itself is kept whole
+    assert len(state["messages"]) == 100
+    assert state["summarized_turns"] == 47
+    summary = model.inputs[-1][1].content
+    assert summary.startswith(SUMMARY_HEADER)
+    assert "User: question 46 | Assistant: The cattle" in summary
+
+
+def test_past_tool_results_are_cut():
+    messages = [message for i in range(3) for message in tool_turn(i)]
+    settings = Settings(history_keep_turns=2, history_tool_tokens=10)
+    llm_input, summary, summarized_turns = trim_history(messages, [], 0, settings)
+
+    assert summarized_turns == 1
+    assert summary[0].startswith("- User: chart 0 | create_chart_tool: Created")
+    assert summary[0].endswith("| Assistant: Here is chart 0")
+    tools = [message for message in llm_input if isinstance(message, ToolMessage)]
+    assert tools[0].content.endswith("…")
+    assert message_tokens(tools[0]) < 20
+    # The current turn is left whole
+    assert tools[1].content == messages[-2].content
+
+
+def test_hard_ceiling():
+    messages = [HumanMessage("Plot this table: " + "1,2,3\n" * 5000)]
+    settings = Settings(history_max_tokens=500)
+    llm_input, _, _ = trim_history(messages, [], 0, settings)
+    assert sum(map(message_tokens, llm_input)) <= 500
@@ -0,0 +1,155 @@
+import asyncio
+import http.server
+import json
+import threading
+import time
+from collections.abc import Iterator
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+from pydantic import BaseModel
+
+from atlas_assistant import llm
+from atlas_assistant.llm import TokenBucket, get_llm_gateway
+from atlas_assistant.settings import Settings
+
+USAGE = {"prompt_tokens": 12, "completion_tokens": 3, "total_tokens": 15}
+
+
+class Answer(BaseModel):
+    text: str
+
+
+class MistralStubHandler(http.server.BaseHTTPRequestHandler):
+    """Answers chat completions like the Mistral API, failing on demand."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.clients.add(self.client_address)
+        time.sleep(self.server.latency)
+        if self.server.failures:
+            status = self.server.failures.pop(0)
+            data = b'{"message": "try again"}'
+            self.send_response(status)
+            if status == 429:
+                self.send_header("Retry-After", "0")
+        else:
+            data = json.dumps(
+                {
+                    "id": "stub",
+                    "object": "chat.completion",
+                    "model": body["model"],
+                    "created": 0,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {
+                                "role": "assistant",
+                                "content": '{"text": "ok"}',
+                            },
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": USAGE,
+                }
+            ).encode()
+            self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+@pytest.fixture
+def mistral_stub() -> Iterator[SimpleNamespace]:
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MistralStubHandler)
+    server.clients = set()
+    server.failures = []
+    server.latency = 0.0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    yield SimpleNamespace(server=server, endpoint=f"http://{host}:{port}")
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def stub_settings(mistral_stub: SimpleNamespace) -> Settings:
+    return Settings(
+        mistral_api_key="test",
+        mistral_endpoint=mistral_stub.endpoint,
+        llm_max_connections=4,
+        llm_backoff_base=0.01,
+        llm_max_retries=2,
+    )
+
+
+async def ask_codestral(settings: Settings) -> Answer:
+    codestral = get_llm_gateway(settings).codestral()
+    response = await codestral.chat.parse_async(
+        model="codestral-latest",
+        messages=[{"role": "user", "content": "hello"}],
+        response_format=Answer,
+    )
+    return response.choices[0].message.parsed
+
+
+async def test_shared_connections_under_load(
+    mistral_stub: SimpleNamespace, stub_settings: Settings
+):
+    mistral_stub.server.latency = 0.02
+    chat_model = stub_settings.get_chat_model()
+    n = 24
+    results = await asyncio.gather(
+        *(ask_codestral(stub_settings) for _ in range(n)),
+        *(chat_model.ainvoke("hello") for _ in range(n)),
+    )
+
+    assert all(result.text == "ok" for result in results[:n])
+    assert all(result.content == '{"text": "ok"}' for result in results[n:])
+    # Both clients share the pool of 4 connections
+    assert len(mistral_stub.server.clients) <= 4
+    stats = get_llm_gateway(stub_settings).transport.stats
+    assert stats["codestral-latest"].calls == n
+    assert stats["mistral-small-latest"].calls == n
+    assert stats["codestral-latest"].prompt_tokens == n * USAGE["prompt_tokens"]
+    assert "codestral-latest: 24 calls, 0 failed" in llm.llm_report()
+
+
+async def test_retries_rate_limited_and_failed_calls(
+    mistral_stub: SimpleNamespace, stub_settings: Settings
+):
+    mistral_stub.server.failures = [429, 503]
+    assert (await ask_codestral(stub_settings)).text == "ok"
+    stats = get_llm_gateway(stub_settings).transport.stats["codestral-latest"]
+    assert (stats.calls, stats.retries, stats.failures) == (1, 2, 0)
+
+
+async def test_gives_up_after_max_retries(
+    mistral_stub: SimpleNamespace, stub_settings: Settings
+):
+    mistral_stub.server.failures = [503] * 3
+    with pytest.raises(Exception, match="503"):
+        await ask_codestral(stub_settings)
+    stats = get_llm_gateway(stub_settings).transport.stats["codestral-latest"]
+    assert (stats.calls, stats.retries, stats.failures) == (1, 2, 1)
+
+
+def test_token_bucket(monkeypatch: pytest.MonkeyPatch):
+    now = 0.0
+    monkeypatch.setattr(llm.time, "monotonic", lambda: now)
+    bucket = TokenBucket(per_minute=60, capacity=2)
+    # A burst of the capacity, then one more per second
+    assert [bucket.reserve(1) for _ in range(4)] == [0, 0, 1, 2]
+    now = 10.0
+    assert bucket.reserve(1) == 0
+    # Calls that used fewer tokens than reserved give them back
+    bucket.adjust(-5)
+    assert bucket.level == 2
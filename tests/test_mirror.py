@@ -0,0 +1,157 @@
+import os
+import shutil
+from pathlib import Path
+from types import SimpleNamespace
+
+import duckdb
+import pytest
+
+from atlas_assistant import catalog, engine, mirror
+from atlas_assistant.layout import Layout
+from atlas_assistant.mirror import DatasetMirror
+from atlas_assistant.settings import Settings
+
+S3_PATH = "s3://digital-atlas/hazards/test.parquet"
+QUERY = (
+    f"SELECT admin0_name, round(avg(value), 6) FROM '{S3_PATH}' GROUP BY ALL ORDER BY 1"
+)
+
+
+@pytest.fixture
+def remote_file(object_store: SimpleNamespace, parquet_dataset: dict) -> Path:
+    path = object_store.root / "digital-atlas" / "hazards" / "test.parquet"
+    path.parent.mkdir(parents=True)
+    shutil.copy(parquet_dataset["s3"], path)
+    return path
+
+
+@pytest.fixture
+def mirror_settings(tmp_path: Path, object_store: SimpleNamespace) -> Settings:
+    return Settings(
+        dataset_mirror_dir=tmp_path / "mirror",
+        duckdb_s3_endpoint=object_store.endpoint,
+        duckdb_cache_dir=None,
+        result_cache_enabled=False,
+    )
+
+
+def make_mirror(
+    settings: Settings, max_age: float | None = None, layout: Layout | None = None
+) -> DatasetMirror:
+    return DatasetMirror(
+        settings.dataset_mirror_dir,
+        s3_endpoint=settings.duckdb_s3_endpoint,
+        max_age=max_age,
+        layout=layout,
+    )
+
+
+def downloads(object_store: SimpleNamespace) -> int:
+    return sum(method == "GET" for method, _ in object_store.requests)
+
+
+async def test_sync_is_incremental(
+    mirror_settings: Settings, object_store: SimpleNamespace, remote_file: Path
+):
+    dataset_mirror = make_mirror(mirror_settings)
+    stats = await dataset_mirror.sync([S3_PATH])
+    assert stats == {"downloaded": 1, "unchanged": 0, "failed": 0}
+    local = dataset_mirror.local_path(S3_PATH)
+    assert local.read_bytes() == remote_file.read_bytes()
+
+    stats = await make_mirror(mirror_settings).sync([S3_PATH])
+    assert stats == {"downloaded": 0, "unchanged": 1, "failed": 0}
+    assert downloads(object_store) == 1
+
+    stat = remote_file.stat()
+    os.utime(remote_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    stats = await dataset_mirror.sync([S3_PATH])
+    assert stats == {"downloaded": 1, "unchanged": 0, "failed": 0}
+
+
+async def test_corrupt_downloads_are_rejected(
+    mirror_settings: Settings,
+    monkeypatch: pytest.MonkeyPatch,
+    remote_file: Path,
+):
+    head = mirror.head
+    monkeypatch.setattr(mirror, "head", lambda url: {**head(url), "ETag": "0" * 32})
+    dataset_mirror = make_mirror(mirror_settings)
+    stats = await dataset_mirror.sync([S3_PATH])
+    assert stats["failed"] == 1
+    assert dataset_mirror.local_path(S3_PATH) is None
+    assert not dataset_mirror.local_file(S3_PATH).exists()
+
+
+async def test_queries_read_fresh_local_copies(
+    mirror_settings: Settings, object_store: SimpleNamespace, remote_file: Path
+):
+    expected = engine.fetch_table(
+        QUERY.replace(S3_PATH, str(remote_file)), mirror_settings
+    )
+    await make_mirror(mirror_settings).sync([S3_PATH])
+    object_store.requests.clear()
+
+    assert engine.fetch_table(QUERY, mirror_settings).equals(expected)
+    assert object_store.requests == []
+
+
+async def test_stale_copies_fall_back_to_remote(
+    mirror_settings: Settings, remote_file: Path
+):
+    await make_mirror(mirror_settings).sync([S3_PATH])
+    stale = make_mirror(mirror_settings, max_age=0)
+    assert stale.local_path(S3_PATH) is None
+    assert stale.rewrite_sql(QUERY) == QUERY
+    fresh = make_mirror(mirror_settings, max_age=60)
+    assert str(fresh.local_file(S3_PATH)) in fresh.rewrite_sql(QUERY)
+
+
+async def test_copies_are_sorted_for_pushdown(
+    mirror_settings: Settings, remote_file: Path
+):
+    layout = Layout(
+        sort_by=["admin0_name", "population", "scenario"], row_group_size=2048
+    )
+    dataset_mirror = make_mirror(mirror_settings, layout=layout)
+    await dataset_mirror.sync([S3_PATH])
+    assert dataset_mirror.local_layout(S3_PATH).sort_by == ["admin0_name", "scenario"]
+
+    row_groups = duckdb.sql(
+        f"""
+        SELECT stats_min_value, stats_max_value
+        FROM parquet_metadata('{dataset_mirror.local_path(S3_PATH)}')
+        WHERE path_in_schema = 'admin0_name'
+        ORDER BY row_group_id
+        """
+    ).fetchall()
+    assert len(row_groups) == 5
+    # Each row group holds a range of countries that follows the previous one
+    for (_, previous_max), (next_min, _) in zip(
+        row_groups, row_groups[1:], strict=False
+    ):
+        assert previous_max <= next_min
+
+    # Another layout makes the next sync rewrite the copy
+    stats = await make_mirror(mirror_settings, layout=Layout()).sync([S3_PATH])
+    assert stats["downloaded"] == 1
+
+
+async def test_partitioned_copies_are_profiled_and_queried(
+    mirror_settings: Settings, object_store: SimpleNamespace, remote_file: Path
+):
+    settings = mirror_settings.model_copy(
+        update={"dataset_layout_partition_by": ["admin0_name"]}
+    )
+    expected = engine.fetch_table(QUERY.replace(S3_PATH, str(remote_file)), settings)
+    engine.get_database(settings)
+    await engine.get_dataset_mirror().sync([S3_PATH])
+    assert engine.get_dataset_mirror().local_path(S3_PATH).is_dir()
+    object_store.requests.clear()
+
+    assert engine.fetch_table(QUERY, settings).equals(expected)
+    profile = catalog.profile_dataset({"key": "test", "s3": S3_PATH}, settings)
+    assert profile.num_rows == 10_000
+    assert profile.layout.partition_by == ["admin0_name"]
+    assert profile.layout.sort_by == ["admin1_name", "scenario", "timeframe"]
+    assert object_store.requests == [("HEAD", None)]
@@ -0,0 +1,93 @@
+import numpy as np
+import plotly.express as px
+import pyarrow as pa
+
+from atlas_assistant.payload import compact_figure, dumps, loads, lttb, to_array
+
+N = 100_000
+
+
+def test_lttb_keeps_the_peaks():
+    x = np.arange(N)
+    y = np.sin(x / 1000)
+    y[31_337] = 50
+    indices = lttb(x, y, 500)
+    assert 450 < len(indices) <= 500
+    assert indices[0] == 0 and indices[-1] == N - 1
+    assert np.all(np.diff(indices) > 0)
+    assert 31_337 in indices
+    assert y[indices].min() < -0.99
+
+
+def test_lines_are_downsampled_and_typed():
+    rng = np.random.default_rng(0)
+    table = pa.table(
+        {
+            "day": np.arange(N),
+            "value": rng.normal(size=N).cumsum(),
+            "scenario": np.array(["ssp126", "ssp585"])[np.arange(N) % 2],
+        }
+    )
+    figure = compact_figure(
+        px.line(table, x="day", y="value", color="scenario").to_plotly_json(), 1000
+    )
+    data = loads(dumps(figure))
+    for trace in data["data"]:
+        assert trace["x"]["dtype"] == "i4"
+        assert 900 < len(to_array(trace["x"])) == len(to_array(trace["y"])) <= 1000
+    assert len(dumps(figure)) < 100_000
+
+
+def test_histograms_are_binned():
+    rng = np.random.default_rng(0)
+    table = pa.table(
+        {
+            "value": rng.normal(size=N),
+            "scenario": np.array(["a", "b"])[np.arange(N) % 2],
+        }
+    )
+    figure = compact_figure(
+        px.histogram(table, x="value", color="scenario").to_plotly_json(), 1000
+    )
+    bars = figure["data"]
+    assert [trace["type"] for trace in bars] == ["bar", "bar"]
+    assert sum(to_array(trace["y"]).sum() for trace in bars) == N
+    # One color's bars line up with the other's
+    assert np.array_equal(to_array(bars[0]["x"]), to_array(bars[1]["x"]))
+    assert len(to_array(bars[0]["x"])) <= 100
+    assert figure["layout"]["bargap"] == 0
+
+
+def test_boxes_are_summarized():
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=N)
+    countries = np.array(["Kenya", "Ghana"])[np.arange(N) % 2]
+    figure = compact_figure(
+        px.box(
+            pa.table({"country": countries, "value": values}), x="country", y="value"
+        ).to_plotly_json(),
+        1000,
+    )
+    box = loads(dumps(figure))["data"][0]
+    assert "y" not in box
+    assert box["x"] == ["Kenya", "Ghana"]
+    assert to_array(box["median"])[0] == np.median(values[countries == "Kenya"])
+    assert to_array(box["q3"])[1] == np.percentile(values[countries == "Ghana"], 75)
+
+
+def test_small_figures_are_left_alone():
+    figure = px.scatter(pa.table({"a": [1, 2, 3], "b": [3.0, 1.0, 2.0]}), x="a", y="b")
+    compacted = compact_figure(figure.to_plotly_json(), 1000)
+    assert to_array(compacted["data"][0]["y"]).tolist() == [3.0, 1.0, 2.0]
+
+
+def test_marker_clouds_keep_their_outliers():
+    rng = np.random.default_rng(0)
+    x, y = rng.normal(size=N), rng.normal(size=N)
+    x[123], y[123] = 30, -30
+    figure = compact_figure(
+        px.scatter(pa.table({"x": x, "y": y}), x="x", y="y").to_plotly_json(), 900
+    )
+    trace = figure["data"][0]
+    assert len(trace["x"]) <= 900
+    assert (30, -30) in zip(trace["x"], trace["y"], strict=True)
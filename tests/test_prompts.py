@@ -0,0 +1,84 @@
+from atlas_assistant.catalog import ColumnProfile, DatasetProfile
+from atlas_assistant.prompts import count_tokens, dataset_context, truncate_tokens
+from atlas_assistant.settings import Settings
+
+CROPS = [f"crop_{i}" for i in range(200)] + ["maize"]
+COUNTRIES = [f"Country {i}" for i in range(50)] + ["Kenya"]
+
+
+def wide_profile() -> DatasetProfile:
+    return DatasetProfile(
+        key="cs_crop",
+        s3="s3://digital-atlas/crops.parquet",
+        file_version="v1",
+        num_rows=1000,
+        num_row_groups=1,
+        columns=[
+            ColumnProfile(
+                name="admin0_name", type="VARCHAR", distinct_values=COUNTRIES
+            ),
+            ColumnProfile(name="scenario", type="INTEGER", distinct_values=[126, 585]),
+            *(
+                ColumnProfile(name=f"{crop}_suitability", type="DOUBLE", min=0, max=1)
+                for crop in CROPS
+            ),
+        ],
+    )
+
+
+DATASET = {
+    "name": "tbl_crop",
+    "info": "CropSuite - Crop Suitability",
+    "note": "Suitability of each crop. " * 200,
+    "s3": "s3://digital-atlas/crops.parquet",
+}
+
+
+def test_token_budgets():
+    settings = Settings(prompt_profile_tokens=300, prompt_note_tokens=40)
+    context = dataset_context(
+        DATASET, wide_profile(), "maize suitability in Kenya", settings
+    )
+    profile = context["dataset_profile"]
+
+    assert count_tokens(profile) <= 300
+    assert "maize_suitability,DOUBLE" in profile
+    assert "crop_199_suitability" not in profile
+    # Values mentioned by the request are kept when the list is cut
+    assert "Kenya|Country 0|" in profile
+    assert "… 31 more" in profile
+    assert "Other columns, not described here: crop_" in context["dataset_info"]
+    assert count_tokens(context["dataset_info"]) < 150
+
+
+def test_small_datasets_are_described_whole():
+    profile = wide_profile()
+    profile.columns = profile.columns[:4]
+    context = dataset_context(DATASET, profile, "anything", Settings())
+    assert context["dataset_profile"].count("\n") == 5
+    assert "Other columns" not in context["dataset_info"]
+
+
+def test_truncate_tokens():
+    assert truncate_tokens("Scenarios available = 126, 585", 3) == "Scenarios…"
+    assert truncate_tokens("short", 3) == "short"
+
+
+def test_views_keep_their_filters():
+    dataset = {
+        "name": "tbl_hazard_ntx",
+        "info": "Extreme heat days",
+        "s3": "s3://digital-atlas/hazards/ntx.parquet",
+        "sql": """
+      CREATE VIEW __name__ AS (
+        select *
+          from read_parquet('__s3__')
+          where hazard = 'NTx35'
+      )
+    """,
+    }
+    settings = Settings(prompt_note_tokens=5)
+    info = dataset_context(dataset, wide_profile(), "heat", settings)["dataset_info"]
+    assert "CREATE VIEW tbl_hazard_ntx AS (" in info
+    assert "read_parquet('s3://digital-atlas/hazards/ntx.parquet')" in info
+    assert "where hazard = 'NTx35'" in info
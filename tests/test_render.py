@@ -0,0 +1,33 @@
+import plotly.express as px
+import pyarrow as pa
+
+from atlas_assistant.blobs import BlobRef
+from atlas_assistant.render import chart_key, describe_update, summarize
+
+
+def test_large_values_are_described_by_size():
+    points = 100_000
+    figure = px.line(
+        pa.table({"x": list(range(points)), "y": [0.5] * points}), x="x", y="y"
+    ).to_plotly_json()
+    description = describe_update(
+        {
+            "chart": figure,
+            "chart_data": {"columns": ["x", "y"], "num_rows": points, "data": {}},
+            "chart_query": "SELECT * FROM t WHERE " + "x > 1 AND " * 100,
+        }
+    )
+    assert "chart: <figure, 1 traces: scattergl>" in description
+    assert f"chart_data: <table, {points} rows x 2 columns>" in description
+    assert "chars)" in description
+    assert len(description) < 300
+
+
+def test_blobs_and_limits():
+    ref = BlobRef(blob="abc", size=2_500_000, media_type="application/json")
+    assert summarize(ref) == "<stored application/json, 2 MB>"
+    assert summarize(ref.model_dump()) == summarize(ref)
+    assert chart_key(ref) == chart_key(ref.model_dump()) == "abc"
+    description = describe_update({f"field{i}": "x" * 70 for i in range(20)})
+    assert len(description) < 600
+    assert description.endswith("more fields")
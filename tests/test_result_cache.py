@@ -0,0 +1,91 @@
+import os
+from pathlib import Path
+
+import pyarrow as pa
+import pytest
+
+from atlas_assistant import engine
+from atlas_assistant.result_cache import ResultCache, canonicalize_sql
+
+
+def test_canonicalize_sql():
+    sql = """
+      SELECT  Admin0_Name, AVG(value)
+      FROM 'S3://Bucket/File.parquet'
+      WHERE admin0_name = 'Kenya';
+    """
+    assert canonicalize_sql(sql) == (
+        "select admin0_name, avg(value) from 'S3://Bucket/File.parquet' "
+        "where admin0_name = 'Kenya'"
+    )
+
+
+def test_key_follows_file_version(parquet_dataset: dict):
+    cache = ResultCache(version_ttl=0)
+    path = parquet_dataset["s3"]
+    sql = f"SELECT count(*) FROM '{path}'"
+    key = cache.key(sql)
+    assert key == cache.key(f"select   COUNT(*)\nfrom '{path}'")
+    assert cache.key(f"COPY (SELECT 1) TO '{path}'") is None
+    assert cache.key("SELECT 42") is None
+
+    os.utime(path, ns=(0, 0))
+    assert cache.key(sql) != key
+
+
+def test_memory_budget():
+    table = pa.table({"x": list(range(1000))})
+    cache = ResultCache(memory_bytes=20_000)
+    for key in "abcd":
+        cache.put(key, table)
+    assert cache.stats()["evictions"] > 0
+    assert cache.get("a") is None
+    assert cache.get("d").column("x").to_pylist() == list(range(1000))
+
+
+def test_disk_tier_survives_restart(tmp_path: Path):
+    table = pa.table({"country": ["Kenya", "Ghana"], "value": [1.5, 2.5]})
+    ResultCache(tmp_path).put("key", table, elapsed=2.0)
+
+    cache = ResultCache(tmp_path)
+    assert cache.get("key").to_pydict() == table.to_pydict()
+    assert cache.get("key") is not None
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["seconds_saved"] == pytest.approx(4.0)
+
+
+def test_disk_tier_is_walked_only_over_budget(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    table = pa.table({"x": list(range(1000))})
+    ResultCache(tmp_path / "sizes").put("a", table)
+    size = (tmp_path / "sizes" / "a.arrow").stat().st_size
+    cache = ResultCache(tmp_path / "cache", disk_bytes=int(size * 2.5))
+    walks = []
+    prune_disk = cache._prune_disk
+    monkeypatch.setattr(cache, "_prune_disk", lambda: walks.append(1) or prune_disk())
+
+    for key in "abc":
+        cache.put(key, table)
+    # Once to count what's on disk, then once past the budget
+    assert len(walks) == 2
+    assert sorted(file.stem for file in (tmp_path / "cache").glob("*.arrow")) == [
+        "b",
+        "c",
+    ]
+    assert cache.disk_size == 2 * size
+    cache.put("c", table)
+    assert len(walks) == 2
+    assert cache.disk_size == 2 * size
+    assert cache.stats()["memory_bytes"] == 3 * size
+
+
+async def test_engine_serves_repeated_queries_from_the_cache(parquet_dataset: dict):
+    sql = (
+        "SELECT admin0_name, avg(value) AS value "
+        f"FROM '{parquet_dataset['s3']}' GROUP BY ALL ORDER BY 1"
+    )
+    first = await engine.run_query(sql)
+    second = await engine.run_query(sql.replace("SELECT", "select"))
+    assert second.equals(first)
+    assert engine.get_result_cache().stats()["hits"] == 1
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from atlas_assistant import vectorstore
+from atlas_assistant.retriever import DatasetRetriever, get_dataset_retriever, top_k
+from atlas_assistant.settings import Settings
+
+
+@pytest.fixture
+async def retriever(offline_settings: Settings) -> DatasetRetriever:
+    store = await vectorstore.get_datasets_vectorstore(offline_settings)
+    return DatasetRetriever.from_vectorstore(store, mode="hybrid", hybrid_margin=0.3)
+
+
+def test_top_k():
+    scores = np.array([[0.1, 0.9, 0.5, 0.7], [1.0, 0.0, 0.2, 0.3]])
+    indices, top = top_k(scores, 2)
+    assert indices.tolist() == [[1, 3], [0, 3]]
+    assert top.tolist() == [[0.9, 0.7], [1.0, 0.3]]
+
+
+async def test_vector_search_matches_chroma(
+    offline_settings: Settings, retriever: DatasetRetriever
+):
+    store = await vectorstore.get_datasets_vectorstore(offline_settings)
+    query = "cattle heat stress"
+    expected = [doc.id for doc, _ in store.similarity_search_with_score(query, k=3)]
+    vector = retriever.embedder.embed_query(query)
+    results = retriever.search_by_vectors(np.array([vector, vector]), k=3)
+    assert [[doc.id for doc, _ in result] for result in results] == [expected] * 2
+
+
+async def test_lexical_search(retriever: DatasetRetriever):
+    results = retriever.search_lexical("cattle heatstress", k=3)
+    assert results[0][0].metadata["key"] == "cattle_hs"
+    assert results[0][1] > results[1][1]
+
+
+async def test_hybrid_only_embeds_when_ambiguous(retriever: DatasetRetriever):
+    results = await retriever.asearch("cattle heatstress")
+    assert results[0][0].metadata["key"] == "cattle_hs"
+    assert retriever.embedding_calls == 0
+
+    await retriever.asearch("zzz unknown words")
+    assert retriever.embedding_calls == 1
+
+
+async def test_shared_retriever_follows_reload(offline_settings: Settings):
+    first = await get_dataset_retriever(offline_settings)
+    assert first is await get_dataset_retriever(offline_settings)
+    vectorstore.reload_datasets_vectorstore(offline_settings)
+    assert first is not await get_dataset_retriever(offline_settings)
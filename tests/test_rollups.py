@@ -0,0 +1,109 @@
+import math
+import os
+
+import pytest
+from conftest import FakeCodestral
+from test_create_chart import make_chart
+
+from atlas_assistant import engine, rollups
+from atlas_assistant.settings import get_settings
+
+
+@pytest.fixture
+async def router(parquet_dataset: dict) -> rollups.RollupRouter:
+    manifest = await rollups.refresh_rollups([parquet_dataset])
+    rollups.save_manifest(manifest, get_settings().rollup_dir / "manifest.json")
+    return rollups.get_rollup_router()
+
+
+def assert_same_results(rewritten: str, sql: str):
+    expected = engine.fetch_table(sql)
+    actual = engine.fetch_table(rewritten)
+    assert actual.schema == expected.schema
+    for got, want in zip(actual.to_pylist(), expected.to_pylist(), strict=False):
+        for name, value in want.items():
+            if isinstance(value, float):
+                assert math.isclose(got[name], value)
+            else:
+                assert got[name] == value
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "SELECT admin0_name, avg(value) FROM '{path}' GROUP BY ALL ORDER BY 1",
+        """
+        SELECT admin0_name AS country, scenario, avg(value) AS mean, max(value),
+          count(*)
+        FROM '{path}'
+        WHERE timeframe = 2045
+        GROUP BY admin0_name, scenario
+        ORDER BY mean DESC, scenario
+        """,
+        """
+        SELECT admin1_name, sum(value) AS total, count(value) AS n
+        FROM read_parquet('{path}')
+        WHERE admin0_name IN ('Kenya', 'Ghana')
+        GROUP BY 1
+        HAVING sum(value) > 10
+        ORDER BY total, admin1_name
+        """,
+        "SELECT round(avg(value) * 100, 1) AS pct, min(timeframe) FROM '{path}'",
+        "SELECT DISTINCT scenario FROM '{path}' ORDER BY scenario",
+    ],
+)
+async def test_routed_queries_match(
+    router: rollups.RollupRouter, parquet_dataset: dict, query: str
+):
+    sql = query.format(path=parquet_dataset["s3"])
+    rewritten = router.route(sql, parquet_dataset, get_settings())
+    assert rewritten is not None
+    assert get_settings().rollup_dir.name in rewritten
+    assert_same_results(rewritten, sql)
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "SELECT * FROM '{path}' LIMIT 5",
+        "SELECT admin0_name, value FROM '{path}' WHERE value > 9",
+        "SELECT admin0_name, median(value) FROM '{path}' GROUP BY 1",
+        "SELECT admin0_name, avg(value) FROM '{path}' WHERE value > 1 GROUP BY 1",
+        "SELECT count(DISTINCT value) FROM '{path}'",
+        "SELECT avg(value) OVER () FROM '{path}'",
+    ],
+)
+async def test_other_queries_read_the_dataset(
+    router: rollups.RollupRouter, parquet_dataset: dict, query: str
+):
+    sql = query.format(path=parquet_dataset["s3"])
+    assert router.route(sql, parquet_dataset, get_settings()) is None
+    assert router.fetch_table(sql, parquet_dataset).equals(engine.fetch_table(sql))
+    assert router.stats["test_heat"] == {"not_routable": 2}
+
+
+async def test_stale_rollups_are_refreshed(
+    router: rollups.RollupRouter, parquet_dataset: dict
+):
+    sql = f"SELECT scenario, sum(value) FROM '{parquet_dataset['s3']}' GROUP BY 1"
+    router.version_ttl = 0
+    stat = os.stat(parquet_dataset["s3"])
+    os.utime(parquet_dataset["s3"], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert router.route(sql, parquet_dataset, get_settings()) is None
+
+    path = get_settings().rollup_dir / "manifest.json"
+    manifest = await rollups.refresh_rollups(
+        [parquet_dataset], manifest=rollups.load_manifest(path)
+    )
+    rollups.save_manifest(manifest, path)
+    assert router.route(sql, parquet_dataset, get_settings()) is not None
+    assert router.report() == "test_heat: 1/2 queries on rollups (50%), stale 1"
+
+
+async def test_chart_queries_are_routed(
+    fake_codestral: FakeCodestral,
+    router: rollups.RollupRouter,
+    parquet_dataset: dict,
+):
+    await make_chart(parquet_dataset)
+    assert router.stats["test_heat"] == {"routed": 1}
@@ -0,0 +1,191 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from conftest import FakeCodestral
+from langchain_core.embeddings import Embeddings
+
+from atlas_assistant import semantic_cache
+from atlas_assistant.catalog import ColumnProfile, DatasetProfile
+from atlas_assistant.prompts import request_literals
+from atlas_assistant.semantic_cache import SemanticCache
+from atlas_assistant.settings import get_settings
+from atlas_assistant.state import AgentState
+from atlas_assistant.tools.create_chart import create_chart
+
+ANSWER = {"sql_query": "SELECT 1", "plot": {}}
+
+
+class AngleEmbeddings(Embeddings):
+    """Embeds texts as unit vectors at the angle, in degrees, they're mapped to."""
+
+    def __init__(self, angles: dict[str, float]):
+        self.angles = angles
+
+    def embed_query(self, text: str) -> list[float]:
+        angle = np.radians(self.angles[text])
+        return [float(np.cos(angle)), float(np.sin(angle))]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+EMBEDDINGS = AngleEmbeddings(
+    {
+        "cattle heat stress by country": 0,
+        "heat stress in cattle per country": 10,  # cos 10° = 0.985
+        "crop suitability in Kenya": 60,
+    }
+)
+
+
+async def test_similar_requests_reuse_the_answer():
+    cache = SemanticCache(EMBEDDINGS, threshold=0.95)
+    scope = ("s3://a.parquet", "v1", "fast")
+    await cache.put("cattle heat stress by country", *scope, ANSWER, cost=2.0)
+
+    assert await cache.get("heat stress in cattle per country", *scope) == ANSWER
+    assert await cache.get("crop suitability in Kenya", *scope) is None
+    for other in [
+        ("s3://b.parquet", "v1", "fast"),
+        ("s3://a.parquet", "v1", "code"),
+    ]:
+        assert await cache.get("cattle heat stress by country", *other) is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["seconds_saved"]) == (1, 3, 2.0)
+    assert cache.report() == "1/4 charts from the cache (25%), 2.0s of LLM calls saved"
+
+
+async def test_answers_persist(tmp_path: Path):
+    path = tmp_path / "chart-cache.sqlite3"
+    scope = ("s3://a.parquet", "v1", "fast")
+    cache = SemanticCache(EMBEDDINGS, path=path)
+    await cache.put("cattle heat stress by country", *scope, ANSWER, cost=1.0)
+
+    reopened = SemanticCache(EMBEDDINGS, path=path)
+    assert await reopened.get("heat stress in cattle per country", *scope) == ANSWER
+
+
+async def test_schema_change_drops_answers(tmp_path: Path):
+    cache = SemanticCache(EMBEDDINGS, path=tmp_path / "cache.sqlite3")
+    await cache.put("cattle heat stress by country", "a", "v1", "fast", ANSWER, 1.0)
+    await cache.put("crop suitability in Kenya", "a", "v2", "fast", ANSWER, 1.0)
+
+    assert await cache.get("cattle heat stress by country", "a", "v1", "fast") is None
+    assert len(SemanticCache(EMBEDDINGS, path=tmp_path / "cache.sqlite3").entries) == 1
+
+
+async def test_eviction(monkeypatch: pytest.MonkeyPatch):
+    now = 1000.0
+    monkeypatch.setattr(semantic_cache.time, "time", lambda: now)
+    cache = SemanticCache(EMBEDDINGS, threshold=0.99, ttl=100, max_entries=2)
+    for query in EMBEDDINGS.angles:
+        await cache.put(query, "a", "v1", "fast", {"query": query}, 1.0)
+        now += 10
+    # The least recently used answer made room for the last one
+    assert await cache.get("cattle heat stress by country", "a", "v1", "fast") is None
+    assert await cache.get("crop suitability in Kenya", "a", "v1", "fast") is not None
+
+    now += 100
+    assert await cache.get("crop suitability in Kenya", "a", "v1", "fast") is None
+    assert not cache.entries
+
+
+async def test_requests_with_other_literals_miss():
+    profile = DatasetProfile(
+        key="rain",
+        s3="s3://a.parquet",
+        file_version="v1",
+        num_rows=10,
+        num_row_groups=1,
+        columns=[
+            ColumnProfile(
+                name="admin0_name",
+                type="VARCHAR",
+                distinct_values=["Kenya", "Mozambique"],
+            )
+        ],
+    )
+    embeddings = AngleEmbeddings(
+        {
+            "rainfall in Kenya": 0,
+            "rainfall in Mozambique": 1,
+            "rainfall in Kenya since 2030": 2,
+        }
+    )
+    cache = SemanticCache(embeddings, threshold=0.99)
+    scope = ("s3://a.parquet", "v1", "fast")
+    kenya = request_literals("rainfall in Kenya", profile)
+    assert kenya == ["kenya"]
+    await cache.put("rainfall in Kenya", *scope, ANSWER, 1.0, literals=kenya)
+
+    for query in ["rainfall in Mozambique", "rainfall in Kenya since 2030"]:
+        literals = request_literals(query, profile)
+        assert await cache.get(query, *scope, literals=literals) is None
+    # Not the literals but the embedding tells these two apart
+    assert await cache.get("rainfall in Mozambique", *scope, literals=kenya) == ANSWER
+
+
+async def test_embedding_model_change_drops_answers(tmp_path: Path):
+    path = tmp_path / "cache.sqlite3"
+    scope = ("s3://a.parquet", "v1", "fast")
+    cache = SemanticCache(EMBEDDINGS, model="mistral-embed", path=path)
+    await cache.put("cattle heat stress by country", *scope, ANSWER, cost=1.0)
+
+    assert SemanticCache(EMBEDDINGS, model="mistral-embed", path=path).entries
+    assert not SemanticCache(EMBEDDINGS, model="other-embed", path=path).entries
+
+
+@pytest.mark.parametrize("mode, llm_calls", [("fast", 1), ("code", 2)])
+async def test_create_chart_reuses_answers(
+    fake_codestral: FakeCodestral,
+    parquet_dataset: dict,
+    monkeypatch: pytest.MonkeyPatch,
+    mode: str,
+    llm_calls: int,
+):
+    monkeypatch.setenv("CHART_MODE", mode)
+    get_settings.cache_clear()
+    cache = SemanticCache(EMBEDDINGS)
+    monkeypatch.setattr(semantic_cache, "_cache", cache)
+    commands = [
+        await create_chart.coroutine(
+            plot_query=query,
+            tool_call_id="call",
+            state=AgentState(messages=[], dataset=parquet_dataset),
+        )
+        for query in [
+            "cattle heat stress by country",
+            "heat stress in cattle per country",
+        ]
+    ]
+
+    assert len(fake_codestral.calls) == llm_calls
+    assert commands[0].update["chart_query"] == commands[1].update["chart_query"]
+    assert commands[0].update["python_code"] == commands[1].update["python_code"]
+    assert cache.stats()["hits"] == 1
+
+
+async def test_views_of_one_file_keep_their_answers(
+    fake_codestral: FakeCodestral,
+    parquet_dataset: dict,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    cache = SemanticCache(EMBEDDINGS)
+    monkeypatch.setattr(semantic_cache, "_cache", cache)
+    wet = {
+        **parquet_dataset,
+        "key": "test_heat_wet",
+        "sql": "SELECT * FROM '__s3__' WHERE scenario = 585",
+    }
+    for dataset in [parquet_dataset, wet, parquet_dataset, wet]:
+        await create_chart.coroutine(
+            plot_query="cattle heat stress by country",
+            tool_call_id="call",
+            state=AgentState(messages=[], dataset=dataset),
+        )
+
+    # One answer per view, neither dropping the other
+    assert len(fake_codestral.calls) == 2
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["entries"] == 2
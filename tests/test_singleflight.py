@@ -0,0 +1,149 @@
+import asyncio
+
+import pytest
+from conftest import FakeCodestral
+from langchain_core.documents import Document
+from test_create_chart import make_chart
+
+import atlas_assistant.tools.select_dataset as select_dataset_module
+from atlas_assistant import engine
+from atlas_assistant.singleflight import SingleFlight, normalize
+
+
+def test_normalize():
+    assert normalize("  Mean value\tper COUNTRY?! ") == "mean value per country"
+
+
+async def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight("test")
+    executions = 0
+
+    async def work():
+        nonlocal executions
+        executions += 1
+        await asyncio.sleep(0.05)
+        return executions
+
+    results = await asyncio.gather(*(flight.run("key", work) for _ in range(10)))
+    assert results == [1] * 10
+    assert flight.stats == {"executions": 1, "coalesced": 9}
+    # Nothing is kept once the work is done
+    assert await flight.run("key", work) == 2
+
+
+async def test_errors_reach_every_caller():
+    flight = SingleFlight("test")
+
+    async def work():
+        await asyncio.sleep(0.01)
+        raise ValueError("bad SQL")
+
+    results = await asyncio.gather(
+        *(flight.run("key", work) for _ in range(3)), return_exceptions=True
+    )
+    assert [str(result) for result in results] == ["bad SQL"] * 3
+    assert flight.stats["executions"] == 1
+
+
+async def test_cancelling_a_caller_keeps_the_work_for_the_others():
+    flight = SingleFlight("test")
+    started = asyncio.Event()
+    cancelled = False
+
+    async def work():
+        nonlocal cancelled
+        started.set()
+        try:
+            await asyncio.sleep(0.1)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        return "chart"
+
+    first = asyncio.create_task(flight.run("key", work))
+    second = asyncio.create_task(flight.run("key", work))
+    await started.wait()
+    first.cancel()
+    assert await second == "chart"
+    with pytest.raises(asyncio.CancelledError):
+        await first
+
+    # Once every caller is gone, so is the work
+    only = asyncio.create_task(flight.run("key", work))
+    await asyncio.sleep(0.01)
+    only.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await only
+    await asyncio.sleep(0)
+    assert cancelled
+
+
+async def test_identical_charts_are_built_once(
+    fake_codestral: FakeCodestral,
+    parquet_dataset: dict,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    fake_codestral.latency = 0.05
+    chart_queries = []
+    fetch_table = engine.fetch_table
+
+    def counting_fetch_table(sql, settings=None, governed=False, query=None):
+        if governed:
+            chart_queries.append(sql)
+        return fetch_table(sql, settings, governed, query)
+
+    monkeypatch.setattr(engine, "fetch_table", counting_fetch_table)
+    prompts = ["Mean value per country", "mean value per country.", " MEAN value"]
+    commands = await asyncio.gather(
+        *(make_chart(parquet_dataset, f"call-{i}", prompts[i % 2]) for i in range(10)),
+        make_chart(parquet_dataset, "call-other", prompts[2]),
+    )
+    # One chart for the 10 identical requests, one for the other
+    assert len(fake_codestral.calls) == 2
+    assert len(chart_queries) == 2
+    assert [command.update["messages"][0].tool_call_id for command in commands] == [
+        *(f"call-{i}" for i in range(10)),
+        "call-other",
+    ]
+    assert all(
+        command.update["chart"] == commands[0].update["chart"]
+        for command in commands[:10]
+    )
+
+
+async def test_views_of_one_file_are_not_coalesced(
+    fake_codestral: FakeCodestral, parquet_dataset: dict
+):
+    fake_codestral.latency = 0.05
+    wet = {
+        **parquet_dataset,
+        "key": "test_heat_wet",
+        "sql": "SELECT * FROM '__s3__' WHERE scenario = 585",
+    }
+    await asyncio.gather(make_chart(parquet_dataset), make_chart(wet))
+    assert len(fake_codestral.calls) == 2
+
+
+async def test_identical_dataset_searches_run_once(monkeypatch: pytest.MonkeyPatch):
+    searches = 0
+
+    async def search_datasets(dataset_query, settings):
+        nonlocal searches
+        searches += 1
+        await asyncio.sleep(0.05)
+        document = Document(page_content="Cattle heat stress", metadata={"key": "hs"})
+        return [(document, 0.9)]
+
+    monkeypatch.setattr(select_dataset_module, "search_datasets", search_datasets)
+    commands = await asyncio.gather(
+        *(
+            select_dataset_module.select_dataset.coroutine(
+                dataset_query="cattle heat stress", tool_call_id=f"call-{i}"
+            )
+            for i in range(5)
+        )
+    )
+    assert searches == 1
+    datasets = [command.update["dataset"] for command in commands]
+    assert datasets == [{"key": "hs"}] * 5
+    assert datasets[0] is not datasets[1]
@@ -0,0 +1,58 @@
+import asyncio
+import subprocess
+import sys
+
+from conftest import ScriptedChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+
+from atlas_assistant import agent, engine, vectorstore
+from atlas_assistant.agent import get_graph, warm_up
+from atlas_assistant.settings import Settings
+
+HEAVY_MODULES = ["chromadb", "mistralai", "pandas", "plotly"]
+
+
+def test_heavy_modules_are_imported_on_first_use():
+    loaded = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, atlas_assistant.agent;"
+            f" print([m for m in {HEAVY_MODULES} if m in sys.modules])",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert loaded.stdout.strip() == "[]"
+
+
+def echo(messages: list[BaseMessage]) -> AIMessage:
+    assert "Today is" in messages[0].content
+    return AIMessage(content=f"{messages[-1].content}, {len(messages) - 1} messages")
+
+
+async def test_sessions_share_one_graph(offline_settings: Settings, monkeypatch):
+    model = ScriptedChatModel(script=echo)
+    monkeypatch.setattr(Settings, "get_chat_model", lambda self: model)
+
+    async def session(user: str) -> str:
+        graph = await get_graph(offline_settings)
+        config = {"configurable": {"thread_id": user}}
+        for turn in range(2):
+            state = await graph.ainvoke(
+                {"messages": [("user", f"{user} {turn}")]}, config
+            )
+        return state["messages"][-1].content
+
+    answers = await asyncio.gather(*(session(user) for user in ["ann", "bo"]))
+    assert answers == ["ann 1, 3 messages", "bo 1, 3 messages"]
+    assert await get_graph() is await get_graph(offline_settings)
+
+
+async def test_warm_up(offline_settings: Settings):
+    await warm_up(offline_settings)
+    assert vectorstore._vectorstore is not None
+    assert engine._database is not None
+    assert agent._graph is not None
+    assert "plotly.express" in sys.modules
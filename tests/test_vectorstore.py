@@ -0,0 +1,77 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from atlas_assistant import vectorstore
+from atlas_assistant.settings import Settings
+from atlas_assistant.tools.select_dataset import search_datasets
+
+
+async def test_vectorstore_is_shared(offline_settings: Settings):
+    first = await vectorstore.get_datasets_vectorstore(offline_settings)
+    second = await vectorstore.get_datasets_vectorstore(offline_settings)
+    assert first is second
+    results = first.similarity_search_with_score("cattle heat stress", k=3)
+    assert len(results) == 3
+
+
+async def test_dataset_search_embeds_asynchronously(
+    offline_settings: Settings,
+    fake_embeddings: DeterministicFakeEmbedding,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    queries = []
+    aembed_query = DeterministicFakeEmbedding.aembed_query
+
+    async def counting_aembed_query(self, text):
+        queries.append(text)
+        return await aembed_query(self, text)
+
+    monkeypatch.setattr(
+        DeterministicFakeEmbedding, "aembed_query", counting_aembed_query
+    )
+    settings = offline_settings.model_copy(update={"dataset_retriever": "chroma"})
+    store = await vectorstore.get_datasets_vectorstore(settings)
+    results = await search_datasets("cattle heat stress", settings)
+    assert queries == ["cattle heat stress"]
+    expected = store.similarity_search_with_score("cattle heat stress", k=3)
+    assert results == expected
+
+
+async def test_vectorstore_built_once_under_concurrency(
+    offline_settings: Settings, monkeypatch: pytest.MonkeyPatch
+):
+    calls = 0
+    load = vectorstore.load_datasets_vector_embeddings
+
+    def counting_load(settings, embedder=None):
+        nonlocal calls
+        calls += 1
+        return load(settings, embedder)
+
+    monkeypatch.setattr(vectorstore, "load_datasets_vector_embeddings", counting_load)
+    stores = await asyncio.gather(
+        *(vectorstore.get_datasets_vectorstore(offline_settings) for _ in range(8))
+    )
+    with ThreadPoolExecutor(4) as pool:
+        stores += list(pool.map(vectorstore._get_or_build, [offline_settings] * 8))
+    assert calls == 1
+    assert all(store is stores[0] for store in stores)
+
+
+async def test_reload_vectorstore(offline_settings: Settings):
+    first = await vectorstore.get_datasets_vectorstore(offline_settings)
+    vectorstore.reload_datasets_vectorstore(offline_settings)
+    second = await vectorstore.get_datasets_vectorstore(offline_settings)
+    assert first is not second
+    vectorstore.reload_datasets_vectorstore()
+    assert vectorstore._vectorstore is None
+
+
+def test_missing_index(tmp_path):
+    with pytest.raises(RuntimeError):
+        vectorstore.load_datasets_vector_embeddings(
+            Settings(datasets_index_path=tmp_path / "missing")
+        )